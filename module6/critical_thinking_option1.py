@@ -29,7 +29,7 @@ import networkx as nx
 import matplotlib.pyplot as plt
 import random
 
-from typing import Any, Self, List
+from typing import Any, Self, List, Tuple
 
 # ChatGPT recommended using the total_ordering decorator and implementing the equal and less than
 # methods then the total_ordering will take care of all the other compare functions
@@ -159,15 +159,34 @@ class AVLTree:
         self.root = None
         self.count = 0
         if start_data:
-            self._build_tree(start_data)
+            self.root = self._build_tree(start_data)
 
     def _build_tree(self, start_data: List[Any]) -> Node:
         # The prompt calls for sorting and removing duplicates from the data before turning it into
         # a balanced tree?
         # This removes duplicates by casting the list as a set, then back to a list, then sort it
         start_data = sorted(list(set(start_data)))
-        for i in start_data:
-            self.insert(i)
+        # Inserting sorted data one node at a time means a rotation on nearly every insert, so
+        # instead build the balanced tree directly and return its root
+        root, _ = self._build_subtree(start_data, 0, len(start_data) - 1, None)
+        return root
+
+    def _build_subtree(
+        self, start_data: List[Any], low: int, high: int, parent: Node
+    ) -> Tuple[Node, int]:
+        # The middle value becomes the root of this subtree, and each half becomes its children.
+        # The height comes back along with the node so the balance factors can be set without
+        # walking each subtree again
+        if low > high:
+            return None, 0
+        mid = (low + high) // 2
+        node = Node(start_data[mid], parent=parent)
+        node.left, left_height = self._build_subtree(start_data, low, mid - 1, node)
+        node.right, right_height = self._build_subtree(start_data, mid + 1, high, node)
+        # Taking the middle value means the halves never differ by more than one node, so the
+        # balance factor is always -1, 0, or 1
+        node.bf = right_height - left_height
+        return node, 1 + max(left_height, right_height)
 
     def _is_balanced(self, node: Node) -> bool:
         # Wiki says nodes can all have a balance factor, and the tree (or subtree?) is balanced
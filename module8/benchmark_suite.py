@@ -0,0 +1,541 @@
+# CSC 506 - Design and Analysis of Algorithms
+# Module 8 - Portfolio Project - Option 2
+# Benchmark suite for the retroactive search trees
+
+"""
+The benchmark in portfolio_project_option2.py runs a fixed set of tests one after the other and
+graphs the means. This runs the same kind of tests, but everything about them can be set from the
+command line: which trees, how big, what mix of operations and how far back the retroactive ones
+reach. Each trial builds its own tree and is independent of the others, so trials are spread over
+a process pool. Results are reported as percentiles and can be written out as JSON or CSV.
+
+Example:
+    python benchmark_suite.py --sizes 512 2048 --trials 8 --mix insert=1,retro_insert=1,pred=2 \
+        --retro near --json results.json --csv results.csv
+
+The retroactive trees that keep a mutable tree can run on any engine from search_engines.py, and
+--trees runs each of them once per engine:
+    python benchmark_suite.py --engines partial rollback --trees avl btree redblack
+
+With --crossover it instead looks for the retro depth, for each history length, where the fully
+retroactive tree and each other engine cost the same, which is the threshold the project asks for:
+    python benchmark_suite.py --crossover --sizes 1024 4096 16384 --operation retro_pred
+"""
+# Imports
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+import argparse
+import csv
+import json
+import math
+import os
+import random
+import time
+from typing import Callable, Dict, List, Tuple
+
+from portfolio_project_option2 import (
+    FullyRetroactiveAVL,
+    PartialRetroactiveAVL,
+    ReplayPartialRetroactiveAVL,
+    RollbackFullyRetroactiveAVL,
+)
+from search_engines import SEARCH_TREES
+
+
+# Each engine is a way of building an empty tree from a search tree class, whether it can answer
+# queries in the past, and whether it uses the search tree class at all. The partially retroactive
+# trees only know the present, so retro_pred is skipped for them. The fully retroactive tree is
+# always on its own persistent tree.
+ENGINES: Dict[str, Tuple[Callable[[type], object], bool, bool]] = {
+    "partial": (lambda tree: PartialRetroactiveAVL(engine=tree), False, True),
+    "replay": (lambda tree: ReplayPartialRetroactiveAVL(engine=tree), False, True),
+    "full": (lambda tree: FullyRetroactiveAVL(), True, False),
+    "rollback": (lambda tree: RollbackFullyRetroactiveAVL(engine=tree), True, True),
+    "rollback_snapshots": (
+        lambda tree: RollbackFullyRetroactiveAVL(use_snapshots=True, engine=tree),
+        True,
+        True,
+    ),
+}
+
+OPERATIONS = ["insert", "delete", "pred", "retro_insert", "retro_delete", "retro_pred"]
+
+
+# Where in the history a retroactive operation lands, given how many operations there are. Near
+# is the most recent 10% of the history, far is the oldest 10%. Any number between 0 and 1 can also
+# be used as a fixed fraction of the way through the history, like the original NEAR_IDX/FAR_IDX.
+def _uniform_point(rng: random.Random, length: int) -> int:
+    return rng.randint(0, length - 1)
+
+
+def _near_point(rng: random.Random, length: int) -> int:
+    return rng.randint(length - 1 - length // 10, length - 1)
+
+
+def _far_point(rng: random.Random, length: int) -> int:
+    return rng.randint(0, length // 10)
+
+
+# Most operations close to the present with a long tail into the past, the mean depth is 10%
+def _recent_point(rng: random.Random, length: int) -> int:
+    depth = int(rng.expovariate(10 / length))
+    return max(0, length - 1 - depth)
+
+
+RETRO_DISTRIBUTIONS: Dict[str, Callable[[random.Random, int], int]] = {
+    "uniform": _uniform_point,
+    "near": _near_point,
+    "far": _far_point,
+    "recent": _recent_point,
+}
+
+
+def retro_point_for(distribution: str, rng: random.Random, length: int) -> int:
+    if distribution in RETRO_DISTRIBUTIONS:
+        return RETRO_DISTRIBUTIONS[distribution](rng, length)
+    return min(length - 1, int(length * float(distribution)))
+
+
+@dataclass
+class BenchmarkConfig:
+    engines: List[str] = field(default_factory=lambda: ["partial", "full"])
+    # Search tree engines (names from SEARCH_TREES) for the retroactive trees to run on
+    trees: List[str] = field(default_factory=lambda: ["avl"])
+    sizes: List[int] = field(default_factory=lambda: [64, 512, 2048])
+    # Relative weights of each operation, the same operations are drawn for every engine
+    mix: Dict[str, float] = field(
+        default_factory=lambda: {"insert": 1, "delete": 1, "retro_insert": 1, "retro_delete": 1}
+    )
+    retro: str = "uniform"
+    trials: int = 20
+    operations: int = 50
+    seed: int = 0
+    workers: int = None
+
+
+# A tree with a history of size inserts of the keys 0 to size - 1 in a random order
+def build_tree(
+    engine: str, size: int, rng: random.Random, search_tree: str = "avl"
+) -> Tuple[object, List[int], float]:
+    tree = ENGINES[engine][0](SEARCH_TREES[search_tree])
+    keys = list(range(size))
+    rng.shuffle(keys)
+    start = time.perf_counter()
+    for key in keys:
+        tree.insert(key)
+    return tree, keys, time.perf_counter() - start
+
+
+# A single trial, run inside a worker process. It builds a tree of the given size and then times
+# each operation on its own, returning the latencies (in seconds) grouped by operation.
+def run_trial(
+    config: BenchmarkConfig, engine: str, search_tree: str, size: int, trial: int
+) -> Tuple[str, str, int, float, Dict[str, List[float]]]:
+    # The seed only depends on the size and trial, so every engine sees the same keys and the
+    # same operations in the same order
+    rng = random.Random(f"{config.seed}-{size}-{trial}")
+    can_query_past = ENGINES[engine][1]
+    tree, keys, build = build_tree(engine, size, rng, search_tree)
+    length = size
+
+    names = list(config.mix)
+    weights = [config.mix[name] for name in names]
+    timings = {name: [] for name in names}
+    for name in rng.choices(names, weights, k=config.operations):
+        value = rng.randint(0, size * 2)
+        if name == "delete" or name == "retro_delete":
+            value = rng.choice(keys) if size > 0 else value
+        retro = name.startswith("retro_")
+        point = retro_point_for(config.retro, rng, length) if retro and length > 0 else None
+        # Operations the engine can't do are still drawn, so the rest of the sequence matches
+        if retro and (length == 0 or (name == "retro_pred" and not can_query_past)):
+            continue
+
+        start = time.perf_counter()
+        if name == "pred":
+            tree.pred(value)
+        elif name == "retro_pred":
+            tree.pred(value, retro=True, retro_point=point)
+        elif name.endswith("insert"):
+            tree.insert(value, retro=retro, retro_point=point)
+        else:
+            tree.delete(value, retro=retro, retro_point=point)
+        timings[name].append(time.perf_counter() - start)
+        if not name.endswith("pred"):
+            length += 1
+    return engine, search_tree, size, build, timings
+
+
+# Linear interpolation between the closest ranks, the same as numpy's default
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if len(sorted_values) == 0:
+        return float("nan")
+    position = (len(sorted_values) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+# One row per engine, search tree, size and operation, with the latencies in microseconds.
+# Operations an engine skipped every time don't get a row.
+def summarize(
+    results: List[Tuple[str, str, int, float, Dict[str, List[float]]]]
+) -> List[Dict[str, object]]:
+    builds = {}
+    latencies = {}
+    for engine, search_tree, size, build, timings in results:
+        builds.setdefault((engine, search_tree, size), []).append(build)
+        for name, values in timings.items():
+            latencies.setdefault((engine, search_tree, size, name), []).extend(values)
+
+    rows = []
+    for (engine, search_tree, size, name), values in sorted(latencies.items()):
+        if len(values) == 0:
+            continue
+        values.sort()
+        build_times = builds[(engine, search_tree, size)]
+        rows.append(
+            {
+                "engine": engine,
+                "tree": search_tree,
+                "size": size,
+                "operation": name,
+                "count": len(values),
+                "mean_us": sum(values) / len(values) * 1e6,
+                "p50_us": percentile(values, 0.50) * 1e6,
+                "p95_us": percentile(values, 0.95) * 1e6,
+                "p99_us": percentile(values, 0.99) * 1e6,
+                "max_us": values[-1] * 1e6,
+                "build_s": sum(build_times) / len(build_times),
+            }
+        )
+    return rows
+
+
+def run_benchmark(config: BenchmarkConfig) -> List[Dict[str, object]]:
+    for engine in config.engines:
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}, expected one of {list(ENGINES)}")
+    for search_tree in config.trees:
+        if search_tree not in SEARCH_TREES:
+            raise ValueError(f"Unknown tree {search_tree}, expected one of {list(SEARCH_TREES)}")
+    for name in config.mix:
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name}, expected one of {OPERATIONS}")
+    if config.retro not in RETRO_DISTRIBUTIONS:
+        fraction = float(config.retro)
+        if not 0 <= fraction <= 1:
+            raise ValueError(f"Retro point fraction {fraction} must be between 0 and 1")
+
+    tasks = [
+        (engine, search_tree, size, trial)
+        for size in config.sizes
+        for engine in config.engines
+        # The engines that don't use a search tree only run once
+        for search_tree in (config.trees if ENGINES[engine][2] else config.trees[:1])
+        for trial in range(config.trials)
+    ]
+    with ProcessPoolExecutor(max_workers=config.workers) as pool:
+        futures = [pool.submit(run_trial, config, *task) for task in tasks]
+        results = [future.result() for future in futures]
+    return summarize(results)
+
+
+# The project asks where the fully retroactive tree beats the rollback solution. How much a
+# retroactive operation costs mostly depends on how long the history is and how far back the
+# operation reaches (its depth, 1 being the most recent operation), so for each history length the
+# depth where two engines cost the same is found by bisection. Within one history length the
+# cost ratio is assumed to only cross over once.
+@dataclass
+class CrossoverConfig:
+    baseline: str = "full"
+    challengers: List[str] = field(
+        default_factory=lambda: ["rollback", "rollback_snapshots", "replay", "partial"]
+    )
+    histories: List[int] = field(default_factory=lambda: [256, 1024, 4096])
+    # The search tree engine for the baseline and challengers that use one
+    tree: str = "avl"
+    operation: str = "retro_insert"
+    # Each cost is the median of this many operations at the same depth
+    repeats: int = 5
+    # Stop bisecting once the crossover is known to within this fraction of the history
+    tolerance: float = 0.02
+    seed: int = 0
+    workers: int = None
+
+
+# Median time (in seconds) of repeats retroactive operations the given depth into the history
+def retro_cost(
+    tree: object, operation: str, depth: int, repeats: int, length: int, rng: random.Random
+) -> Tuple[float, int]:
+    samples = []
+    for _ in range(repeats):
+        value = rng.randint(0, length * 2)
+        point = max(0, length - depth)
+        start = time.perf_counter()
+        if operation == "retro_pred":
+            tree.pred(value, retro=True, retro_point=point)
+        elif operation == "retro_insert":
+            tree.insert(value, retro=True, retro_point=point)
+            length += 1
+        else:
+            tree.delete(value, retro=True, retro_point=point)
+            length += 1
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2], length
+
+
+# Runs inside a worker process, one history length and one challenger against the baseline.
+# Every probe builds both trees fresh from the same keys and draws its operations from an rng
+# seeded by the history and depth, so a probe measures the same workload no matter which probes
+# came before it and the bisection gives the same answer every time it's run.
+def find_crossover(config: CrossoverConfig, history: int, challenger: str) -> Dict[str, object]:
+    # Positive when the baseline is slower
+    def log_ratio(depth: int) -> float:
+        costs = []
+        for name in (config.baseline, challenger):
+            rng = random.Random(f"{config.seed}-{history}")
+            tree, _, _ = build_tree(name, history, rng, config.tree)
+            rng = random.Random(f"{config.seed}-{history}-{depth}")
+            cost, _ = retro_cost(tree, config.operation, depth, config.repeats, history, rng)
+            costs.append(max(cost, 1e-9))
+        return math.log(costs[0] / costs[1])
+
+    low, high = 1, history
+    low_ratio, high_ratio = log_ratio(low), log_ratio(high)
+    evaluations = 2
+    crossover = None
+    if (low_ratio > 0) != (high_ratio > 0):
+        # Depths are bisected geometrically since costs tend to change with the log of the depth
+        # on one side and linearly on the other
+        while high - low > max(1, int(config.tolerance * history)):
+            middle = min(max(math.isqrt(low * high), low + 1), high - 1)
+            middle_ratio = log_ratio(middle)
+            evaluations += 1
+            if (middle_ratio > 0) == (low_ratio > 0):
+                low = middle
+            else:
+                high = middle
+        crossover = (low + high) // 2
+
+    return {
+        "operation": config.operation,
+        "history": history,
+        "baseline": config.baseline,
+        "challenger": challenger,
+        "tree": config.tree,
+        "crossover_depth": crossover,
+        "crossover_fraction": crossover / history if crossover is not None else None,
+        "shallow_winner": challenger if low_ratio > 0 else config.baseline,
+        "deep_winner": challenger if high_ratio > 0 else config.baseline,
+        "shallow_ratio": math.exp(low_ratio),
+        "deep_ratio": math.exp(high_ratio),
+        "evaluations": evaluations,
+    }
+
+
+def run_crossover(config: CrossoverConfig) -> List[Dict[str, object]]:
+    engines = [config.baseline] + config.challengers
+    for engine in engines:
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}, expected one of {list(ENGINES)}")
+        if config.operation == "retro_pred" and not ENGINES[engine][1]:
+            raise ValueError(f"{engine} can't answer queries in the past")
+    if config.tree not in SEARCH_TREES:
+        raise ValueError(f"Unknown tree {config.tree}, expected one of {list(SEARCH_TREES)}")
+    if config.operation not in ("retro_insert", "retro_delete", "retro_pred"):
+        raise ValueError(f"Crossover needs a retroactive operation, not {config.operation}")
+
+    tasks = [
+        (history, challenger)
+        for history in config.histories
+        for challenger in config.challengers
+        if challenger != config.baseline
+    ]
+    with ProcessPoolExecutor(max_workers=config.workers) as pool:
+        futures = [pool.submit(find_crossover, config, *task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+CROSSOVER_COLUMNS = [
+    "operation",
+    "history",
+    "baseline",
+    "challenger",
+    "tree",
+    "crossover_depth",
+    "crossover_fraction",
+    "shallow_winner",
+    "deep_winner",
+    "shallow_ratio",
+    "deep_ratio",
+    "evaluations",
+]
+
+
+def print_crossover_table(rows: List[Dict[str, object]]) -> None:
+    print(
+        f"{'History':>8} | {'Baseline':>10} | {'Challenger':>18} | {'Crossover':>9} | "
+        f"{'Fraction':>8} | {'Shallow winner':>18} | {'Deep winner':>18}"
+    )
+    for row in rows:
+        depth = row["crossover_depth"]
+        fraction = row["crossover_fraction"]
+        print(
+            f"{row['history']:>8} | {row['baseline']:>10} | {row['challenger']:>18} | "
+            f"{depth if depth is not None else 'none':>9} | "
+            f"{f'{fraction:.3f}' if fraction is not None else '-':>8} | "
+            f"{row['shallow_winner']:>18} | {row['deep_winner']:>18}"
+        )
+
+
+COLUMNS = [
+    "engine",
+    "tree",
+    "size",
+    "operation",
+    "count",
+    "mean_us",
+    "p50_us",
+    "p95_us",
+    "p99_us",
+    "max_us",
+    "build_s",
+]
+
+
+def write_json(path: str, config: object, rows: List[Dict[str, object]]) -> None:
+    with open(path, "w") as output:
+        json.dump({"config": asdict(config), "results": rows}, output, indent=2)
+
+
+def write_csv(path: str, rows: List[Dict[str, object]], columns: List[str] = COLUMNS) -> None:
+    with open(path, "w", newline="") as output:
+        writer = csv.DictWriter(output, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def print_table(rows: List[Dict[str, object]]) -> None:
+    print(
+        f"{'Engine':>18} | {'Tree':>9} | {'Size':>7} | {'Operation':>12} | {'Count':>6} | "
+        f"{'Mean (us)':>10} | {'p50 (us)':>10} | {'p95 (us)':>10} | {'p99 (us)':>10}"
+    )
+    for row in rows:
+        print(
+            f"{row['engine']:>18} | {row['tree']:>9} | {row['size']:>7} | {row['operation']:>12} | "
+            f"{row['count']:>6} | {row['mean_us']:>10.2f} | {row['p50_us']:>10.2f} | "
+            f"{row['p95_us']:>10.2f} | {row['p99_us']:>10.2f}"
+        )
+
+
+# "insert=2,pred=1" -> {"insert": 2.0, "pred": 1.0}
+def _parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight) if weight else 1.0
+    return mix
+
+
+def main(argv: List[str] = None) -> None:
+    defaults = BenchmarkConfig()
+    crossover_defaults = CrossoverConfig()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=list(ENGINES),
+        help="engines to run, or with --crossover the engines to compare against the baseline",
+    )
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, help="tree sizes, or with --crossover history lengths"
+    )
+    parser.add_argument(
+        "--mix",
+        type=_parse_mix,
+        default=defaults.mix,
+        help=f"comma separated operation=weight pairs, operations are {', '.join(OPERATIONS)}",
+    )
+    parser.add_argument(
+        "--retro",
+        default=defaults.retro,
+        help=f"{', '.join(RETRO_DISTRIBUTIONS)} or a fixed fraction of the history like 0.9",
+    )
+    parser.add_argument(
+        "--trees",
+        nargs="+",
+        choices=list(SEARCH_TREES),
+        help="search tree engines to run the retroactive trees on, with --crossover only the first",
+    )
+    parser.add_argument("--trials", type=int, default=defaults.trials)
+    parser.add_argument(
+        "--operations", type=int, default=defaults.operations, help="timed operations per trial"
+    )
+    parser.add_argument(
+        "--crossover",
+        action="store_true",
+        help="find the retro depth where the baseline and each other engine cost the same",
+    )
+    parser.add_argument("--baseline", default=crossover_defaults.baseline, choices=list(ENGINES))
+    parser.add_argument(
+        "--operation",
+        default=crossover_defaults.operation,
+        choices=["retro_insert", "retro_delete", "retro_pred"],
+        help="retroactive operation to compare with --crossover",
+    )
+    parser.add_argument("--repeats", type=int, default=crossover_defaults.repeats)
+    parser.add_argument("--tolerance", type=float, default=crossover_defaults.tolerance)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--csv", help="write the results to this CSV file")
+    args = parser.parse_args(argv)
+
+    if args.crossover:
+        challengers = args.engines
+        if challengers is None:
+            # Only the engines that can do the operation, the partial ones can't query the past
+            challengers = [
+                engine
+                for engine in crossover_defaults.challengers
+                if args.operation != "retro_pred" or ENGINES[engine][1]
+            ]
+        config = CrossoverConfig(
+            baseline=args.baseline,
+            challengers=challengers,
+            histories=args.sizes or crossover_defaults.histories,
+            tree=args.trees[0] if args.trees else crossover_defaults.tree,
+            operation=args.operation,
+            repeats=args.repeats,
+            tolerance=args.tolerance,
+            seed=args.seed,
+            workers=args.workers,
+        )
+        rows = run_crossover(config)
+        print_crossover_table(rows)
+        columns = CROSSOVER_COLUMNS
+    else:
+        config = BenchmarkConfig(
+            engines=args.engines or defaults.engines,
+            trees=args.trees or defaults.trees,
+            sizes=args.sizes or defaults.sizes,
+            mix=args.mix,
+            retro=args.retro,
+            trials=args.trials,
+            operations=args.operations,
+            seed=args.seed,
+            workers=args.workers,
+        )
+        rows = run_benchmark(config)
+        print_table(rows)
+        columns = COLUMNS
+    if args.json:
+        write_json(args.json, config, rows)
+    if args.csv:
+        write_csv(args.csv, rows, columns)
+
+
+if __name__ == "__main__":
+    main()
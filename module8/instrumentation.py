@@ -0,0 +1,313 @@
+# CSC 506 - Design and Analysis of Algorithms
+# Module 8 - Portfolio Project - Option 2
+# Counters and timing hooks for the search trees in portfolio_project_option2.py
+
+"""
+Collect counts of what the trees are doing for a block of code:
+
+    with instrumentation.collect() as stats:
+        tree.insert(5, retro=True, retro_point=0)
+    print(stats.rotations, stats.replayed)
+
+Comparisons are counted inside the search loops themselves. Every search tree class (the AVL trees
+and the engines in search_engines.py) has a stats attribute that is None until something counts,
+so while nothing is being collected a search only pays for one None check. A collection points the
+classes' stats at its running totals. To count one tree's searches on its own, without touching
+anything else in the process, give just that tree a counter:
+
+    tree.stats = instrumentation.TreeStats()
+
+The other counters (rotations, height updates, node creation and log replays) work by swapping
+counting wrappers in for those methods when the first collection starts, and swapping them back
+out when the last one ends. Those wrappers, and the class level stats, are process wide. Everything
+every thread does to any tree while a collection is open gets counted, and the copy on write
+readers of FullyRetroactiveAVL are counted along with the writer. Don't start or end a collection
+while other threads are inside the trees, since the methods are being swapped under them.
+
+Per-call timing is handled the same way. collect(timing=True) records how long each public insert,
+delete and pred call on the retroactive trees takes, and add_timing_hook registers a function that
+is called with the method name and the seconds it took for every one of those calls. Timing is
+swapped in the same process wide way.
+"""
+# Imports
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields
+import bisect
+import functools
+import time
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import portfolio_project_option2 as trees
+import search_engines
+
+
+@dataclass
+class TreeStats:
+    # Nodes looked at walking down the trees, a key comparison for the binary trees and skip list
+    # and a bisect over a node's keys for the B-trees
+    comparisons: int = 0
+    # Single rotations, a double rotation counts as two
+    rotations: int = 0
+    # Times a node's height was worked out again from its children
+    height_updates: int = 0
+    # Operation log entries that had to be replayed, or timestamps the partially retroactive tree
+    # had to relabel
+    replayed: int = 0
+    # Tree nodes created, including the path copies made by the persistent tree
+    allocations: int = 0
+    # Seconds taken by each public call, by method name, only filled in when timing is on
+    timings: Dict[str, List[float]] = field(default_factory=dict)
+
+    def as_dict(self) -> Dict[str, object]:
+        return {item.name: getattr(self, item.name) for item in fields(self)}
+
+
+_COUNTERS = ["comparisons", "rotations", "height_updates", "replayed", "allocations"]
+
+# Running totals while the counters are installed, each collection reports the difference between
+# the totals when it started and when it ended so collections can be nested
+_totals = TreeStats()
+_counting = 0
+_timing = 0
+_timing_blocks: List[TreeStats] = []
+_hooks: List[Callable[[str, float], None]] = []
+# (owner, name) -> the original attribute, for everything that is currently wrapped
+_originals: Dict[Tuple[object, str], object] = {}
+
+
+def _wrap_counter(owner: object, name: str, counter: str, amount: int = 1) -> None:
+    original = getattr(owner, name)
+
+    @functools.wraps(original)
+    def wrapper(*args, **kwargs):
+        setattr(_totals, counter, getattr(_totals, counter) + amount)
+        return original(*args, **kwargs)
+
+    _replace(owner, name, wrapper)
+
+
+# Wrap a method that replays part of a history, count_replayed works out how many entries it
+# replayed from the tree and the arguments
+def _wrap_replay(owner: type, name: str, count_replayed: Callable) -> None:
+    original = getattr(owner, name)
+
+    @functools.wraps(original)
+    def wrapper(self, *args, **kwargs):
+        _totals.replayed += count_replayed(self, *args, **kwargs)
+        return original(self, *args, **kwargs)
+
+    _replace(owner, name, wrapper)
+
+
+def _replace(owner: object, name: str, wrapper: Callable) -> None:
+    _originals[(owner, name)] = owner.__dict__[name]
+    setattr(owner, name, wrapper)
+
+
+def _restore(names: List[Tuple[object, str]]) -> None:
+    for owner, name in names:
+        setattr(owner, name, _originals.pop((owner, name)))
+
+
+# The persistent tree rotates by building new nodes, so this looks at the same heights
+# _persistent_balance does to tell how many rotations it is about to make
+def _persistent_rotations(
+    value: int, left: trees.PersistentNode, right: trees.PersistentNode
+) -> int:
+    height = trees._persistent_height
+    if height(left) - height(right) > 1:
+        return 1 if height(left.left) >= height(left.right) else 2
+    if height(right) - height(left) > 1:
+        return 1 if height(right.right) >= height(right.left) else 2
+    return 0
+
+
+def _wrap_persistent_balance() -> None:
+    original = trees._persistent_balance
+
+    @functools.wraps(original)
+    def wrapper(value, left, right):
+        _totals.rotations += _persistent_rotations(value, left, right)
+        return original(value, left, right)
+
+    _replace(trees, "_persistent_balance", wrapper)
+
+
+# How far the rollback tree rolls back or forward, or replays from a snapshot
+def _rollback_steps(tree: trees.RollbackFullyRetroactiveAVL, point: int) -> int:
+    return max(0, tree._current_retro - point)
+
+
+def _rollforward_steps(tree: trees.RollbackFullyRetroactiveAVL, point: int) -> int:
+    return max(0, point - tree._current_retro)
+
+
+def _snapshot_steps(tree: trees.RollbackFullyRetroactiveAVL, point: int) -> int:
+    index = bisect.bisect_right(tree._snapshot_points, point) - 1
+    start = tree._snapshot_points[index] + 1 if index >= 0 else 0
+    return point + 1 - start
+
+
+def _replay_partial_steps(tree: trees.ReplayPartialRetroactiveAVL, start: int = 0) -> int:
+    kept = start // tree._checkpoint_interval
+    return len(tree._operations) - kept * tree._checkpoint_interval
+
+
+def _rebuild_steps(tree: trees.FullyRetroactiveAVL, start: int = 0) -> int:
+    return len(tree._operations) - start
+
+
+def _materialize_steps(tree: trees.FullyRetroactiveAVL, count: int) -> int:
+    return max(0, count - len(tree._versions))
+
+
+def _relabel_steps(timeline: trees.Timeline, chunk: trees.TimelineChunk) -> int:
+    return len(chunk.stamps)
+
+
+# The classes whose searches count comparisons into their stats, _Engine covers every engine in
+# search_engines.py
+_SEARCH_CLASSES = [
+    trees.AVLTree,
+    trees.ArenaAVLTree,
+    trees.PersistentAVLTree,
+    search_engines._Engine,
+]
+
+
+def _install_counters() -> None:
+    for owner in _SEARCH_CLASSES:
+        owner.stats = _totals
+    avl, arena = trees.AVLTree, trees.ArenaAVLTree
+    for owner in (avl, arena, search_engines.RedBlackTree):
+        _wrap_counter(owner, "_rotate_left", "rotations")
+        _wrap_counter(owner, "_rotate_right", "rotations")
+    _wrap_counter(avl, "_update_balance_factors", "height_updates")
+    _wrap_counter(arena, "_update_height", "height_updates")
+    _wrap_counter(arena, "_new_node", "allocations")
+    _wrap_counter(trees.TreeNode, "__init__", "allocations")
+
+    _wrap_counter(trees.PersistentNode, "__init__", "allocations")
+    _wrap_counter(trees, "_persistent_node", "height_updates")
+    _wrap_persistent_balance()
+    # The engines' nodes. The treap and the B-trees don't rotate, they split and merge.
+    for node in (
+        search_engines._RedBlackNode,
+        search_engines._TreapNode,
+        search_engines._SkipNode,
+        search_engines._BTreeNode,
+        search_engines._BPlusLeaf,
+        search_engines._BPlusInternal,
+    ):
+        _wrap_counter(node, "__init__", "allocations")
+
+    rollback = trees.RollbackFullyRetroactiveAVL
+    _wrap_replay(rollback, "rollback", _rollback_steps)
+    _wrap_replay(rollback, "rollforward", _rollforward_steps)
+    _wrap_replay(rollback, "_tree_at", _snapshot_steps)
+    _wrap_replay(trees.ReplayPartialRetroactiveAVL, "_rebuild", _replay_partial_steps)
+    _wrap_replay(trees.FullyRetroactiveAVL, "_rebuild", _rebuild_steps)
+    _wrap_replay(trees.FullyRetroactiveAVL, "_materialize", _materialize_steps)
+    _wrap_replay(trees.Timeline, "_relabel", _relabel_steps)
+
+
+_TIMED_CLASSES = [
+    trees.PartialRetroactiveAVL,
+    trees.ReplayPartialRetroactiveAVL,
+    trees.RollbackFullyRetroactiveAVL,
+    trees.FullyRetroactiveAVL,
+]
+_TIMED_METHODS = ["insert", "delete", "pred", "insert_many", "delete_many"]
+
+
+def _install_timing() -> None:
+    for owner in _TIMED_CLASSES:
+        for name in _TIMED_METHODS:
+            if name in owner.__dict__:
+                _wrap_timed(owner, name, f"{owner.__name__}.{name}")
+
+
+def _wrap_timed(owner: type, name: str, label: str) -> None:
+    original = getattr(owner, name)
+
+    @functools.wraps(original)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            for stats in _timing_blocks:
+                stats.timings.setdefault(label, []).append(elapsed)
+            for hook in _hooks:
+                hook(label, elapsed)
+
+    _replace(owner, name, wrapper)
+
+
+def _timed_names() -> List[Tuple[object, str]]:
+    return [
+        (owner, name)
+        for owner in _TIMED_CLASSES
+        for name in _TIMED_METHODS
+        if (owner, name) in _originals
+    ]
+
+
+def _counter_names() -> List[Tuple[object, str]]:
+    timed = set(_timed_names())
+    return [key for key in _originals if key not in timed]
+
+
+def _start_timing() -> None:
+    global _timing
+    if _timing == 0:
+        _install_timing()
+    _timing += 1
+
+
+def _stop_timing() -> None:
+    global _timing
+    _timing -= 1
+    if _timing == 0:
+        _restore(_timed_names())
+
+
+# Collect stats for the code run inside the with block. The counts are filled in when the block
+# ends. With timing=True the time of each public call on the retroactive trees is kept as well.
+@contextmanager
+def collect(timing: bool = False) -> Iterator[TreeStats]:
+    global _counting
+    if _counting == 0:
+        _install_counters()
+    _counting += 1
+    stats = TreeStats()
+    if timing:
+        _timing_blocks.append(stats)
+        _start_timing()
+    start = {name: getattr(_totals, name) for name in _COUNTERS}
+    try:
+        yield stats
+    finally:
+        for name in _COUNTERS:
+            setattr(stats, name, getattr(_totals, name) - start[name])
+        if timing:
+            _timing_blocks.remove(stats)
+            _stop_timing()
+        _counting -= 1
+        if _counting == 0:
+            _restore(_counter_names())
+            for owner in _SEARCH_CLASSES:
+                owner.stats = None
+
+
+# Call hook(name, seconds) after every public insert, delete and pred on the retroactive trees until
+# it is removed again
+def add_timing_hook(hook: Callable[[str, float], None]) -> None:
+    _hooks.append(hook)
+    _start_timing()
+
+
+def remove_timing_hook(hook: Callable[[str, float], None]) -> None:
+    _hooks.remove(hook)
+    _stop_timing()
@@ -3,10 +3,6 @@
 # Michael Luker
 # March 10, 2024
 
-import sys
-
-sys.recursionlimit = 20000
-
 """
 Prompt:
 In this portfolio project, retroactive search trees will be implemented - both partially and fully 
@@ -22,17 +18,31 @@ retroactive search tree with a simple rollback solution. What are the thresholds
 complicated solution is superior to the rollback solution?
 """
 # Imports
+from array import array
+from collections import Counter
+from contextlib import nullcontext
 from dataclasses import dataclass
+import bisect
+import heapq
+import itertools
+import math
+import mmap
 import random
+import struct
+import threading
 import time
-from typing import Any, List, Self
+from typing import Any, List, Protocol, Self, Tuple
 from functools import total_ordering
+from operator import attrgetter, index
 
 
 # To me this seems like it should be broken down into a few different objects to make things easier
 # First, is a node in the binary search tree, it contains a value and links to the left (lower value)
 # and right (higher value) nodes
-@dataclass(repr=False, eq=False, order=False)
+# Using slots drops the per node __dict__, which like in module 4 cuts the size of every node down a
+# lot. The tree code compares node.value directly, the compare methods are only there so nodes can
+# still be compared to each other or to plain values.
+@dataclass(repr=False, eq=False, order=False, slots=True)
 @total_ordering
 class TreeNode:
     value: int
@@ -40,37 +50,376 @@ class TreeNode:
     left: Self = None
     right: Self = None
     bf: int = 0
-    __eq__: Any = lambda self, other: self.value == other
-    __lt__: Any = lambda self, other: self.value < other
+    # Height of the subtree rooted at this node, cached so balance factors can be found without
+    # walking the whole subtree (a leaf has a height of 1, an empty subtree a height of 0)
+    height: int = 1
+    # Number of nodes in the subtree rooted at this node, used for rank and select
+    size: int = 1
+
+    def __eq__(self, other: Any) -> bool:
+        return self.value == other
+
+    def __lt__(self, other: Any) -> bool:
+        return self.value < other
+
+
+# What the retroactive trees need from the search tree that holds their present state (or their
+# checkpoints and snapshots). AVLTree is the default, and search_engines.py has a red-black tree, a
+# treap, a skip list and a B-tree that can be passed in instead. Every engine is a multiset:
+# inserting a value that's already there adds another copy, and delete removes one copy and says
+# whether it found one. insert takes either a TreeNode or a plain value.
+class SearchTree(Protocol):
+    @classmethod
+    def from_sorted(cls, sorted_data: List[int]) -> Self: ...
+
+    def insert(self, newNode: TreeNode) -> None: ...
+
+    def delete(self, data: int) -> bool: ...
+
+    def insert_many(self, values: List[int]) -> None: ...
+
+    def delete_many(self, values: List[int]) -> int: ...
+
+    # The largest value <= x, or None
+    def pred(self, x: int) -> int: ...
+
+    def rank(self, x: int) -> int: ...
+
+    def select(self, k: int) -> int: ...
+
+    def count(self, lo: int, hi: int) -> int: ...
+
+    def __len__(self) -> int: ...
+
+    def in_order(self): ...
+
+    def print_tree(self) -> None: ...
 
 
 # The acutal search tree contains a root and the functions related to any given instance of a tree
 # Doing an AVL BST seems like it might be nice as well? https://en.wikipedia.org/wiki/AVL_tree
 class AVLTree:
 
+    # Opt in counters for instrumentation.py, None unless something is counting. Setting it on
+    # one tree (tree.stats = TreeStats()) counts the nodes only that tree's searches look at.
+    stats = None
+
     def __init__(self, starting_data: List[Any] = None) -> None:
         self.root = None
 
-        # If there is starting data, it can be inserted into the tree (after sanitizing)
+        # If there is starting data, it can be built straight into a balanced tree (after sanitizing)
         if starting_data is not None and len(starting_data) > 0:
             starting_data = sorted(list(set(starting_data)))
-            for data in starting_data:
-                self.insert(TreeNode(data))
+            self.root = self._build_tree(starting_data, 0, len(starting_data) - 1, None)
+
+    # Build a tree from data that is already sorted with no duplicates, skipping the sort in __init__
+    @classmethod
+    def from_sorted(cls, sorted_data: List[Any]) -> Self:
+        tree = cls()
+        tree.root = tree._build_tree(sorted_data, 0, len(sorted_data) - 1, None)
+        return tree
+
+    # Inserting sorted data one at a time is the worst case for an AVL tree since every insert
+    # lands on the right edge and triggers a rotation. Instead the middle value of the sorted data
+    # becomes the root and each half is built the same way, which is perfectly balanced and O(n).
+    # The recursion only goes log(n) levels deep.
+    def _build_tree(
+        self, sorted_data: List[Any], low: int, high: int, parent: TreeNode
+    ) -> TreeNode:
+        if low > high:
+            return None
+        mid = (low + high) // 2
+        node = TreeNode(sorted_data[mid], parent=parent)
+        node.left = self._build_tree(sorted_data, low, mid - 1, node)
+        node.right = self._build_tree(sorted_data, mid + 1, high, node)
+        self._set_built_shape(node, low, mid, high)
+        return node
+
+    # The set operations below are built on join and split, the same way as in "Just Join for
+    # Parallel Ordered Sets" (Blelloch, Ferizovic and Sun). For a tree of m values combined with a
+    # tree of n values they cost O(m log(n/m + 1)), so a small tree going into a big one only pays
+    # for the paths it touches. Nodes are moved rather than copied, so both trees are used up and
+    # left empty afterwards. They treat the trees as sets, a value in both only shows up once in
+    # the result, but duplicate copies already inside one tree are left as they are.
+
+    # A new tree holding every value from either tree
+    def union(self, other: Self) -> Self:
+        return self._take_result(self._union(self.root, other.root), other)
+
+    # A new tree holding the values that are in both trees
+    def intersection(self, other: Self) -> Self:
+        return self._take_result(self._intersection(self.root, other.root), other)
+
+    # A new tree holding the values in this tree that aren't in the other
+    def difference(self, other: Self) -> Self:
+        return self._take_result(self._difference(self.root, other.root), other)
+
+    # Same as union, but this tree takes on the merged contents
+    def merge(self, other: Self) -> None:
+        self.root = self.union(other).root
+
+    # Split this tree into one tree holding the values <= x and one holding the values > x, in
+    # O(log n). Like the set operations, this tree is left empty.
+    def split(self, x: int) -> Tuple[Self, Self]:
+        lower, upper = self._split(self.root, x)
+        self.root = None
+        left, right = type(self)(), type(self)()
+        left.root, right.root = lower, upper
+        return left, right
+
+    # The opposite of split, every value in left must be <= key and every value in right >= key.
+    # Costs O(|height(left) - height(right)|), both trees are left empty.
+    @classmethod
+    def join(cls, left: Self, key: int, right: Self) -> Self:
+        tree = cls()
+        tree.root = tree._join(left.root, TreeNode(key), right.root)
+        left.root = None
+        right.root = None
+        return tree
+
+    def _take_result(self, root: TreeNode, other: Self) -> Self:
+        self.root = None
+        other.root = None
+        tree = type(self)()
+        tree.root = root
+        return tree
+
+    # Join works on bare subtrees, which can be in the middle of being taken apart, so self.root is
+    # only used as scratch space for the rotations while a join is running
+    def _join(self, left: TreeNode, node: TreeNode, right: TreeNode) -> TreeNode:
+        left_height = self._height(left)
+        right_height = self._height(right)
+        node.parent = None
+        # Close enough in height that the node can just sit on top of both
+        if abs(left_height - right_height) <= 1:
+            self._attach(node, left, right)
+            return node
+
+        # Otherwise walk down the taller tree's inner edge until reaching a subtree that is close
+        # enough in height to the shorter tree, then the node takes that subtree's place with the
+        # subtree and the shorter tree as its children. That is at most one level taller than what
+        # was there, so rebalancing from there up is the same as after an insert.
+        if left_height > right_height:
+            parent = None
+            current = left
+            while self._height(current) > right_height + 1:
+                parent = current
+                current = current.right
+            self._attach(node, current, right)
+            parent.right = node
+        else:
+            parent = None
+            current = right
+            while self._height(current) > left_height + 1:
+                parent = current
+                current = current.left
+            self._attach(node, left, current)
+            parent.left = node
+        node.parent = parent
+        self.root = left if left_height > right_height else right
+        self.root.parent = None
+        self._rebalance(parent)
+        return self.root
+
+    def _attach(self, node: TreeNode, left: TreeNode, right: TreeNode) -> None:
+        node.left = left
+        node.right = right
+        if left is not None:
+            left.parent = node
+        if right is not None:
+            right.parent = node
+        self._update_balance_factors(node)
+
+    # Join without a key in the middle, the largest value on the left is pulled out to be the key
+    def _join_pair(self, left: TreeNode, right: TreeNode) -> TreeNode:
+        if left is None:
+            return right
+        left, last = self._split_last(left)
+        return self._join(left, last, right)
+
+    # Take a node's children off it so each one is the root of a tree of its own
+    def _detach(self, node: TreeNode) -> Tuple[TreeNode, TreeNode]:
+        left, right = node.left, node.right
+        node.left = None
+        node.right = None
+        if left is not None:
+            left.parent = None
+        if right is not None:
+            right.parent = None
+        return left, right
+
+    # The split recursion only goes as deep as the tree is tall, so O(log n) levels
+    def _split(self, node: TreeNode, x: int) -> Tuple[TreeNode, TreeNode]:
+        if node is None:
+            return None, None
+        left, right = self._detach(node)
+        if node.value <= x:
+            lower, upper = self._split(right, x)
+            return self._join(left, node, lower), upper
+        lower, upper = self._split(left, x)
+        return lower, self._join(upper, node, right)
+
+    # Split into the values < x, the node holding x (or None) and the values > x
+    def _split_at(self, node: TreeNode, x: int) -> Tuple[TreeNode, TreeNode, TreeNode]:
+        if node is None:
+            return None, None, None
+        left, right = self._detach(node)
+        if x < node.value:
+            lower, found, upper = self._split_at(left, x)
+            return lower, found, self._join(upper, node, right)
+        if x > node.value:
+            lower, found, upper = self._split_at(right, x)
+            return self._join(left, node, lower), found, upper
+        return left, node, right
+
+    def _split_last(self, node: TreeNode) -> Tuple[TreeNode, TreeNode]:
+        left, right = self._detach(node)
+        if right is None:
+            return left, node
+        rest, last = self._split_last(right)
+        return self._join(left, node, rest), last
+
+    def _union(self, first: TreeNode, second: TreeNode) -> TreeNode:
+        if first is None:
+            return second
+        if second is None:
+            return first
+        left, right = self._detach(first)
+        lower, _, upper = self._split_at(second, first.value)
+        lower = self._union(left, lower)
+        upper = self._union(right, upper)
+        return self._join(lower, first, upper)
+
+    def _intersection(self, first: TreeNode, second: TreeNode) -> TreeNode:
+        if first is None or second is None:
+            return None
+        left, right = self._detach(first)
+        lower, found, upper = self._split_at(second, first.value)
+        lower = self._intersection(left, lower)
+        upper = self._intersection(right, upper)
+        if found is None:
+            return self._join_pair(lower, upper)
+        return self._join(lower, first, upper)
+
+    def _difference(self, first: TreeNode, second: TreeNode) -> TreeNode:
+        if first is None or second is None:
+            return first
+        left, right = self._detach(second)
+        lower, _, upper = self._split_at(first, second.value)
+        lower = self._difference(lower, left)
+        upper = self._difference(upper, right)
+        return self._join_pair(lower, upper)
+
+    # Insert a whole batch at once. Unlike union this keeps duplicates, the same as inserting each
+    # value one at a time would. The tree's nodes and the new nodes are put in sorted order and
+    # relinked into a balanced tree in one pass, O(n + k log k) for k values, instead of paying for
+    # a rebalance on every insert. Relinking costs about as much per node as a tenth of an insert, so
+    # for a small batch going into a big tree (k log n < n) inserting one at a time is still cheaper.
+    def insert_many(self, values: List[int]) -> None:
+        if len(values) == 0:
+            return
+        size = len(self)
+        if len(values) * max(1, size.bit_length()) < size:
+            for value in sorted(values):
+                self.insert(TreeNode(value))
+            return
+        nodes = self._nodes_in_order()
+        nodes.extend(TreeNode(value) for value in values)
+        # The existing nodes are already one sorted run, so this is mostly a merge
+        nodes.sort(key=attrgetter("value"))
+        self.root = self._link_nodes(nodes, 0, len(nodes) - 1, None)
+
+    # Delete a whole batch at once, each value in the batch removes one copy if there is one, the
+    # same as deleting them one at a time. Returns how many values were removed.
+    def delete_many(self, values: List[int]) -> int:
+        if len(values) == 0:
+            return 0
+        size = len(self)
+        if len(values) * max(1, size.bit_length()) < size:
+            return sum(1 for value in values if self.delete(value))
+        to_remove = Counter(values)
+        kept = []
+        for node in self._nodes_in_order():
+            if to_remove[node.value] > 0:
+                to_remove[node.value] -= 1
+            else:
+                kept.append(node)
+        self.root = self._link_nodes(kept, 0, len(kept) - 1, None)
+        return size - len(kept)
+
+    # Like _build_tree, but reusing nodes that already exist instead of making new ones
+    def _link_nodes(
+        self, nodes: List[TreeNode], low: int, high: int, parent: TreeNode
+    ) -> TreeNode:
+        if low > high:
+            return None
+        mid = (low + high) // 2
+        node = nodes[mid]
+        node.parent = parent
+        node.left = self._link_nodes(nodes, low, mid - 1, node)
+        node.right = self._link_nodes(nodes, mid + 1, high, node)
+        self._set_built_shape(node, low, mid, high)
+        return node
+
+    # A subtree built by always splitting at the middle has a height that only depends on how many
+    # nodes it holds, the bit length of that count, so nothing needs to be looked up on the children
+    def _set_built_shape(self, node: TreeNode, low: int, mid: int, high: int) -> None:
+        node.size = high - low + 1
+        node.height = node.size.bit_length()
+        node.bf = (mid - low).bit_length() - (high - mid).bit_length()
+
+    def _nodes_in_order(self) -> List[TreeNode]:
+        nodes = []
+        stack = []
+        current = self.root
+        while stack or current is not None:
+            if current is not None:
+                stack.append(current)
+                current = current.left
+            else:
+                current = stack.pop()
+                nodes.append(current)
+                current = current.right
+        return nodes
+
+    # Walk the tree in sorted order without recursion, yielding the values one at a time
+    def in_order(self):
+        stack = []
+        current = self.root
+        while stack or current is not None:
+            if current is not None:
+                stack.append(current)
+                current = current.left
+            else:
+                current = stack.pop()
+                yield current.value
+                current = current.right
+
+    # Walk the tree root first, then the left subtree, then the right
+    def pre_order(self):
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            current = stack.pop()
+            yield current.value
+            # Right goes on the stack first so the left subtree comes out first
+            if current.right is not None:
+                stack.append(current.right)
+            if current.left is not None:
+                stack.append(current.left)
 
     def insert(self, newNode: TreeNode) -> None:
+        # Plain values get wrapped in a node, like the other search tree engines allow
+        if not isinstance(newNode, TreeNode):
+            newNode = TreeNode(newNode)
         # If the tree is empty, the new node becomes the root
         if self.root is None:
             self.root = newNode
             return
         # Otherwise, the tree is traversed to find the correct spot for the new node
         current = self.root
-        break_count = 0
+        steps = 0
         while current is not None:
-            break_count += 1
-            if break_count > 2999:
-                print(
-                    f"Infinite loop detected: avl insert | {newNode.value} | {current.value} | {current.left.value} | {current.right.value} | {current.parent.value} | {self.root.value} | {self.root.left.value} | {self.root.right.value} | {self.root.parent.value} | {self.root.bf} | {self.root.left.bf} | {self.root.right.bf} | {self.root.parent.bf}"
-                )
+            steps += 1
             if newNode.value < current.value:
                 if current.left is None:
                     current.left = newNode
@@ -83,87 +432,177 @@ class AVLTree:
                     newNode.parent = current
                     break
                 current = current.right
-        # After the new node is inserted, the balance factors need to be updated for whichever
-        # subtree it was inserted into
-        self._update_balance_factors(newNode)
-        # And the tree needs to be rebalanced
-        self._rebalance(newNode)
-
-    def _bst_delete(self, current_node: TreeNode, data: int) -> None:
-        # Standard BST delete from https://www.geeksforgeeks.org/deletion-in-binary-search-tree/?ref=lbp
-        # If the current node is None then we can't delete anything
-        if current_node is None:
-            return current_node
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        # After the new node is inserted, the heights and balance factors need to be updated for
+        # whichever subtree it was inserted into, rebalancing on the way back up to the root
+        self._rebalance(newNode.parent)
+
+    # Returns whether the data was found and removed
+    def delete(self, data: int) -> bool:
+        # Find the node to delete without recursing, the same way insert finds its spot
+        current = self.root
+        steps = 0
+        while current is not None and current.value != data:
+            steps += 1
+            if data < current.value:
+                current = current.left
+            else:
+                current = current.right
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        if current is None:
+            return False
+
+        # If the node has two children, the smallest value in its right subtree (the "successor")
+        # takes its place and the successor's node is the one that gets removed instead
+        if current.left is not None and current.right is not None:
+            successor = current.right
+            while successor.left is not None:
+                successor = successor.left
+            current.value = successor.value
+            current = successor
+
+        # Now the node has at most one child, which moves up to take the node's place
+        child = current.left if current.left is not None else current.right
+        parent = current.parent
+        if child is not None:
+            child.parent = parent
+        if parent is None:
+            self.root = child
+        elif parent.left is current:
+            parent.left = child
+        else:
+            parent.right = child
 
-        # If the data is less than the current node then we need to go left
-        if data < current_node:
-            current_node.left = self._bst_delete(current_node.left, data)
-            return current_node
-        # If the data is greater than the current node then we need to go right
-        elif data > current_node:
-            current_node.right = self._bst_delete(current_node.right, data)
-            return current_node
+        # The removed node's parent is the lowest node whose height may have changed, so the
+        # retrace and rebalance starts there
+        self._rebalance(parent)
+        return True
 
-        # If the current node is the one we want to delete
-        # If there are no children then just delete the node
-        if current_node.left is None and current_node.right is None:
-            if current_node == self.root:
-                self.root = None
-            del current_node
-            return None
-        # If it only has one child node
-        elif current_node.left is None and current_node.right is not None:
-            temp = current_node.right
-            temp.parent = current_node.parent
-            if current_node == self.root:
-                self.root = temp
-            del current_node
-            return temp
-        elif current_node.right is None and current_node.left is not None:
-            temp = current_node.left
-            temp.parent = current_node.parent
-            if current_node == self.root:
-                self.root = temp
-            del current_node
-            return temp
-        # If the current node has two children
-        else:
-            parent = current_node
-            # Find the smallest node in the right subtree
-            temp = current_node.right
-            break_count = 0
-            while temp.left is not None:
-                break_count += 1
-                if break_count > 2999:
-                    print(
-                        f"Infinite loop detected - bst_delete | {data} | {current_node.value} | {temp.value} | {temp.left.value} | {temp.right.value} | {temp.parent.value} | {parent.value} | {self.root.value} | {self.root.left.value} | {self.root.right.value} | {self.root.parent.value} | {self.root.bf} | {self.root.left.bf} | {self.root.right.bf} | {self.root.parent.bf}"
-                    )
-                parent = temp
-                temp = temp.left
-            # Delete the "successor" node (temp)
-            if parent != current_node:
-                parent.left = temp.right
+    # From the assignment, "Pred(x) returns the largest element stored in the subtree <= x"
+    # A single walk from the root is enough: every time we step right the current node is <= x and
+    # becomes the best candidate so far, every time we step left it's too big to be the answer
+    def floor(self, x: int) -> int:
+        best = None
+        current = self.root
+        steps = 0
+        while current is not None:
+            steps += 1
+            if current.value <= x:
+                best = current.value
+                current = current.right
+            else:
+                current = current.left
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return best
+
+    # The mirror image of floor, the smallest element stored that is >= x
+    def ceil(self, x: int) -> int:
+        best = None
+        current = self.root
+        steps = 0
+        while current is not None:
+            steps += 1
+            if current.value >= x:
+                best = current.value
+                current = current.left
             else:
-                parent.right = temp.right
+                current = current.right
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return best
 
-            # move the data
-            current_node.value = temp.value
+    # Pred and Succ follow the assignment's inclusive definition, so they're the same as floor / ceil
+    def pred(self, x: int) -> int:
+        return self.floor(x)
 
-            # delete the successor node
+    def succ(self, x: int) -> int:
+        return self.ceil(x)
 
-            del temp
-            return current_node
+    # All values lo <= value <= hi in sorted order, only walking the subtrees that can overlap the
+    # range so it costs O(log n + k) for k results
+    def range(self, lo: int, hi: int) -> List[int]:
+        values = []
+        stack = []
+        current = self.root
+        while stack or current is not None:
+            # Go as far left as possible, but there's no point going left of a node smaller than lo
+            if current is not None:
+                stack.append(current)
+                current = current.left if current.value >= lo else None
+                continue
+            current = stack.pop()
+            if current.value > hi:
+                break
+            if current.value >= lo:
+                values.append(current.value)
+            current = current.right
+        return values
+
+    # The subtree sizes give order statistics in a single descent, every time we go right the
+    # whole left subtree and the node itself are smaller
+    # How many values are <= x
+    def rank(self, x: int) -> int:
+        count = 0
+        current = self.root
+        steps = 0
+        while current is not None:
+            steps += 1
+            if current.value <= x:
+                count += self._size(current.left) + 1
+                current = current.right
+            else:
+                current = current.left
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return count
+
+    # How many values are < x
+    def _rank_below(self, x: int) -> int:
+        count = 0
+        current = self.root
+        steps = 0
+        while current is not None:
+            steps += 1
+            if current.value < x:
+                count += self._size(current.left) + 1
+                current = current.right
+            else:
+                current = current.left
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return count
+
+    # The k-th smallest value, counting from 0 like a sorted list index
+    def select(self, k: int) -> int:
+        if k < 0 or k >= self._size(self.root):
+            raise IndexError("select index out of range")
+        current = self.root
+        while True:
+            left_size = self._size(current.left)
+            if k < left_size:
+                current = current.left
+            elif k == left_size:
+                return current.value
+            else:
+                k -= left_size + 1
+                current = current.right
+
+    # How many values are in lo <= value <= hi
+    def count(self, lo: int, hi: int) -> int:
+        if hi < lo:
+            return 0
+        return self.rank(hi) - self._rank_below(lo)
 
-    def delete(self, data: int) -> None:
-        removed_from = self._bst_delete(self.root, data)
-        # Update the balance factors
-        self._update_balance_factors(self.root)
-        # start rebalancing the tree starting from around where the node was deleted from
-        # Make sure the parent has both children balanced, may be over the top
-        if removed_from is not None and removed_from.right is not None:
-            self._rebalance(removed_from.right)
-        if removed_from is not None and removed_from.left is not None:
-            self._rebalance(removed_from.left)
+    def __len__(self) -> int:
+        return self._size(self.root)
+
+    # A read only copy of the tree as one flat sorted array, for when the tree is done changing and
+    # only gets queried. The tree itself is left as it was.
+    def freeze(self) -> "FrozenAVLTree":
+        return FrozenAVLTree(list(self.in_order()))
 
     def print_tree(self) -> None:
         if self.root is None:
@@ -188,54 +627,63 @@ class AVLTree:
         from_right: bool,
         bf: bool = False,
     ) -> None:
-        if start is not None:
-            val_to_print = str(start.bf) if bf else str(start.value)
-            self._print_tree(
-                start.right, level + 1, from_left=False, from_right=True, bf=bf
-            )
-            if from_left:
-                print(" " * 3 * level + "\\" + val_to_print)
-            elif from_right:
-                print(" " * 3 * level + "/" + val_to_print)
-            else:
-                print(val_to_print)
-            self._print_tree(
-                start.left, level + 1, from_left=True, from_right=False, bf=bf
-            )
+        # Right subtree first so the tree reads sideways with the root on the left, the stack holds
+        # (node, level, prefix) for the nodes still waiting to be printed
+        stack = []
+        current = start
+        prefix = "\\" if from_left else "/" if from_right else ""
+        while stack or current is not None:
+            if current is not None:
+                stack.append((current, level, prefix))
+                current = current.right
+                level += 1
+                prefix = "/"
+                continue
+            current, level, prefix = stack.pop()
+            val_to_print = str(current.bf) if bf else str(current.value)
+            print(" " * 3 * level + prefix + val_to_print)
+            current = current.left
+            level += 1
+            prefix = "\\"
 
     def _rebalance(self, start: TreeNode) -> None:
         if start is None:
             return
-        # Start at the leaf and work up towards the root
+        # Start at the lowest changed node and work up towards the root
         current = start
-        break_count = 0
         while current is not None:
-            break_count += 1
-            if break_count > 2999:
-                # print(f"Infinite loop detected: avl rebalance | ")
-                return
+            # Remember the height before this node is updated, if it doesn't change then none of
+            # the nodes above it can have changed either and we can stop early
+            old_height = current.height
+            self._update_balance_factors(current)
 
             # If the balance factor is -2, the right subtree is too tall
             if current.bf <= -2:
                 # If the right subtree's balance factor is 1, a double rotation is needed
                 if current.right.bf == 1:
                     self._rotate_right(current.right)
-                    self._rotate_left(current)
-                # Otherwise, a single rotation is needed
-                else:
-                    self._rotate_left(current)
+                # The pivot moves down a level, its parent is now the root of this subtree
+                self._rotate_left(current)
+                current = current.parent
             # If the balance factor is 2, the left subtree is too tall
             elif current.bf >= 2:
                 # If the left subtree's balance factor is -1, a double rotation is needed
                 if current.left.bf == -1:
                     self._rotate_left(current.left)
-                    self._rotate_right(current)
-                # Otherwise, a single rotation is needed
-                else:
-                    self._rotate_right(current)
+                self._rotate_right(current)
+                current = current.parent
+
+            if current.height == old_height:
+                break
             # Move to the next node
             current = current.parent
 
+        # The heights above here can't have changed, but every ancestor's size still has
+        current = current.parent if current is not None else None
+        while current is not None:
+            current.size = 1 + self._size(current.left) + self._size(current.right)
+            current = current.parent
+
     def _rotate_left(self, pivot: TreeNode) -> None:
         # If the pivot's right child is None, there's nothing to rotate
         if pivot.right is None:
@@ -303,23 +751,959 @@ class AVLTree:
     def _update_balance_factors(self, start: TreeNode) -> None:
         if start is None:
             return
-        # If the node has no children, the balance factor is 0
-        if start.left is None and start.right is None:
-            start.bf = 0
-        # Otherwise the balance factor is the difference in height between the left and right children
-        else:
-            start.bf = self._height(start.left) - self._height(start.right)
-        # Update the balance factors for the nodes above
-        if start.parent is not None:
-            self._update_balance_factors(start.parent)
+        # The children already know their own heights, so this node's height and balance factor
+        # can be found without visiting anything below them
+        left_height = self._height(start.left)
+        right_height = self._height(start.right)
+        start.height = 1 + max(left_height, right_height)
+        start.bf = left_height - right_height
+        start.size = 1 + self._size(start.left) + self._size(start.right)
+
+    def _size(self, start: TreeNode) -> int:
+        return start.size if start is not None else 0
 
     def _height(self, start: TreeNode) -> int:
         # If the node is None, the height is 0
         if start is None:
             return 0
-        # Otherwise, the height is 1 plus the maximum height of the left or right children
+        # Otherwise the height is cached on the node
+        return start.height
+
+    # Work out the height by actually walking the subtree a level at a time, rather than trusting
+    # the cached heights, useful for checking them
+    def _measure_height(self, start: TreeNode) -> int:
+        height = 0
+        level = [start] if start is not None else []
+        while level:
+            height += 1
+            next_level = []
+            for node in level:
+                if node.left is not None:
+                    next_level.append(node.left)
+                if node.right is not None:
+                    next_level.append(node.right)
+            level = next_level
+        return height
+
+
+# The values of an AVLTree frozen into a single sorted array. Every query is a bisect over the
+# array instead of a walk through TreeNode objects, and 64-bit int keys are packed into an
+# array("q") at 8 bytes each. Anything else that can be sorted (or any sorted sequence handed in,
+# like a memoryview) works too, just without the packing. It can't be changed, thaw gives back a
+# normal AVLTree when updates start again.
+class FrozenAVLTree:
+    def __init__(self, sorted_data) -> None:
+        if isinstance(sorted_data, list):
+            try:
+                sorted_data = array("q", sorted_data)
+            except (TypeError, OverflowError):
+                pass
+        self._keys = sorted_data
+
+    def thaw(self) -> AVLTree:
+        return AVLTree.from_sorted(self._keys)
+
+    def floor(self, x: int) -> int:
+        i = bisect.bisect_right(self._keys, x)
+        return self._keys[i - 1] if i > 0 else None
+
+    def ceil(self, x: int) -> int:
+        i = bisect.bisect_left(self._keys, x)
+        return self._keys[i] if i < len(self._keys) else None
+
+    def pred(self, x: int) -> int:
+        return self.floor(x)
+
+    def succ(self, x: int) -> int:
+        return self.ceil(x)
+
+    # Pred for a whole batch of queries. With numpy installed the batch is done with one vectorized
+    # searchsorted over the key array (without copying it), otherwise it's a bisect per query.
+    def pred_many(self, xs: List[int]) -> List[int]:
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        if np is None or not isinstance(self._keys, (array, memoryview)):
+            return [self.floor(x) for x in xs]
+        keys = np.frombuffer(self._keys, dtype=np.int64)
+        positions = np.searchsorted(keys, np.asarray(xs, dtype=np.int64), side="right")
+        found = keys[np.maximum(positions - 1, 0)].tolist()
+        return [
+            value if position > 0 else None
+            for value, position in zip(found, positions.tolist())
+        ]
+
+    def range(self, lo: int, hi: int) -> List[int]:
+        start = bisect.bisect_left(self._keys, lo)
+        stop = bisect.bisect_right(self._keys, hi)
+        return list(self._keys[start:stop])
+
+    def rank(self, x: int) -> int:
+        return bisect.bisect_right(self._keys, x)
+
+    def select(self, k: int) -> int:
+        if k < 0 or k >= len(self._keys):
+            raise IndexError("select index out of range")
+        return self._keys[k]
+
+    def count(self, lo: int, hi: int) -> int:
+        if hi < lo:
+            return 0
+        return bisect.bisect_right(self._keys, hi) - bisect.bisect_left(self._keys, lo)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def in_order(self):
+        yield from self._keys
+
+
+# The same AVL tree, but instead of a TreeNode object per key, all the nodes live in parallel arrays
+# and a node is just an index into them (-1 standing in for None). A node costs about 21 bytes of
+# array space instead of a whole Python object and a boxed int. Deleted nodes go on a free list so
+# their slots can be reused. Keys have to fit in a signed 64-bit int. The methods match AVLTree, and
+# insert takes a TreeNode (or a plain value) the same way.
+class ArenaAVLTree:
+    # Opt in counters for instrumentation.py, None unless something is counting. Setting it on
+    # one tree (tree.stats = TreeStats()) counts the nodes only that tree's searches look at.
+    stats = None
+
+    def __init__(self, starting_data: List[Any] = None) -> None:
+        self._keys = array("q")
+        self._left = array("i")
+        self._right = array("i")
+        self._parent = array("i")
+        self._heights = array("b")
+        self._sizes = array("i")
+        self._free: List[int] = []
+        self._root = -1
+
+        if starting_data is not None and len(starting_data) > 0:
+            starting_data = sorted(list(set(starting_data)))
+            self._root = self._build_tree(starting_data, 0, len(starting_data) - 1, -1)
+
+    @classmethod
+    def from_sorted(cls, sorted_data: List[Any]) -> Self:
+        tree = cls()
+        tree._root = tree._build_tree(sorted_data, 0, len(sorted_data) - 1, -1)
+        return tree
+
+    def _build_tree(self, sorted_data: List[Any], low: int, high: int, parent: int) -> int:
+        if low > high:
+            return -1
+        mid = (low + high) // 2
+        node = self._new_node(sorted_data[mid], parent)
+        self._left[node] = self._build_tree(sorted_data, low, mid - 1, node)
+        self._right[node] = self._build_tree(sorted_data, mid + 1, high, node)
+        self._update_height(node)
+        return node
+
+    # Bytes used by the node arrays
+    def nbytes(self) -> int:
+        return sum(
+            len(buffer) * buffer.itemsize
+            for buffer in (
+                self._keys,
+                self._left,
+                self._right,
+                self._parent,
+                self._heights,
+                self._sizes,
+            )
+        )
+
+    def _new_node(self, value: int, parent: int) -> int:
+        if self._free:
+            node = self._free.pop()
+            self._keys[node] = value
+            self._left[node] = -1
+            self._right[node] = -1
+            self._parent[node] = parent
+            self._heights[node] = 1
+            self._sizes[node] = 1
+            return node
+        self._keys.append(value)
+        self._left.append(-1)
+        self._right.append(-1)
+        self._parent.append(parent)
+        self._heights.append(1)
+        self._sizes.append(1)
+        return len(self._keys) - 1
+
+    def _height(self, node: int) -> int:
+        return self._heights[node] if node >= 0 else 0
+
+    def _balance_factor(self, node: int) -> int:
+        return self._height(self._left[node]) - self._height(self._right[node])
+
+    def _size(self, node: int) -> int:
+        return self._sizes[node] if node >= 0 else 0
+
+    def _update_height(self, node: int) -> None:
+        self._heights[node] = 1 + max(
+            self._height(self._left[node]), self._height(self._right[node])
+        )
+        self._sizes[node] = 1 + self._size(self._left[node]) + self._size(self._right[node])
+
+    def insert(self, newNode: TreeNode) -> None:
+        value = newNode.value if isinstance(newNode, TreeNode) else newNode
+        if self._root < 0:
+            self._root = self._new_node(value, -1)
+            return
+        keys = self._keys
+        current = self._root
+        steps = 0
+        while True:
+            steps += 1
+            if value < keys[current]:
+                child = self._left[current]
+                if child < 0:
+                    self._left[current] = self._new_node(value, current)
+                    break
+            else:
+                child = self._right[current]
+                if child < 0:
+                    self._right[current] = self._new_node(value, current)
+                    break
+            current = child
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        self._rebalance(current)
+
+    # Returns whether the data was found and removed
+    def delete(self, data: int) -> bool:
+        keys = self._keys
+        current = self._root
+        steps = 0
+        while current >= 0 and keys[current] != data:
+            steps += 1
+            current = self._left[current] if data < keys[current] else self._right[current]
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        if current < 0:
+            return False
+        # Two children, the successor's key moves up and its node is removed instead
+        if self._left[current] >= 0 and self._right[current] >= 0:
+            successor = self._right[current]
+            while self._left[successor] >= 0:
+                successor = self._left[successor]
+            keys[current] = keys[successor]
+            current = successor
+        child = self._left[current] if self._left[current] >= 0 else self._right[current]
+        parent = self._parent[current]
+        if child >= 0:
+            self._parent[child] = parent
+        if parent < 0:
+            self._root = child
+        elif self._left[parent] == current:
+            self._left[parent] = child
+        else:
+            self._right[parent] = child
+        self._free.append(current)
+        self._rebalance(parent)
+        return True
+
+    # Same retrace as AVLTree._rebalance, stopping once a subtree's height stops changing
+    def _rebalance(self, start: int) -> None:
+        current = start
+        while current >= 0:
+            old_height = self._heights[current]
+            self._update_height(current)
+            bf = self._balance_factor(current)
+            if bf <= -2:
+                if self._balance_factor(self._right[current]) == 1:
+                    self._rotate_right(self._right[current])
+                current = self._rotate_left(current)
+            elif bf >= 2:
+                if self._balance_factor(self._left[current]) == -1:
+                    self._rotate_left(self._left[current])
+                current = self._rotate_right(current)
+            if self._heights[current] == old_height:
+                break
+            current = self._parent[current]
+        # Sizes still change all the way up
+        current = self._parent[current] if current >= 0 else -1
+        while current >= 0:
+            self._sizes[current] = (
+                1 + self._size(self._left[current]) + self._size(self._right[current])
+            )
+            current = self._parent[current]
+
+    # Rotations return the node that takes the pivot's place
+    def _rotate_left(self, pivot: int) -> int:
+        new_root = self._right[pivot]
+        self._right[pivot] = self._left[new_root]
+        if self._left[new_root] >= 0:
+            self._parent[self._left[new_root]] = pivot
+        self._replace_child(pivot, new_root)
+        self._left[new_root] = pivot
+        self._parent[pivot] = new_root
+        self._update_height(pivot)
+        self._update_height(new_root)
+        return new_root
+
+    def _rotate_right(self, pivot: int) -> int:
+        new_root = self._left[pivot]
+        self._left[pivot] = self._right[new_root]
+        if self._right[new_root] >= 0:
+            self._parent[self._right[new_root]] = pivot
+        self._replace_child(pivot, new_root)
+        self._right[new_root] = pivot
+        self._parent[pivot] = new_root
+        self._update_height(pivot)
+        self._update_height(new_root)
+        return new_root
+
+    # Point the old node's parent (or the root) at the new node instead
+    def _replace_child(self, old: int, new: int) -> None:
+        parent = self._parent[old]
+        self._parent[new] = parent
+        if parent < 0:
+            self._root = new
+        elif self._left[parent] == old:
+            self._left[parent] = new
         else:
-            return 1 + max(self._height(start.left), self._height(start.right))
+            self._right[parent] = new
+
+    def floor(self, x: int) -> int:
+        best = None
+        current = self._root
+        steps = 0
+        while current >= 0:
+            steps += 1
+            if self._keys[current] <= x:
+                best = self._keys[current]
+                current = self._right[current]
+            else:
+                current = self._left[current]
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return best
+
+    def ceil(self, x: int) -> int:
+        best = None
+        current = self._root
+        steps = 0
+        while current >= 0:
+            steps += 1
+            if self._keys[current] >= x:
+                best = self._keys[current]
+                current = self._left[current]
+            else:
+                current = self._right[current]
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return best
+
+    def pred(self, x: int) -> int:
+        return self.floor(x)
+
+    def succ(self, x: int) -> int:
+        return self.ceil(x)
+
+    def range(self, lo: int, hi: int) -> List[int]:
+        values = []
+        stack = []
+        current = self._root
+        while stack or current >= 0:
+            if current >= 0:
+                stack.append(current)
+                current = self._left[current] if self._keys[current] >= lo else -1
+                continue
+            current = stack.pop()
+            if self._keys[current] > hi:
+                break
+            if self._keys[current] >= lo:
+                values.append(self._keys[current])
+            current = self._right[current]
+        return values
+
+    def rank(self, x: int) -> int:
+        count = 0
+        current = self._root
+        steps = 0
+        while current >= 0:
+            steps += 1
+            if self._keys[current] <= x:
+                count += self._size(self._left[current]) + 1
+                current = self._right[current]
+            else:
+                current = self._left[current]
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return count
+
+    def _rank_below(self, x: int) -> int:
+        count = 0
+        current = self._root
+        steps = 0
+        while current >= 0:
+            steps += 1
+            if self._keys[current] < x:
+                count += self._size(self._left[current]) + 1
+                current = self._right[current]
+            else:
+                current = self._left[current]
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return count
+
+    def select(self, k: int) -> int:
+        if k < 0 or k >= self._size(self._root):
+            raise IndexError("select index out of range")
+        current = self._root
+        while True:
+            left_size = self._size(self._left[current])
+            if k < left_size:
+                current = self._left[current]
+            elif k == left_size:
+                return self._keys[current]
+            else:
+                k -= left_size + 1
+                current = self._right[current]
+
+    def count(self, lo: int, hi: int) -> int:
+        if hi < lo:
+            return 0
+        return self.rank(hi) - self._rank_below(lo)
+
+    def __len__(self) -> int:
+        return self._size(self._root)
+
+    def in_order(self):
+        stack = []
+        current = self._root
+        while stack or current >= 0:
+            if current >= 0:
+                stack.append(current)
+                current = self._left[current]
+            else:
+                current = stack.pop()
+                yield self._keys[current]
+                current = self._right[current]
+
+    def pre_order(self):
+        stack = [self._root] if self._root >= 0 else []
+        while stack:
+            current = stack.pop()
+            yield self._keys[current]
+            if self._right[current] >= 0:
+                stack.append(self._right[current])
+            if self._left[current] >= 0:
+                stack.append(self._left[current])
+
+    # Batches just go one value at a time, so the arena can be used as a SearchTree engine
+    def insert_many(self, values: List[int]) -> None:
+        for value in values:
+            self.insert(value)
+
+    def delete_many(self, values: List[int]) -> int:
+        return sum(1 for value in values if self.delete(value))
+
+    def union(self, other: Self) -> Self:
+        merged = []
+        for value in heapq.merge(self.in_order(), other.in_order()):
+            if len(merged) == 0 or merged[-1] != value:
+                merged.append(value)
+        return ArenaAVLTree.from_sorted(merged)
+
+    def merge(self, other: Self) -> None:
+        merged = self.union(other)
+        self._keys = merged._keys
+        self._left = merged._left
+        self._right = merged._right
+        self._parent = merged._parent
+        self._heights = merged._heights
+        self._sizes = merged._sizes
+        self._free = merged._free
+        self._root = merged._root
+
+    def print_tree(self) -> None:
+        if self._root < 0:
+            print("Tree is empty")
+            return
+        print("Current tree state: ")
+        self._print_tree(bf=False)
+        print()
+
+    def print_balances(self) -> None:
+        if self._root < 0:
+            print("Tree is empty")
+            return
+        print("Current tree balance factors: ")
+        self._print_tree(bf=True)
+
+    def _print_tree(self, bf: bool) -> None:
+        stack = []
+        current = self._root
+        level = 0
+        prefix = ""
+        while stack or current >= 0:
+            if current >= 0:
+                stack.append((current, level, prefix))
+                current = self._right[current]
+                level += 1
+                prefix = "/"
+                continue
+            current, level, prefix = stack.pop()
+            if bf:
+                val_to_print = str(self._balance_factor(current))
+            else:
+                val_to_print = str(self._keys[current])
+            print(" " * 3 * level + prefix + val_to_print)
+            current = self._left[current]
+            level += 1
+            prefix = "\\"
+
+
+# A list split into chunks, with a Fenwick tree (1 indexed) over the chunk lengths in _fenwick so
+# the chunk holding item t is found in O(log m). Subclasses keep the chunks and say how long they are.
+class _ChunkedList:
+    def _chunk_lengths(self) -> List[int]:
+        raise NotImplementedError
+
+    def _rebuild_fenwick(self) -> None:
+        lengths = self._chunk_lengths()
+        self._fenwick = [0] * (len(lengths) + 1)
+        for i, length in enumerate(lengths, start=1):
+            self._fenwick[i] += length
+            parent = i + (i & -i)
+            if parent < len(self._fenwick):
+                self._fenwick[parent] += self._fenwick[i]
+
+    # Add a new empty chunk on the end, its Fenwick entry covers the chunks before it too
+    def _fenwick_append(self) -> None:
+        i = len(self._fenwick)
+        self._fenwick.append(self._prefix(i - 1) - self._prefix(i - (i & -i)))
+
+    def _fenwick_add(self, chunk: int, amount: int) -> None:
+        i = chunk + 1
+        while i < len(self._fenwick):
+            self._fenwick[i] += amount
+            i += i & -i
+
+    # Number of items in the first `chunks` chunks
+    def _prefix(self, chunks: int) -> int:
+        total = 0
+        while chunks > 0:
+            total += self._fenwick[chunks]
+            chunks -= chunks & -chunks
+        return total
+
+    # Find the chunk holding item index, and where it is within that chunk
+    def _locate(self, index: int) -> Tuple[int, int]:
+        position = 0
+        remaining = index
+        step = 1 << (len(self._fenwick) - 1).bit_length()
+        while step > 0:
+            following = position + step
+            if following < len(self._fenwick) and self._fenwick[following] <= remaining:
+                position = following
+                remaining -= self._fenwick[following]
+            step >>= 1
+        return position, remaining
+
+
+# The retroactive trees need an operation log that can get very long and has operations added in the
+# middle of it. A Python list of ("insert", value) tuples costs around 90 bytes per operation and
+# list.insert has to shift every pointer after the insert point. This log stores the operations as
+# an opcode array('b') and a value array('q') (9 bytes per operation), split into chunks of around
+# _CHUNK_SIZE operations so an insert in the middle only shifts one chunk. A Fenwick tree over the
+# chunk lengths finds which chunk holds operation t in O(log m). It still looks like a list of
+# (operation, value) tuples to the code using it, but values have to fit in a signed 64-bit int.
+class OperationLog(_ChunkedList):
+    _CHUNK_SIZE = 1024
+    _OPCODES = {"insert": 1, "delete": 2}
+    _NAMES = {1: "insert", 2: "delete"}
+    _MIN_VALUE = -(2**63)
+    _MAX_VALUE = 2**63 - 1
+
+    # The trees call this before they change anything, so a value that can't be logged is turned
+    # away instead of ending up in the tree without a log entry
+    @classmethod
+    def check_value(cls, value: int) -> None:
+        # Anything that isn't an integer raises TypeError here, array("q") won't take it either
+        if not cls._MIN_VALUE <= index(value) <= cls._MAX_VALUE:
+            raise ValueError(f"{value} doesn't fit in the operation log, values are 64-bit ints")
+
+    def __init__(self, operations: List[Tuple[str, int]] = None) -> None:
+        self._opcodes: List[array] = []
+        self._values: List[array] = []
+        # Fenwick tree (1 indexed) over the number of operations in each chunk
+        self._fenwick: List[int] = [0]
+        self._length = 0
+        if operations is not None:
+            for operation in operations:
+                self.append(operation)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self):
+        for opcodes, values in zip(self._opcodes, self._values):
+            for opcode, value in zip(opcodes, values):
+                yield (self._NAMES[opcode], value)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return list(itertools.islice(self.iter_from(start), max(0, stop - start)))
+        if index < 0:
+            index += self._length
+        if index < 0 or index >= self._length:
+            raise IndexError("operation log index out of range")
+        chunk, offset = self._locate(index)
+        return (self._NAMES[self._opcodes[chunk][offset]], self._values[chunk][offset])
+
+    # Walk the log from the given index onward without looking each operation up separately
+    def iter_from(self, start: int):
+        if start >= self._length:
+            return
+        chunk, offset = self._locate(start)
+        while chunk < len(self._opcodes):
+            opcodes = self._opcodes[chunk]
+            values = self._values[chunk]
+            for i in range(offset, len(opcodes)):
+                yield (self._NAMES[opcodes[i]], values[i])
+            chunk += 1
+            offset = 0
+
+    def append(self, operation: Tuple[str, int]) -> None:
+        name, value = operation
+        self.check_value(value)
+        if len(self._opcodes) == 0 or len(self._opcodes[-1]) >= self._CHUNK_SIZE:
+            self._opcodes.append(array("b"))
+            self._values.append(array("q"))
+            self._fenwick_append()
+        self._opcodes[-1].append(self._OPCODES[name])
+        self._values[-1].append(value)
+        self._fenwick_add(len(self._opcodes) - 1, 1)
+        self._length += 1
+
+    # Append a batch of operations, filling whole chunks at a time
+    def extend(self, operations: List[Tuple[str, int]]) -> None:
+        for _, value in operations:
+            self.check_value(value)
+        opcodes = array("b", [self._OPCODES[name] for name, _ in operations])
+        values = array("q", [value for _, value in operations])
+        position = 0
+        while position < len(opcodes):
+            if len(self._opcodes) == 0 or len(self._opcodes[-1]) >= self._CHUNK_SIZE:
+                self._opcodes.append(array("b"))
+                self._values.append(array("q"))
+                self._fenwick_append()
+            room = self._CHUNK_SIZE - len(self._opcodes[-1])
+            self._opcodes[-1].extend(opcodes[position : position + room])
+            self._values[-1].extend(values[position : position + room])
+            added = min(room, len(opcodes) - position)
+            self._fenwick_add(len(self._opcodes) - 1, added)
+            self._length += added
+            position += added
+
+    # Same index rules as list.insert, negative indexes count from the end
+    def insert(self, index: int, operation: Tuple[str, int]) -> None:
+        if index < 0:
+            index = max(0, index + self._length)
+        if index >= self._length:
+            self.append(operation)
+            return
+        name, value = operation
+        self.check_value(value)
+        chunk, offset = self._locate(index)
+        self._opcodes[chunk].insert(offset, self._OPCODES[name])
+        self._values[chunk].insert(offset, value)
+        self._fenwick_add(chunk, 1)
+        self._length += 1
+        # Once a chunk gets twice as big as it should be, split it in half so inserts stay cheap
+        if len(self._opcodes[chunk]) >= 2 * self._CHUNK_SIZE:
+            self._split(chunk)
+
+    # Write all the opcodes (1 byte each) and then all the values (8 bytes each) to a binary file,
+    # straight from the chunk buffers
+    def write_opcodes(self, file) -> None:
+        for opcodes in self._opcodes:
+            file.write(opcodes)
+
+    def write_values(self, file) -> None:
+        for values in self._values:
+            file.write(values)
+
+    # The opposite of write_opcodes / write_values, from any buffers holding the raw bytes (like a
+    # memory mapped file). The bytes are copied into chunks without making a tuple per operation.
+    @classmethod
+    def from_buffers(cls, opcodes, values) -> Self:
+        log = cls()
+        opcodes = memoryview(opcodes).cast("B")
+        values = memoryview(values).cast("B")
+        log._length = len(opcodes)
+        if len(values) != 8 * log._length:
+            raise ValueError("The opcode and value buffers hold a different number of operations")
+        for start in range(0, log._length, cls._CHUNK_SIZE):
+            stop = min(start + cls._CHUNK_SIZE, log._length)
+            chunk_opcodes = array("b")
+            chunk_opcodes.frombytes(opcodes[start:stop])
+            chunk_values = array("q")
+            chunk_values.frombytes(values[8 * start : 8 * stop])
+            log._opcodes.append(chunk_opcodes)
+            log._values.append(chunk_values)
+        log._rebuild_fenwick()
+        return log
+
+    # Bytes used by the opcode and value buffers
+    def nbytes(self) -> int:
+        return sum(
+            len(opcodes) * opcodes.itemsize + len(values) * values.itemsize
+            for opcodes, values in zip(self._opcodes, self._values)
+        )
+
+    def _split(self, chunk: int) -> None:
+        half = len(self._opcodes[chunk]) // 2
+        self._opcodes.insert(chunk + 1, self._opcodes[chunk][half:])
+        self._values.insert(chunk + 1, self._values[chunk][half:])
+        del self._opcodes[chunk][half:]
+        del self._values[chunk][half:]
+        # Every chunk after this one moved, so the Fenwick tree is rebuilt. This only happens once
+        # every _CHUNK_SIZE inserts into a chunk
+        self._rebuild_fenwick()
+
+    def _chunk_lengths(self) -> List[int]:
+        return [len(opcodes) for opcodes in self._opcodes]
+
+# A node for the persistent tree below. Nodes are never changed once they're created, so any number
+# of versions of the tree can share them. There's no parent link since a node can have a different
+# parent in every version it's part of.
+@dataclass(slots=True)
+class PersistentNode:
+    value: int
+    left: Self = None
+    right: Self = None
+    height: int = 1
+    size: int = 1
+
+
+def _persistent_height(node: PersistentNode) -> int:
+    return node.height if node is not None else 0
+
+
+def _persistent_size(node: PersistentNode) -> int:
+    return node.size if node is not None else 0
+
+
+def _persistent_node(
+    value: int, left: PersistentNode, right: PersistentNode
+) -> PersistentNode:
+    left_height = _persistent_height(left)
+    right_height = _persistent_height(right)
+    size = 1 + _persistent_size(left) + _persistent_size(right)
+    return PersistentNode(value, left, right, 1 + max(left_height, right_height), size)
+
+
+# Make a node from a value and two subtrees that may be off balance by 2, doing the same single and
+# double rotations as the AVLTree but by creating new nodes instead of moving the old ones
+def _persistent_balance(
+    value: int, left: PersistentNode, right: PersistentNode
+) -> PersistentNode:
+    left_height = _persistent_height(left)
+    right_height = _persistent_height(right)
+    # The left subtree is too tall
+    if left_height - right_height > 1:
+        if _persistent_height(left.left) >= _persistent_height(left.right):
+            return _persistent_node(
+                left.value, left.left, _persistent_node(value, left.right, right)
+            )
+        pivot = left.right
+        return _persistent_node(
+            pivot.value,
+            _persistent_node(left.value, left.left, pivot.left),
+            _persistent_node(value, pivot.right, right),
+        )
+    # The right subtree is too tall
+    if right_height - left_height > 1:
+        if _persistent_height(right.right) >= _persistent_height(right.left):
+            return _persistent_node(
+                right.value, _persistent_node(value, left, right.left), right.right
+            )
+        pivot = right.left
+        return _persistent_node(
+            pivot.value,
+            _persistent_node(value, left, pivot.left),
+            _persistent_node(right.value, pivot.right, right.right),
+        )
+    return _persistent_node(value, left, right)
+
+
+# Persistent AVL tree using path copying: an insert or delete copies only the O(log n) nodes on the
+# path from the root to where the change happens and shares every other node with the old version.
+# Each update returns a new tree and leaves the old one exactly as it was, so old versions can be
+# kept around and queried for free. Like AVLTree, inserting a value that is already there adds
+# another copy, and deleting a value removes one copy.
+class PersistentAVLTree:
+    # Opt in counters for instrumentation.py, None unless something is counting. Setting it on
+    # one tree (tree.stats = TreeStats()) counts the nodes only that tree's searches look at.
+    stats = None
+
+    def __init__(self, root: PersistentNode = None) -> None:
+        self.root = root
+
+    # Build a balanced tree straight from sorted values (duplicates allowed), the same middle split
+    # as AVLTree._build_tree
+    @classmethod
+    def from_sorted(cls, sorted_data) -> Self:
+        return cls(cls._build_tree(sorted_data, 0, len(sorted_data) - 1))
+
+    @staticmethod
+    def _build_tree(sorted_data, low: int, high: int) -> PersistentNode:
+        if low > high:
+            return None
+        mid = (low + high) // 2
+        return PersistentNode(
+            sorted_data[mid],
+            PersistentAVLTree._build_tree(sorted_data, low, mid - 1),
+            PersistentAVLTree._build_tree(sorted_data, mid + 1, high),
+            (high - low + 1).bit_length(),
+            high - low + 1,
+        )
+
+    def insert(self, data: int) -> Self:
+        return PersistentAVLTree(self._insert(self.root, data))
+
+    def _insert(self, node: PersistentNode, data: int) -> PersistentNode:
+        if node is None:
+            return PersistentNode(data)
+        if self.stats is not None:
+            self.stats.comparisons += 1
+        if data < node.value:
+            return _persistent_balance(
+                node.value, self._insert(node.left, data), node.right
+            )
+        return _persistent_balance(node.value, node.left, self._insert(node.right, data))
+
+    # If the data isn't in the tree, the same tree is returned
+    def delete(self, data: int) -> Self:
+        new_root, removed = self._delete(self.root, data)
+        if not removed:
+            return self
+        return PersistentAVLTree(new_root)
+
+    def _delete(self, node: PersistentNode, data: int) -> Tuple[PersistentNode, bool]:
+        if node is None:
+            return None, False
+        if self.stats is not None:
+            self.stats.comparisons += 1
+        if data < node.value:
+            new_left, removed = self._delete(node.left, data)
+            if not removed:
+                return node, False
+            return _persistent_balance(node.value, new_left, node.right), True
+        if data > node.value:
+            new_right, removed = self._delete(node.right, data)
+            if not removed:
+                return node, False
+            return _persistent_balance(node.value, node.left, new_right), True
+        # Found it, with one or no children the child just takes its place
+        if node.left is None:
+            return node.right, True
+        if node.right is None:
+            return node.left, True
+        # Otherwise the smallest value on the right takes its place
+        new_right, successor = self._delete_min(node.right)
+        return _persistent_balance(successor, node.left, new_right), True
+
+    def _delete_min(self, node: PersistentNode) -> Tuple[PersistentNode, int]:
+        if node.left is None:
+            return node.right, node.value
+        new_left, smallest = self._delete_min(node.left)
+        return _persistent_balance(node.value, new_left, node.right), smallest
+
+    # Same root to leaf descent as AVLTree.floor
+    def pred(self, x: int) -> int:
+        best = None
+        current = self.root
+        steps = 0
+        while current is not None:
+            steps += 1
+            if current.value <= x:
+                best = current.value
+                current = current.right
+            else:
+                current = current.left
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return best
+
+    # Same order statistics as AVLTree
+    def rank(self, x: int) -> int:
+        count = 0
+        current = self.root
+        while current is not None:
+            if current.value <= x:
+                count += _persistent_size(current.left) + 1
+                current = current.right
+            else:
+                current = current.left
+        return count
+
+    def _rank_below(self, x: int) -> int:
+        count = 0
+        current = self.root
+        while current is not None:
+            if current.value < x:
+                count += _persistent_size(current.left) + 1
+                current = current.right
+            else:
+                current = current.left
+        return count
+
+    def select(self, k: int) -> int:
+        if k < 0 or k >= _persistent_size(self.root):
+            raise IndexError("select index out of range")
+        current = self.root
+        while True:
+            left_size = _persistent_size(current.left)
+            if k < left_size:
+                current = current.left
+            elif k == left_size:
+                return current.value
+            else:
+                k -= left_size + 1
+                current = current.right
+
+    def count(self, lo: int, hi: int) -> int:
+        if hi < lo:
+            return 0
+        return self.rank(hi) - self._rank_below(lo)
+
+    def __len__(self) -> int:
+        return _persistent_size(self.root)
+
+    def in_order(self):
+        stack = []
+        current = self.root
+        while stack or current is not None:
+            if current is not None:
+                stack.append(current)
+                current = current.left
+            else:
+                current = stack.pop()
+                yield current.value
+                current = current.right
+
+    def print_tree(self) -> None:
+        if self.root is None:
+            print("Tree is empty")
+            return
+        print("Current tree state: ")
+        self._print_tree(self.root, 0, "")
+        print()
+
+    def _print_tree(self, start: PersistentNode, level: int, prefix: str) -> None:
+        if start is not None:
+            self._print_tree(start.right, level + 1, "/")
+            print(" " * 3 * level + prefix + str(start.value))
+            self._print_tree(start.left, level + 1, "\\")
 
 
 # Partial retroactive: The data structure is partially retroactive if, in addition to supporting updates
@@ -334,30 +1718,83 @@ class AVLTree:
 # and
 # STEFAN LANGERMAN
 # Universit´e Libre de Bruxelles
-class PartialRetroactiveAVL:
-    def __init__(self) -> None:
-        self._tree = AVLTree()
+#
+# This version is the simple rollback solution, every retroactive change replays the operation log
+# (from the nearest checkpoint) to get back to the current state. It's kept around to check the
+# PartialRetroactiveAVL below against, and to compare their performance. Like the other retroactive
+# trees that keep a mutable tree, engine can be any SearchTree class.
+class ReplayPartialRetroactiveAVL:
+    def __init__(self, checkpoint_interval: int = 64, engine: type = AVLTree) -> None:
+        self._engine = engine
+        self._tree = engine()
         # I'm not sure yet, but I think a list of tuples can act as an operation log to store the action
         # and value, so a BST could essentially be rolled backward or forward to a given state
-        self._operations: List[(str, int)] = []
-
-    # Wipe out the current tree and rebuild based on the list of operations
-    def _rebuild(self) -> None:
+        self._operations = OperationLog()
+        # Every checkpoint_interval operations the sorted contents of the tree are saved, checkpoint
+        # i holds the state after operation (i + 1) * checkpoint_interval - 1 has been applied. A
+        # retroactive change only has to replay from the last checkpoint before it instead of from
+        # the very first operation. Smaller intervals replay less but keep more snapshots in memory.
+        if checkpoint_interval < 1:
+            raise ValueError("checkpoint_interval must be at least 1")
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoints: List[List[int]] = []
+        # How much replaying the retroactive updates have needed
+        self._retro_updates = 0
+        self._last_replayed = 0
+        self._total_replayed = 0
+
+    # Save the current state if the operation that was just applied lands on a checkpoint
+    def _take_checkpoint(self, op_index: int) -> None:
+        if (op_index + 1) % self._checkpoint_interval == 0:
+            self._checkpoints.append(list(self._tree.in_order()))
+
+    # Rebuild the tree based on the list of operations, start is the first operation that changed so
+    # only checkpoints from before it can still be trusted
+    def _rebuild(self, start: int = 0) -> None:
+        kept = start // self._checkpoint_interval
+        del self._checkpoints[kept:]
         del self._tree
-        self._tree = AVLTree()
-        for op in self._operations:
+        if kept > 0:
+            self._tree = self._engine.from_sorted(self._checkpoints[-1])
+        else:
+            self._tree = self._engine()
+        first_op = kept * self._checkpoint_interval
+        for i, op in enumerate(self._operations.iter_from(first_op), start=first_op):
             if op[0] == "insert":
                 self._tree.insert(TreeNode(op[1]))
             elif op[0] == "delete":
                 self._tree.delete(op[1])
+            self._take_checkpoint(i)
+        self._retro_updates += 1
+        self._last_replayed = len(self._operations) - first_op
+        self._total_replayed += self._last_replayed
+
+    # Replay counts for the retroactive updates so far
+    def stats(self) -> dict:
+        return {
+            "retro_updates": self._retro_updates,
+            "last_replayed": self._last_replayed,
+            "total_replayed": self._total_replayed,
+            "avg_replayed": (
+                self._total_replayed / self._retro_updates if self._retro_updates else 0
+            ),
+            "checkpoints": len(self._checkpoints),
+            "checkpoint_interval": self._checkpoint_interval,
+        }
+
+    # Number of operations in the log, the valid retro points are 0 to len - 1
+    def __len__(self) -> int:
+        return len(self._operations)
 
     # Partial supports insertion in the past, and the current state
     def insert(self, data: int, retro: bool = False, retro_point: int = None) -> None:
+        OperationLog.check_value(data)
         newNode = TreeNode(data)
         # If retro isn't being used then insert to the current state as normal
         if not retro:
             self._tree.insert(newNode)
             self._operations.append(("insert", newNode.value))
+            self._take_checkpoint(len(self._operations) - 1)
         else:
             # If retro is being used, make sure a point in time is set, and that it doesn't go out
             # of bounds for the operation list
@@ -373,13 +1810,15 @@ class PartialRetroactiveAVL:
             # Insert the operation into the list at the given point, then rebuild the tree
             # to achieve making the modification in the past, but still being at the current state
             self._operations.insert(retro_point, ("insert", newNode.value))
-            self._rebuild()
+            self._rebuild(retro_point)
 
     # Partial supports deletion in the past, and the current state
     def delete(self, data: int, retro: bool = False, retro_point: int = None) -> None:
+        OperationLog.check_value(data)
         if not retro:
             self._tree.delete(data)
             self._operations.append(("delete", data))
+            self._take_checkpoint(len(self._operations) - 1)
         else:
             if (
                 retro_point is None
@@ -391,29 +1830,328 @@ class PartialRetroactiveAVL:
                 )
                 return
             self._operations.insert(retro_point, ("delete", data))
-            self._rebuild()
+            self._rebuild(retro_point)
 
     # Partial only queries the current state
     # From the assignment, "Pred(x) returns the largest element stored in the subtree <= x"
     def pred(self, x: int) -> int:
-        # Get a list of nodes that are less than or equal to x
-        node_list = []
-        self._get_nodes_less_than_or_equal_to_x(self._tree.root, x, node_list)
-        # If the list is empty, there are no nodes less than or equal to x
-        if len(node_list) == 0:
+        result = self._pred(x)
+        # If nothing was found, there are no nodes less than or equal to x
+        if result is None:
             return -1
-        print([node.value for node in node_list])
-        # Otherwise, return the largest value in the list
-        return max([node.value for node in node_list])
+        return result
+
+    # Pred that gives None when nothing is <= x, since -1 could also be a stored value
+    def _pred(self, x: int) -> int:
+        return self._tree.pred(x)
+
+    def print_tree(self) -> None:
+        self._tree.print_tree()
+
+    def print_log(self) -> None:
+        if len(self._operations) == 0:
+            print("Operation log is empty")
+            return
+        print("Operation log: ")
+        for op in self._operations:
+            print(op)
+
+
+# Where one operation sits in time for PartialRetroactiveAVL, see Timeline below. Timestamps are
+# compared with before(), the order stays right when labels are changed or chunks are split.
+@dataclass(slots=True, eq=False)
+class Timestamp:
+    chunk: "TimelineChunk"
+    label: int
+
+    def before(self, other: Self) -> bool:
+        if self.chunk is other.chunk:
+            return self.label < other.label
+        return self.chunk.index < other.chunk.index
 
-    def _get_nodes_less_than_or_equal_to_x(
-        self, start: TreeNode, x: int, node_list: List[TreeNode]
+
+@dataclass(slots=True, eq=False)
+class TimelineChunk:
+    # Where this chunk is in the timeline's list of chunks
+    index: int
+    stamps: List[Timestamp]
+
+
+# A Timestamp for every operation in the log, in log order, so two operations can be put in time
+# order without knowing where they are in the log. It's laid out like the OperationLog, in chunks of
+# around _CHUNK_SIZE timestamps with a Fenwick tree over the chunk lengths to find the timestamp at
+# an index in O(log m). A timestamp is the index of its chunk plus a label that orders it within the
+# chunk. A new timestamp takes the midpoint of its neighbours' labels, and when two neighbours have
+# no room left between them only the labels in that one chunk are spread out again. Splitting a
+# chunk renumbers the chunk indexes after it, at the same time (and the same cost) as the Fenwick
+# tree is rebuilt.
+class Timeline(_ChunkedList):
+    _CHUNK_SIZE = 1024
+    _LABEL_GAP = 2**32
+
+    def __init__(self) -> None:
+        self._chunks: List[TimelineChunk] = []
+        self._fenwick: List[int] = [0]
+        self._length = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: int) -> Timestamp:
+        chunk, offset = self._locate(index)
+        return self._chunks[chunk].stamps[offset]
+
+    # A new timestamp after all the others
+    def append(self) -> Timestamp:
+        if len(self._chunks) == 0 or len(self._chunks[-1].stamps) >= self._CHUNK_SIZE:
+            self._chunks.append(TimelineChunk(len(self._chunks), []))
+            self._fenwick_append()
+        chunk = self._chunks[-1]
+        label = chunk.stamps[-1].label + self._LABEL_GAP if chunk.stamps else 0
+        stamp = Timestamp(chunk, label)
+        chunk.stamps.append(stamp)
+        self._fenwick_add(len(self._chunks) - 1, 1)
+        self._length += 1
+        return stamp
+
+    # count new timestamps after all the others, filling whole chunks at a time
+    def extend(self, count: int) -> List[Timestamp]:
+        added = []
+        while len(added) < count:
+            if len(self._chunks) == 0 or len(self._chunks[-1].stamps) >= self._CHUNK_SIZE:
+                self._chunks.append(TimelineChunk(len(self._chunks), []))
+                self._fenwick_append()
+            chunk = self._chunks[-1]
+            room = min(self._CHUNK_SIZE - len(chunk.stamps), count - len(added))
+            first = chunk.stamps[-1].label + self._LABEL_GAP if chunk.stamps else 0
+            stamps = [Timestamp(chunk, first + i * self._LABEL_GAP) for i in range(room)]
+            chunk.stamps.extend(stamps)
+            added.extend(stamps)
+            self._fenwick_add(len(self._chunks) - 1, room)
+            self._length += room
+        return added
+
+    # A new timestamp just before the one at index, which makes it index
+    def insert(self, index: int) -> Timestamp:
+        if index >= self._length:
+            return self.append()
+        position, offset = self._locate(index)
+        chunk = self._chunks[position]
+        if offset > 0 and chunk.stamps[offset].label - chunk.stamps[offset - 1].label < 2:
+            self._relabel(chunk)
+        high = chunk.stamps[offset].label
+        low = chunk.stamps[offset - 1].label if offset > 0 else high - 2 * self._LABEL_GAP
+        stamp = Timestamp(chunk, (low + high) // 2)
+        chunk.stamps.insert(offset, stamp)
+        self._fenwick_add(position, 1)
+        self._length += 1
+        if len(chunk.stamps) >= 2 * self._CHUNK_SIZE:
+            self._split(position)
+        return stamp
+
+    # Space the labels in one chunk out evenly again
+    def _relabel(self, chunk: TimelineChunk) -> None:
+        for i, stamp in enumerate(chunk.stamps):
+            stamp.label = i * self._LABEL_GAP
+
+    def _split(self, position: int) -> None:
+        chunk = self._chunks[position]
+        half = len(chunk.stamps) // 2
+        moved = TimelineChunk(position + 1, chunk.stamps[half:])
+        del chunk.stamps[half:]
+        for stamp in moved.stamps:
+            stamp.chunk = moved
+        self._chunks.insert(position + 1, moved)
+        for i in range(position + 2, len(self._chunks)):
+            self._chunks[i].index = i
+        self._rebuild_fenwick()
+
+    def _chunk_lengths(self) -> List[int]:
+        return [len(chunk.stamps) for chunk in self._chunks]
+
+
+# One update in a key's history for PartialRetroactiveAVL. Each key's history is a treap ordered by
+# timestamp (a BST on the timestamps that's also a max heap on a random priority). An update changes
+# the number of copies of the key, c, to max(c + shift, floor). Inserting is shift 1 and deleting is
+# shift -1, both with floor 0 since deleting a key that isn't there does nothing. Two of those in a
+# row are another one of the same form, so every node also keeps shift and floor for its whole
+# subtree in time order, and the root's give the number of copies now without replaying anything.
+@dataclass(slots=True, eq=False)
+class HistoryNode:
+    stamp: Timestamp
+    change: int
+    priority: float
+    left: Self = None
+    right: Self = None
+    shift: int = 0
+    floor: int = 0
+
+
+def _history_update(node: HistoryNode) -> None:
+    shift, floor = 0, 0
+    if node.left is not None:
+        shift, floor = node.left.shift, node.left.floor
+    shift += node.change
+    floor = max(floor + node.change, 0)
+    if node.right is not None:
+        floor = max(floor + node.right.shift, node.right.floor)
+        shift += node.right.shift
+    node.shift, node.floor = shift, floor
+
+
+# Copies of the key after every update in the history, starting from none
+def _history_count(node: HistoryNode) -> int:
+    if node is None:
+        return 0
+    return max(node.shift, node.floor)
+
+
+# Add new_node to the history under node in time order, rotating it up while its priority is higher
+def _history_insert(node: HistoryNode, new_node: HistoryNode) -> HistoryNode:
+    if node is None:
+        _history_update(new_node)
+        return new_node
+    if new_node.stamp.before(node.stamp):
+        node.left = _history_insert(node.left, new_node)
+        if node.left.priority > node.priority:
+            child = node.left
+            node.left, child.right = child.right, node
+            _history_update(node)
+            node = child
+    else:
+        node.right = _history_insert(node.right, new_node)
+        if node.right.priority > node.priority:
+            child = node.right
+            node.right, child.left = child.left, node
+            _history_update(node)
+            node = child
+    _history_update(node)
+    return node
+
+
+# The paper points out that for a search tree, updates to different keys never affect each other.
+# Whether x is in the tree right now only depends on the updates made to x, in the order they
+# happened. So instead of replaying the whole log, each key keeps its own time ordered history of
+# updates, and a retroactive insert / delete only adds to the history of the key it touches, then
+# fixes up the present time tree with at most one insert or delete.
+#
+# The Timeline gives each operation a Timestamp so the histories stay in time order when updates are
+# added in the middle of the log, and each history is a HistoryNode treap that keeps the key's count
+# up to date as it goes. A retroactive update costs O(log m) to find its place in time plus
+# O(log h) for the h updates to its key, with the relabelling of one chunk when a spot in the
+# timeline gets crowded.
+class PartialRetroactiveAVL:
+    # engine is the SearchTree class that holds the present
+    def __init__(self, engine: type = AVLTree) -> None:
+        self._tree = engine()
+        # Still keep the operation log so the full history can be printed
+        self._operations = OperationLog()
+        self._timeline = Timeline()
+        # Key -> root of the key's HistoryNode treap
+        self._histories: dict = {}
+
+    # Add an update to a key's history, returning how many copies of the key there are now, before
+    # and after the update
+    def _add_history(self, operation: str, data: int, stamp: Timestamp) -> Tuple[int, int]:
+        root = self._histories.get(data)
+        change = 1 if operation == "insert" else -1
+        if root is None:
+            # Most keys only have the one update, which is its own subtree
+            node = HistoryNode(stamp, change, random.random(), shift=change, floor=0)
+            self._histories[data] = node
+            return 0, max(change, 0)
+        before = _history_count(root)
+        root = _history_insert(root, HistoryNode(stamp, change, random.random()))
+        self._histories[data] = root
+        return before, _history_count(root)
+
+    def _add_operation(
+        self, operation: str, data: int, retro: bool, retro_point: int
     ) -> None:
-        if start is not None:
-            if start.value <= x:
-                node_list.append(start)
-            self._get_nodes_less_than_or_equal_to_x(start.left, x, node_list)
-            self._get_nodes_less_than_or_equal_to_x(start.right, x, node_list)
+        OperationLog.check_value(data)
+        if not retro:
+            stamp = self._timeline.append()
+            self._operations.append((operation, data))
+        else:
+            stamp = self._timeline.insert(retro_point)
+            self._operations.insert(retro_point, (operation, data))
+        # Bring the present tree in line with the new count for the key. For an update at the
+        # present this is just the update itself.
+        before, after = self._add_history(operation, data, stamp)
+        for _ in range(after - before):
+            self._tree.insert(TreeNode(data))
+        for _ in range(before - after):
+            self._tree.delete(data)
+
+    # Add a batch of present time updates, the log and histories are extended in one go and the
+    # tree does a single bulk update
+    def _add_operations(self, operation: str, values: List[int]) -> None:
+        for value in values:
+            OperationLog.check_value(value)
+        for value, stamp in zip(values, self._timeline.extend(len(values))):
+            self._add_history(operation, value, stamp)
+        self._operations.extend([(operation, value) for value in values])
+
+    def insert_many(self, values: List[int]) -> None:
+        self._add_operations("insert", values)
+        self._tree.insert_many(values)
+
+    def delete_many(self, values: List[int]) -> None:
+        self._add_operations("delete", values)
+        self._tree.delete_many(values)
+
+    # Number of operations in the log, the valid retro points are 0 to len - 1
+    def __len__(self) -> int:
+        return len(self._operations)
+
+    # Partial supports insertion in the past, and the current state
+    def insert(self, data: int, retro: bool = False, retro_point: int = None) -> None:
+        if retro and (
+            retro_point is None
+            or retro_point < 0
+            or retro_point > len(self._operations) - 1
+        ):
+            print(
+                f"PartRAIns: Invalid retro point {retro_point} for {len(self._operations)} ops"
+            )
+            return
+        self._add_operation("insert", data, retro, retro_point)
+
+    # Partial supports deletion in the past, and the current state
+    def delete(self, data: int, retro: bool = False, retro_point: int = None) -> None:
+        if retro and (
+            retro_point is None
+            or retro_point < 0
+            or retro_point > len(self._operations) - 1
+        ):
+            print(
+                f"PartRADel: Invalid retro point {retro_point} for {len(self._operations)} ops"
+            )
+            return
+        self._add_operation("delete", data, retro, retro_point)
+
+    # Partial only queries the current state
+    # From the assignment, "Pred(x) returns the largest element stored in the subtree <= x"
+    def pred(self, x: int) -> int:
+        result = self._pred(x)
+        # If nothing was found, there are no nodes less than or equal to x
+        if result is None:
+            return -1
+        return result
+
+    # Pred that gives None when nothing is <= x, since -1 could also be a stored value
+    def _pred(self, x: int) -> int:
+        return self._tree.pred(x)
+
+    # Order statistics on the current state
+    def rank(self, x: int) -> int:
+        return self._tree.rank(x)
+
+    def select(self, k: int) -> int:
+        return self._tree.select(k)
+
+    def count(self, lo: int, hi: int) -> int:
+        return self._tree.count(lo, hi)
 
     def print_tree(self) -> None:
         self._tree.print_tree()
@@ -439,79 +2177,136 @@ class PartialRetroactiveAVL:
 # and
 # STEFAN LANGERMAN
 # Universit´e Libre de Bruxelles
-class FullyRetroactiveAVL:
-    def __init__(self) -> None:
-        self._tree = AVLTree()
-        self._operations: List[(str, int)] = []
+#
+# This version is the simple rollback solution, a single tree is rolled backward and forward through
+# the operation log to reach any point in time. FullyRetroactiveAVL below is checked against it.
+class RollbackFullyRetroactiveAVL:
+    # Rolling back one operation at a time makes going far into the past linear in the length of the
+    # history. With use_snapshots turned on, a frozen copy of the tree (its sorted values) is kept
+    # every snapshot_interval operations, and a trip further back than one interval starts from a
+    # copy of the nearest snapshot instead, so it never replays more than an interval's worth of
+    # operations. Leaving snapshot_interval as None uses sqrt(m) for m operations, which keeps about
+    # sqrt(m) snapshots. A smaller interval means faster time travel but more snapshots in memory.
+    # engine is the SearchTree class used for the tree and for trees rebuilt from snapshots.
+    def __init__(
+        self, use_snapshots: bool = False, snapshot_interval: int = None, engine: type = AVLTree
+    ) -> None:
+        self._engine = engine
+        self._tree = engine()
+        self._operations = OperationLog()
+        # Whether each operation actually changed the tree, a delete of a value that wasn't there
+        # does nothing so it mustn't be undone as an insert when rolling back
+        self._applied: List[bool] = []
         # Store where the retro tree currently is to roll forward or backward depending on function
         # calls coming in
         self._current_retro: int = -1
+        if snapshot_interval is not None and snapshot_interval < 1:
+            raise ValueError("snapshot_interval must be at least 1")
+        self._use_snapshots = use_snapshots
+        self._snapshot_interval = snapshot_interval
+        # The operation index each snapshot was taken after, in increasing order, and the sorted
+        # values in the tree at that point
+        self._snapshot_points: List[int] = []
+        self._snapshots: List[List[int]] = []
+
+    def _interval(self) -> int:
+        if self._snapshot_interval is not None:
+            return self._snapshot_interval
+        return max(1, math.isqrt(len(self._operations)))
+
+    # Freeze the current tree if it's been at least an interval since the last snapshot
+    def _take_snapshot(self) -> None:
+        if not self._use_snapshots:
+            return
+        last_point = self._snapshot_points[-1] if self._snapshot_points else -1
+        if self._current_retro - last_point >= self._interval():
+            self._snapshot_points.append(self._current_retro)
+            self._snapshots.append(list(self._tree.in_order()))
+
+    # Snapshots taken at or after a retroactive change no longer match the history
+    def _drop_snapshots_from(self, point: int) -> None:
+        keep = bisect.bisect_left(self._snapshot_points, point)
+        del self._snapshot_points[keep:]
+        del self._snapshots[keep:]
+
+    # A separate tree in the state right after the given operation, copied from the nearest
+    # snapshot at or before it and then rolled forward. The main tree isn't touched.
+    def _tree_at(self, point: int) -> SearchTree:
+        index = bisect.bisect_right(self._snapshot_points, point) - 1
+        if index < 0:
+            tree = self._engine()
+            start = 0
+        else:
+            tree = self._engine.from_sorted(self._snapshots[index])
+            start = self._snapshot_points[index] + 1
+        for operation, value in itertools.islice(
+            self._operations.iter_from(start), point + 1 - start
+        ):
+            if operation == "insert":
+                tree.insert(TreeNode(value))
+            elif operation == "delete":
+                tree.delete(value)
+        return tree
+
+    # Whether going back to the point would be cheaper from a snapshot than by rolling back
+    def _use_snapshot_for(self, point: int) -> bool:
+        return self._use_snapshots and self._current_retro - point > self._interval()
+
+    # Move the main tree back to the given point, from a snapshot if that's closer
+    def _travel_back(self, point: int) -> None:
+        if self._use_snapshot_for(point):
+            self._tree = self._tree_at(point)
+            self._current_retro = point
+        else:
+            self.rollback(point)
 
     # This function will undo any changes to go from the current point in time to the desired one
     def rollback(self, point: int) -> None:
-        break_count = 0
         while self._current_retro > point:
-            break_count += 1
-            if break_count > 2999:
-                print(
-                    f"Infinite loop detected: full_ret_avl rollback | {self._current_retro} | {point}"
-                )
             operation, value = self._operations[self._current_retro]
             if operation == "insert":
-                # print("Rollback Delete: ", self._operations[self._current_retro][1])
                 self._tree.delete(value)
-            elif operation == "delete":
-                # print("Rollback Insert: ", self._operations[self._current_retro][1])
+            elif operation == "delete" and self._applied[self._current_retro]:
                 self._tree.insert(TreeNode(value))
             self._current_retro -= 1
 
     # This function will apply any changes to go from the current point in time to the desired one
     def rollforward(self, point: int) -> None:
         # Current retro points to the last *applied* operation, so we need to start at the next one
-        self._current_retro += 1
-        break_count = 0
-        while self._current_retro <= point:
-            break_count += 1
-            if break_count > 2999:
-                print(
-                    "Infinite loop detected: full_ret_avl rollforward | ",
-                    self._current_retro,
-                    point,
-                )
+        while self._current_retro < point:
+            self._current_retro += 1
             operation, value = self._operations[self._current_retro]
             if operation == "insert":
-                # print("Rollforward Insert: ", self._operations[self._current_retro][1])
                 self._tree.insert(TreeNode(value))
+                self._applied[self._current_retro] = True
             elif operation == "delete":
-                # print("Rollforward Delete: ", self._operations[self._current_retro][1])
-                self._tree.delete(value)
-            self._current_retro += 1
-            if self._current_retro >= len(self._operations):
-                self._current_retro = len(self._operations) - 1
-                break
+                self._applied[self._current_retro] = self._tree.delete(value)
+            self._take_snapshot()
 
     # Wipe out the current tree and rebuild based on the list of operations
     def _rebuild(self, stop: int = None) -> None:
         del self._tree
-        self._tree = AVLTree()
+        self._tree = self._engine()
         self._current_retro = -1
-        for op, val in self._operations:
-            if op == "insert":
-                self._tree.insert(TreeNode(val))
-            elif op == "delete":
-                self._tree.delete(val)
-            self._current_retro += 1
-            if stop is not None and self._current_retro == stop:
-                break
+        if stop is None:
+            stop = len(self._operations) - 1
+        self.rollforward(stop)
+
+    # Number of operations in the log, the valid retro points are 0 to len - 1
+    def __len__(self) -> int:
+        return len(self._operations)
 
     # Partial supports insertion in the past, and the current state
     def insert(self, data: int, retro: bool = False, retro_point: int = None) -> None:
+        OperationLog.check_value(data)
         newNode = TreeNode(data)
         # If retro isn't being used then insert to the current state as normal
         if not retro:
             self._tree.insert(newNode)
             self._operations.append(("insert", newNode.value))
+            self._applied.append(True)
             self._current_retro += 1
+            self._take_snapshot()
         else:
             # If retro is being used, make sure a point in time is set, and that it doesn't go out
             # of bounds for the operation list
@@ -527,19 +2322,23 @@ class FullyRetroactiveAVL:
             # Insert the operation into the list at the given point, then rebuild the tree
             # to achieve making the modification in the past, but still being at the current state
             # Roll back to the point before the specified insertion point for the retroactive op
-            self.rollback(retro_point - 1)
+            self._travel_back(retro_point - 1)
             # Then the new op goes in at the specified point
+            self._drop_snapshots_from(retro_point)
             self._operations.insert(retro_point, ("insert", newNode.value))
+            self._applied.insert(retro_point, False)
             self.rollforward(len(self._operations) - 1)
             # self._current_retro += 1
             # self._rebuild()
 
     # Partial supports deletion in the past, and the current state
     def delete(self, data: int, retro: bool = False, retro_point: int = None) -> None:
+        OperationLog.check_value(data)
         if not retro:
-            self._tree.delete(data)
+            self._applied.append(self._tree.delete(data))
             self._operations.append(("delete", data))
             self._current_retro += 1
+            self._take_snapshot()
         else:
             if (
                 retro_point is None
@@ -551,8 +2350,10 @@ class FullyRetroactiveAVL:
                 )
                 return
 
-            self.rollback(retro_point - 1)
+            self._travel_back(retro_point - 1)
+            self._drop_snapshots_from(retro_point)
             self._operations.insert(retro_point, ("delete", data))
+            self._applied.insert(retro_point, False)
             self.rollforward(len(self._operations) - 1)
             # self._rebuild()
             # self._current_retro += 1
@@ -560,13 +2361,7 @@ class FullyRetroactiveAVL:
     # Partial only queries the current state
     # From the assignment, "Pred(x) returns the largest element stored in the subtree <= x"
     def pred(self, x: int, retro: bool = False, retro_point: int = None) -> int:
-        # If it's a retro pred, set the state to that point in time, saving the current location
-        # before hand
         if retro:
-            print("Pre Retro Tree Log: ")
-            self.print_log()
-            print("Pre Retro Tree State: ")
-            self._tree.print_tree()
             if (
                 retro_point is None
                 or retro_point < 0
@@ -576,41 +2371,320 @@ class FullyRetroactiveAVL:
                     f"FullRAPred: Invalid retro point {retro_point} for {len(self._operations)} ops"
                 )
                 return
-            self.rollback(retro_point)
-            print("Retro Pred Tree State: ")
-            self._tree.print_tree()
+        result = self._pred(x, retro_point if retro else None)
+        # If nothing was found, there are no nodes less than or equal to x
+        if result is None:
+            return -1
+        return result
+
+    # Pred now, or right after a valid retro point, that gives None when nothing is <= x since -1
+    # could also be a stored value
+    def _pred(self, x: int, retro_point: int = None) -> int:
+        if retro_point is None:
+            return self._tree.pred(x)
+        # Far enough back, a copy of the nearest snapshot answers the query and the main tree can
+        # stay where it is
+        if self._use_snapshot_for(retro_point):
+            return self._tree_at(retro_point).pred(x)
+        # Set the state to that point in time, then restore the current state
+        self.rollback(retro_point)
+        result = self._tree.pred(x)
+        self.rollforward(len(self._operations) - 1)
+        return result
 
-        # Get a list of nodes that are less than or equal to x
-        node_list = []
-        self._get_nodes_less_than_or_equal_to_x(self._tree.root, x, node_list)
+    def print_tree(self) -> None:
+        self._tree.print_tree()
+
+    def print_log(self) -> None:
+        if len(self._operations) == 0:
+            print("Operation log is empty")
+            return
+        print("Operation log: ")
+        for i, op in enumerate(self._operations):
+            print(f"  - {i}: {op}")
 
-        if retro:
-            # Restore the current state
-            self.rollforward(len(self._operations) - 1)
-            print("Post Retro Tree State: ")
-            self._tree.print_tree()
-            # self._rebuild()
-            # self._tree.print_tree()
-        print("Candidate nodes were: ", [node for node in node_list])
 
-        # If the list is empty, there are no nodes less than or equal to x
-        if len(node_list) == 0:
+# The fully retroactive tree keeps one persistent version of the tree for every point in the
+# operation log, version i being the tree after operation i. Because the versions share all of the
+# nodes that didn't change, each one only costs O(log n) extra nodes. A query in the past is just a
+# Pred on the right version with nothing to roll back or forward, so old versions are never changed
+# by a read. A retroactive update at point t only has to redo the versions from t onward.
+#
+# With copy_on_write turned on, queries can run from any number of threads while updates come in
+# from others. Queries only ever look at _published, the versions list, the present and the number
+# of operations swapped in as one tuple, so a query never sees half of an update. A retroactive
+# update builds a new versions list (sharing the versions before t) instead of cutting the old one
+# short, so a query that's part way through still has every old version it could ask for. Present
+# time updates just append to the list, which queries never read past their operation count.
+# Updates (and building versions a snapshot skipped) take a lock, queries don't.
+class FullyRetroactiveAVL:
+    def __init__(self, copy_on_write: bool = False) -> None:
+        self._operations = OperationLog()
+        # Versions are only built as far as they've been needed, _versions[i] is the version right
+        # after operation i for every i < len(_versions). Normally that is every operation, but a
+        # tree loaded from a snapshot starts with none of them and builds them the first time the
+        # past is used. _present is always the latest version.
+        self._versions: List[PersistentAVLTree] = []
+        self._present = PersistentAVLTree()
+        self._copy_on_write = copy_on_write
+        self._lock = threading.Lock() if copy_on_write else nullcontext()
+        self._publish()
+
+    # Make the latest update visible to queries
+    def _publish(self) -> None:
+        self._published = (self._versions, self._present, len(self._operations))
+
+    # Build the versions for the first count operations if they aren't built yet
+    def _materialize(self, count: int) -> None:
+        start = len(self._versions)
+        if start >= count:
+            return
+        version = self._versions[-1] if start > 0 else PersistentAVLTree()
+        for operation, value in itertools.islice(self._operations.iter_from(start), count - start):
+            version = self._apply(version, operation, value)
+            self._versions.append(version)
+
+    # The version from just before the given point in the log
+    def _version_before(self, point: int) -> PersistentAVLTree:
+        if point <= 0:
+            return PersistentAVLTree()
+        self._materialize(point)
+        return self._versions[point - 1]
+
+    def _apply(self, version: PersistentAVLTree, operation: str, value: int):
+        if operation == "insert":
+            return version.insert(value)
+        return version.delete(value)
+
+    # Throw away the versions from start onward and redo them from the operation log
+    def _rebuild(self, start: int = 0) -> None:
+        version = self._version_before(start)
+        if self._copy_on_write:
+            versions = self._versions[:start]
+        else:
+            versions = self._versions
+            del versions[start:]
+        for operation, value in self._operations.iter_from(start):
+            version = self._apply(version, operation, value)
+            versions.append(version)
+        self._versions = versions
+        self._present = version
+
+    def _add_operation(
+        self, operation: str, data: int, retro: bool, retro_point: int
+    ) -> None:
+        OperationLog.check_value(data)
+        with self._lock:
+            if not retro:
+                self._present = self._apply(self._present, operation, data)
+                if len(self._versions) == len(self._operations):
+                    self._versions.append(self._present)
+                self._operations.append((operation, data))
+            else:
+                self._operations.insert(retro_point, (operation, data))
+                self._rebuild(retro_point)
+            self._publish()
+
+    # Add a batch of present time updates. Every update still needs its own version so the points
+    # in between can be queried, but the log is extended in one go
+    def _add_operations(self, operation: str, values: List[int]) -> None:
+        for value in values:
+            OperationLog.check_value(value)
+        with self._lock:
+            complete = len(self._versions) == len(self._operations)
+            version = self._present
+            for value in values:
+                version = self._apply(version, operation, value)
+                if complete:
+                    self._versions.append(version)
+            self._present = version
+            self._operations.extend([(operation, value) for value in values])
+            self._publish()
+
+    def insert_many(self, values: List[int]) -> None:
+        self._add_operations("insert", values)
+
+    def delete_many(self, values: List[int]) -> None:
+        self._add_operations("delete", values)
+
+    # Number of operations in the log, the valid retro points are 0 to len - 1
+    def __len__(self) -> int:
+        return self._published[2]
+
+    def _valid_retro_point(self, retro_point: int) -> bool:
+        return retro_point is not None and 0 <= retro_point <= len(self._operations) - 1
+
+    def insert(self, data: int, retro: bool = False, retro_point: int = None) -> None:
+        if retro and not self._valid_retro_point(retro_point):
+            print(
+                f"FullRAIns: Invalid retro point {retro_point} for {len(self._operations)} ops"
+            )
+            return
+        self._add_operation("insert", data, retro, retro_point)
+
+    def delete(self, data: int, retro: bool = False, retro_point: int = None) -> None:
+        if retro and not self._valid_retro_point(retro_point):
+            print(
+                f"FullRADel: Invalid retro point {retro_point} for {len(self._operations)} ops"
+            )
+            return
+        self._add_operation("delete", data, retro, retro_point)
+
+    # From the assignment, "Pred(x) returns the largest element stored in the subtree <= x"
+    def pred(self, x: int, retro: bool = False, retro_point: int = None) -> int:
+        version = self._version_for("FullRAPred", retro, retro_point)
+        if version is None:
+            return
+        result = version.pred(x)
+        # If nothing was found, there are no nodes less than or equal to x
+        if result is None:
             return -1
+        return result
 
-        #  Otherwise, return the largest value in the list
-        return max(node_list)
+    # Pred now, or right after a valid retro point, that gives None when nothing is <= x since -1
+    # could also be a stored value
+    def _pred(self, x: int, retro_point: int = None) -> int:
+        return self._version_for("FullRAPred", retro_point is not None, retro_point).pred(x)
 
-    def _get_nodes_less_than_or_equal_to_x(
-        self, start: TreeNode, x: int, node_list: List[TreeNode]
-    ) -> None:
-        if start is not None:
-            if start.value <= x:
-                node_list.append(start.value)
-            self._get_nodes_less_than_or_equal_to_x(start.left, x, node_list)
-            self._get_nodes_less_than_or_equal_to_x(start.right, x, node_list)
+    # The version to query, either the present or the one at retro_point. Returns None (after
+    # printing why) if the retro point is invalid
+    def _version_for(self, name: str, retro: bool, retro_point: int):
+        versions, present, count = self._published
+        if not retro:
+            return present
+        if retro_point is None or not 0 <= retro_point < count:
+            print(f"{name}: Invalid retro point {retro_point} for {count} ops")
+            return None
+        if retro_point < len(versions):
+            return versions[retro_point]
+        # The past hasn't been built this far yet. If a retroactive update has replaced the
+        # versions since this query started, the query just moves on to the newer ones.
+        with self._lock:
+            if versions is self._versions:
+                self._materialize(retro_point + 1)
+                return versions[retro_point]
+        return self._version_for(name, retro, retro_point)
+
+    # Order statistics on the present or on any point in the past
+    def rank(self, x: int, retro: bool = False, retro_point: int = None) -> int:
+        version = self._version_for("FullRARank", retro, retro_point)
+        return None if version is None else version.rank(x)
+
+    def select(self, k: int, retro: bool = False, retro_point: int = None) -> int:
+        version = self._version_for("FullRASelect", retro, retro_point)
+        return None if version is None else version.select(k)
+
+    def count(
+        self, lo: int, hi: int, retro: bool = False, retro_point: int = None
+    ) -> int:
+        version = self._version_for("FullRACount", retro, retro_point)
+        return None if version is None else version.count(lo, hi)
+
+    # Answer a batch of (x, retro_point) Pred queries offline, giving the same answers as calling
+    # pred(x, retro=True, retro_point=t) for each one.
+    # Replaying the log once gives the stretches of time [start, end) that each key is in the tree.
+    # Each stretch is stored on the O(log m) nodes of a segment tree over time that cover it, so
+    # the keys alive at time t are exactly the keys on the path from leaf t up to the root, and a
+    # query is a bisect in each of those nodes' sorted key lists.
+    def pred_many(self, queries: List[Tuple[int, int]]) -> List[int]:
+        # Reads the whole log, so updates wait until it's done
+        with self._lock:
+            m = len(self._operations)
+            intervals = self._alive_intervals()
+        # Iterative segment tree, leaf t is node size + t and node i covers its children 2i, 2i + 1
+        size = 1
+        while size < m:
+            size *= 2
+        node_keys = {}
+        for value, start, end in intervals:
+            low = start + size
+            high = end + size
+            while low < high:
+                if low & 1:
+                    node_keys.setdefault(low, []).append(value)
+                    low += 1
+                if high & 1:
+                    high -= 1
+                    node_keys.setdefault(high, []).append(value)
+                low >>= 1
+                high >>= 1
+        for keys in node_keys.values():
+            keys.sort()
+
+        results = []
+        for x, retro_point in queries:
+            if retro_point is None or not 0 <= retro_point < m:
+                print(f"FullRAPred: Invalid retro point {retro_point} for {m} ops")
+                results.append(None)
+                continue
+            best = None
+            node = retro_point + size
+            while node > 0:
+                keys = node_keys.get(node)
+                if keys is not None:
+                    i = bisect.bisect_right(keys, x)
+                    if i > 0 and (best is None or keys[i - 1] > best):
+                        best = keys[i - 1]
+                node >>= 1
+            # If nothing was found, there are no nodes less than or equal to x
+            results.append(-1 if best is None else best)
+        return results
+
+    # Stretches of the log where each key is in the tree, as (value, start, end) where the key is
+    # present after operations start through end - 1. Duplicate inserts stack up like in the tree,
+    # so a key stays alive until as many deletes have removed every copy.
+    def _alive_intervals(self) -> List[Tuple[int, int, int]]:
+        counts = {}
+        starts = {}
+        intervals = []
+        for i, (operation, value) in enumerate(self._operations):
+            count = counts.get(value, 0)
+            if operation == "insert":
+                if count == 0:
+                    starts[value] = i
+                counts[value] = count + 1
+            elif count > 0:
+                counts[value] = count - 1
+                if count == 1:
+                    intervals.append((value, starts.pop(value), i))
+        for value, start in starts.items():
+            intervals.append((value, start, len(self._operations)))
+        return intervals
+
+    # Save the present state and the operation log in the snapshot format described above
+    # SnapshotView. Loading it back doesn't have to replay the log to get the present.
+    def save(self, path: str) -> None:
+        with self._lock:
+            keys = array("q", self._present.in_order())
+            with open(path, "wb") as file:
+                file.write(
+                    _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, len(keys), len(self._operations))
+                )
+                file.write(keys)
+                self._operations.write_values(file)
+                self._operations.write_opcodes(file)
+
+    # The present is bulk built from the sorted keys and the log is copied in from the raw bytes,
+    # so nothing is replayed. The versions in the past are only built the first time one is needed.
+    @classmethod
+    def load(cls, path: str, copy_on_write: bool = False) -> Self:
+        tree = cls(copy_on_write)
+        with open(path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+                with memoryview(snapshot) as view:
+                    keys, values, opcodes = _snapshot_sections(view, path)
+                    try:
+                        tree._present = PersistentAVLTree.from_sorted(keys)
+                        tree._operations = OperationLog.from_buffers(opcodes, values)
+                        tree._publish()
+                    finally:
+                        # The views have to let go of the mapping before it can be closed
+                        for section in (keys, values, opcodes):
+                            section.release()
+        return tree
 
     def print_tree(self) -> None:
-        self._tree.print_tree()
+        self._present.print_tree()
 
     def print_log(self) -> None:
         if len(self._operations) == 0:
@@ -621,6 +2695,89 @@ class FullyRetroactiveAVL:
             print(f"  - {i}: {op}")
 
 
+# Snapshot file layout, all little endian:
+#   header   8 byte magic, number of keys, number of operations (8 bytes each)
+#   keys     the sorted values in the present tree, 8 bytes each
+#   values   the value of each operation in the log, 8 bytes each
+#   opcodes  the opcode of each operation in the log (OperationLog._OPCODES), 1 byte each
+# The opcodes go last so the 8 byte sections stay 8 byte aligned.
+_SNAPSHOT_MAGIC = b"RAVLSNP1"
+_SNAPSHOT_HEADER = struct.Struct("<8sQQ")
+
+
+# Split a snapshot's bytes into memoryviews of the keys, values and opcodes without copying them
+def _snapshot_sections(view: memoryview, path: str) -> Tuple[memoryview, memoryview, memoryview]:
+    if len(view) < _SNAPSHOT_HEADER.size:
+        raise ValueError(f"{path} is too short to be a snapshot")
+    magic, key_count, op_count = _SNAPSHOT_HEADER.unpack_from(view)
+    if magic != _SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not a snapshot")
+    keys_end = _SNAPSHOT_HEADER.size + 8 * key_count
+    values_end = keys_end + 8 * op_count
+    if len(view) != values_end + op_count:
+        raise ValueError(f"{path} is truncated or has extra data")
+    return (
+        view[_SNAPSHOT_HEADER.size : keys_end].cast("q"),
+        view[keys_end:values_end].cast("q"),
+        view[values_end:].cast("b"),
+    )
+
+
+# Answers queries on the present straight from a memory mapped snapshot, without building a tree
+# at all. The keys are a sorted array, so every query is a bisect, and only the pages it touches
+# are read from disk. It can't be updated, use FullyRetroactiveAVL.load for that.
+class SnapshotView:
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        try:
+            self._keys, self._values, self._opcodes = _snapshot_sections(self._view, path)
+        except ValueError:
+            self._view.release()
+            self._map.close()
+            self._file.close()
+            raise
+        self._frozen = FrozenAVLTree(self._keys)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for section in (self._keys, self._values, self._opcodes, self._view):
+            section.release()
+        self._map.close()
+        self._file.close()
+
+    # Same answers as FullyRetroactiveAVL.pred on the present, -1 if nothing is <= x
+    def pred(self, x: int) -> int:
+        result = self._frozen.pred(x)
+        return -1 if result is None else result
+
+    def rank(self, x: int) -> int:
+        return self._frozen.rank(x)
+
+    def select(self, k: int) -> int:
+        return self._frozen.select(k)
+
+    def count(self, lo: int, hi: int) -> int:
+        return self._frozen.count(lo, hi)
+
+    def __len__(self) -> int:
+        return len(self._frozen)
+
+    def operation_count(self) -> int:
+        return len(self._opcodes)
+
+    # The operation log, as (operation, value) tuples like OperationLog
+    def operations(self):
+        for opcode, value in zip(self._opcodes, self._values):
+            yield (OperationLog._NAMES[opcode], value)
+
+
 def verify_avltree():
     # prefilled_tree = AVLTree([5, 3, 7, 2, 4, 6, 8])
     # prefilled_tree.print_tree()
@@ -720,13 +2877,253 @@ def verify_fully_retroactive_avl():
     print(f"Retroactive Pred(20, 5): {tree.pred(20, retro=True, retro_point=5)}")
 
 
+# pred_many has to give exactly what calling pred for each query would, negative keys included
+def verify_pred_many():
+    tree = FullyRetroactiveAVL()
+    tree.insert(-5)
+    tree.insert(3)
+    tree.insert(-20)
+    tree.delete(-5)
+    tree.insert(-1, retro=True, retro_point=1)
+    tree.delete(3, retro=True, retro_point=3)
+
+    queries = [
+        (x, point) for x in (-30, -20, -10, -5, -2, -1, 0, 3, 10) for point in range(6)
+    ]
+    expected = [tree.pred(x, retro=True, retro_point=point) for x, point in queries]
+    assert tree.pred_many(queries) == expected, "pred_many doesn't match pred"
+    # Only -5 is in the tree after the first operation
+    assert tree.pred_many([(0, 0)]) == [-5]
+    assert tree.pred_many([(-30, 5)]) == [-1]
+    print("pred_many matches pred")
+
+
+# With the heights cached on each node an insert should only cost O(log n), so the time per insert
+# divided by log2(n) should stay roughly flat as the tree grows
+def benchmark_avl_insert(sizes: List[int] = None) -> None:
+    if sizes is None:
+        sizes = [10**3, 10**4, 10**5, 10**6]
+    print(f"{'Keys':>10} | {'Total (s)':>10} | {'us / insert':>12} | {'us / log2(n)':>12}")
+    for size in sizes:
+        num_list = list(range(size))
+        random.shuffle(num_list)
+        tree = AVLTree()
+        start = time.perf_counter()
+        for num in num_list:
+            tree.insert(TreeNode(num))
+        total = time.perf_counter() - start
+        per_insert = total / size * 1e6
+        print(
+            f"{size:>10} | {total:>10.4f} | {per_insert:>12.3f} | {per_insert / math.log2(size):>12.4f}"
+        )
+
+
+# A retroactive update to the PartialRetroactiveAVL only touches one key, so how far back in time it
+# happens shouldn't matter. The replay version has to redo everything after the retro point.
+def benchmark_partial_retro_points(
+    size: int = 20000, points: List[float] = None, repeats: int = 20
+) -> None:
+    if points is None:
+        points = [0.01, 0.10, 0.50, 0.90, 0.99]
+    num_list = list(range(size))
+    random.shuffle(num_list)
+    trees = {
+        "partial": PartialRetroactiveAVL(),
+        "replay": ReplayPartialRetroactiveAVL(),
+    }
+    for tree in trees.values():
+        for num in num_list:
+            tree.insert(num)
+    print(f"{'Retro point':>11} | {'Partial (us)':>12} | {'Replay (us)':>12}")
+    for point in points:
+        results = []
+        for tree in trees.values():
+            start = time.perf_counter()
+            for _ in range(repeats):
+                value = random.randint(0, size * 2)
+                tree.insert(value, retro=True, retro_point=int(size * point))
+            results.append((time.perf_counter() - start) / repeats * 1e6)
+        print(f"{point:>11.2f} | {results[0]:>12.2f} | {results[1]:>12.2f}")
+
+
+# Compare the memory used by the old list of tuples against the OperationLog, and the cost of
+# adding an operation in the middle of each. tracemalloc counts everything each log allocates.
+def benchmark_operation_log(sizes: List[int] = None, repeats: int = 1000) -> None:
+    import tracemalloc
+
+    if sizes is None:
+        sizes = [10**4, 10**5, 10**6]
+    print(
+        f"{'Ops':>9} | {'List (MB)':>9} | {'Log (MB)':>9} | {'List ins (us)':>13} | {'Log ins (us)':>12}"
+    )
+    for size in sizes:
+        results = []
+        for log_type in (list, OperationLog):
+            tracemalloc.start()
+            log = log_type()
+            for i in range(size):
+                log.append(("insert" if i % 3 else "delete", random.randint(0, 2**40)))
+            memory = tracemalloc.get_traced_memory()[0] / 2**20
+            tracemalloc.stop()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                log.insert(random.randint(0, len(log) - 1), ("insert", 1000))
+            results.append((memory, (time.perf_counter() - start) / repeats * 1e6))
+        print(
+            f"{size:>9} | {results[0][0]:>9.2f} | {results[1][0]:>9.2f} | {results[0][1]:>13.3f} | {results[1][1]:>12.3f}"
+        )
+
+
+# The recursive delete, traversal, and height the AVLTree used to have, kept to benchmark the
+# iterative versions against
+class RecursiveAVLTree(AVLTree):
+    def delete(self, data: int) -> bool:
+        self._retrace_from = None
+        self._removed = False
+        self._bst_delete(self.root, data)
+        self._rebalance(self._retrace_from)
+        return self._removed
+
+    def _bst_delete(self, current_node: TreeNode, data: int) -> TreeNode:
+        if current_node is None:
+            return current_node
+        if data < current_node.value:
+            current_node.left = self._bst_delete(current_node.left, data)
+            return current_node
+        elif data > current_node.value:
+            current_node.right = self._bst_delete(current_node.right, data)
+            return current_node
+        self._retrace_from = current_node.parent
+        self._removed = True
+        if current_node.left is None or current_node.right is None:
+            temp = current_node.left if current_node.left is not None else current_node.right
+            if temp is not None:
+                temp.parent = current_node.parent
+            if current_node is self.root:
+                self.root = temp
+            return temp
+        parent = current_node
+        temp = current_node.right
+        while temp.left is not None:
+            parent = temp
+            temp = temp.left
+        if parent is not current_node:
+            parent.left = temp.right
+        else:
+            parent.right = temp.right
+        if temp.right is not None:
+            temp.right.parent = parent
+        self._retrace_from = parent
+        current_node.value = temp.value
+        return current_node
+
+    def in_order(self):
+        yield from self._in_order(self.root)
+
+    def _in_order(self, start: TreeNode):
+        if start is not None:
+            yield from self._in_order(start.left)
+            yield start.value
+            yield from self._in_order(start.right)
+
+    def _measure_height(self, start: TreeNode) -> int:
+        if start is None:
+            return 0
+        return 1 + max(self._measure_height(start.left), self._measure_height(start.right))
+
+
+# Time deletes, an in-order walk, and measuring the height with the iterative AVLTree against the
+# old recursive versions
+def benchmark_iterative_vs_recursive(
+    sizes: List[int] = None, deletes: int = 10000
+) -> None:
+    if sizes is None:
+        sizes = [10**5, 10**6]
+    print(f"{'Keys':>9} | {'Version':>9} | {'Delete (us)':>11} | {'In-order (s)':>12} | {'Height (s)':>10}")
+    for size in sizes:
+        to_delete = random.sample(range(size), deletes)
+        for tree_type in (RecursiveAVLTree, AVLTree):
+            tree = tree_type.from_sorted(range(size))
+            start = time.perf_counter()
+            for value in to_delete:
+                tree.delete(value)
+            delete_time = (time.perf_counter() - start) / deletes * 1e6
+            start = time.perf_counter()
+            for _ in tree.in_order():
+                pass
+            in_order_time = time.perf_counter() - start
+            start = time.perf_counter()
+            tree._measure_height(tree.root)
+            height_time = time.perf_counter() - start
+            name = "recursive" if tree_type is RecursiveAVLTree else "iterative"
+            print(
+                f"{size:>9} | {name:>9} | {delete_time:>11.3f} | {in_order_time:>12.4f} | {height_time:>10.4f}"
+            )
+
+
+# Memory per key and insert speed for the pointer based AVLTree against the ArenaAVLTree
+def benchmark_tree_memory(sizes: List[int] = None) -> None:
+    import tracemalloc
+
+    if sizes is None:
+        sizes = [10**4, 10**5, 10**6]
+    print(f"{'Keys':>9} | {'Tree':>7} | {'Bytes / key':>11} | {'us / insert':>11}")
+    for size in sizes:
+        num_list = random.sample(range(size * 4), size)
+        for tree_type in (AVLTree, ArenaAVLTree):
+            tracemalloc.start()
+            tree = tree_type()
+            start = time.perf_counter()
+            for num in num_list:
+                tree.insert(TreeNode(num))
+            insert_time = (time.perf_counter() - start) / size * 1e6
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            name = "pointer" if tree_type is AVLTree else "arena"
+            print(f"{size:>9} | {name:>7} | {memory / size:>11.1f} | {insert_time:>11.3f}")
+            del tree
+
+
+# Keys per second going into each retroactive tree through the per key insert loop compared to
+# insert_many with the same batches
+def benchmark_bulk_ingest(total: int = 100000, batch_size: int = 5000) -> None:
+    num_list = list(range(total))
+    random.shuffle(num_list)
+    batches = [num_list[i : i + batch_size] for i in range(0, total, batch_size)]
+    print(f"{'Tree':>8} | {'Per key (keys/s)':>16} | {'Batched (keys/s)':>16} | {'Speedup':>7}")
+    for tree_type in (PartialRetroactiveAVL, FullyRetroactiveAVL):
+        tree = tree_type()
+        start = time.perf_counter()
+        for batch in batches:
+            for num in batch:
+                tree.insert(num)
+        per_key = total / (time.perf_counter() - start)
+        tree = tree_type()
+        start = time.perf_counter()
+        for batch in batches:
+            tree.insert_many(batch)
+        batched = total / (time.perf_counter() - start)
+        name = "partial" if tree_type is PartialRetroactiveAVL else "full"
+        print(f"{name:>8} | {per_key:>16.0f} | {batched:>16.0f} | {batched / per_key:>6.1f}x")
+
+
 if __name__ == "__main__":
     # Verify the datastructures each behave as expected
     # verify_avltree()
     # verify_partial_retroactive_avl()
     # verify_fully_retroactive_avl()
+    # verify_pred_many()
+    # benchmark_avl_insert()
+    # benchmark_partial_retro_points()
+    # benchmark_operation_log()
+    # benchmark_iterative_vs_recursive()
+    # benchmark_tree_memory()
+    # benchmark_bulk_ingest()
     # exit(0)
 
+    # benchmark_suite.py runs these same kinds of tests with configurable sizes and operation mixes,
+    # spread over a process pool, and reports percentiles as JSON or CSV
+
     # I'll test performance of different size trees (small 100 node, medium 500 node, large 1000 node)
     # I'll do a strange number to try and make sure the tree isn't too "perfect" for the tests
     # SML_SIZE = 1050
@@ -1137,9 +3534,26 @@ if __name__ == "__main__":
     # print(delete_retro_times)
 
     # Graph everything as single histograms comparing one tree size and its current to retro performance
+    # plt.show() blocks until each window is closed, so when BENCHMARK_PLOT_DIR is set (like on a
+    # headless nightly run) the plots are saved there as images instead
+    import os
+
+    import matplotlib
+
+    plot_dir = os.environ.get("BENCHMARK_PLOT_DIR")
+    if plot_dir is not None:
+        matplotlib.use("Agg")
+        os.makedirs(plot_dir, exist_ok=True)
     import matplotlib.pyplot as plt
     import numpy as np
 
+    def show_plot(name: str) -> None:
+        if plot_dir is None:
+            plt.show()
+        else:
+            plt.savefig(os.path.join(plot_dir, f"{name}.png"))
+            plt.close()
+
     # First, show all the timings for current ins / del operations as they are all very quick
     fig, ax = plt.subplots(1, 2, figsize=(10, 5))
     fig.subplots_adjust(left=0.1, right=0.9, top=0.9, bottom=0.1, wspace=0.4)
@@ -1208,7 +3622,7 @@ if __name__ == "__main__":
     plt.tight_layout()
     ax[0].grid(True, which="both", linestyle="--", linewidth=0.5, color="gray")
     ax[1].grid(True, which="both", linestyle="--", linewidth=0.5, color="gray")
-    plt.show()
+    show_plot("current")
 
     # Now show the timings for small tree insert / delete
     fig, ax = plt.subplots(1, 2, figsize=(10, 5))
@@ -1274,7 +3688,7 @@ if __name__ == "__main__":
     plt.tight_layout()
     ax[0].grid(True, which="both", linestyle="--", linewidth=0.5, color="gray")
     ax[1].grid(True, which="both", linestyle="--", linewidth=0.5, color="gray")
-    plt.show()
+    show_plot("retro_small")
 
     # Now show the timings for medium tree insert / delete
     fig, ax = plt.subplots(1, 2, figsize=(10, 5))
@@ -1341,7 +3755,7 @@ if __name__ == "__main__":
     plt.tight_layout()
     ax[0].grid(True, which="both", linestyle="--", linewidth=0.5, color="gray")
     ax[1].grid(True, which="both", linestyle="--", linewidth=0.5, color="gray")
-    plt.show()
+    show_plot("retro_medium")
 
     # Now show the timings for large tree insert / delete
     fig, ax = plt.subplots(1, 2, figsize=(10, 5))
@@ -1407,4 +3821,4 @@ if __name__ == "__main__":
     plt.tight_layout()
     ax[0].grid(True, which="both", linestyle="--", linewidth=0.5, color="gray")
     ax[1].grid(True, which="both", linestyle="--", linewidth=0.5, color="gray")
-    plt.show()
+    show_plot("retro_large")
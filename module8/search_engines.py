@@ -0,0 +1,1441 @@
+# CSC 506 - Design and Analysis of Algorithms
+# Module 8 - Portfolio Project - Option 2
+# Other balanced search trees that can stand in for AVLTree
+
+"""
+Every class here follows the SearchTree protocol from portfolio_project_option2.py, so any of them
+can be passed as the engine of the retroactive trees that keep a mutable tree:
+
+    PartialRetroactiveAVL(engine=BTree)
+    RollbackFullyRetroactiveAVL(engine=Treap)
+
+Like AVLTree they are all multisets, insert takes a TreeNode or a plain value, delete removes one
+copy and returns whether it found one, and pred returns None when nothing is <= x.
+
+RedBlackTree - left leaning red-black tree (Sedgewick), with subtree sizes for rank / select
+Treap        - randomized BST kept as a heap on random priorities, built on split and merge
+SkipList     - indexable skip list, each link knows how many values it skips over
+BTree        - B-tree with `order` children per node (32 by default), BTree.with_order(64) makes
+               a B-tree class with a different (even) order
+BPlusTree    - B+-tree, values only in linked sorted leaves (64 values and 64 children by default)
+"""
+# Imports
+import bisect
+import random
+from typing import List, Self, Tuple
+
+from portfolio_project_option2 import ArenaAVLTree, AVLTree, TreeNode
+
+
+# The engines take either a TreeNode (like AVLTree.insert always has) or a plain value
+def _value(newNode) -> int:
+    return newNode.value if isinstance(newNode, TreeNode) else newNode
+
+
+# The parts of the protocol that are the same for every engine, in terms of insert, delete, rank
+# and select
+class _Engine:
+    # Opt in counters for instrumentation.py, None unless something is counting. Setting it on
+    # one tree (tree.stats = TreeStats()) counts the nodes only that tree's searches look at.
+    stats = None
+
+    def insert_many(self, values: List[int]) -> None:
+        for value in values:
+            self.insert(value)
+
+    # Returns how many of the values were found and removed
+    def delete_many(self, values: List[int]) -> int:
+        removed = 0
+        for value in values:
+            if self.delete(value):
+                removed += 1
+        return removed
+
+    # Pred and Succ follow the assignment's inclusive definition, like AVLTree
+    def pred(self, x: int) -> int:
+        return self.floor(x)
+
+    def succ(self, x: int) -> int:
+        return self.ceil(x)
+
+    # How many values are in lo <= value <= hi
+    def count(self, lo: int, hi: int) -> int:
+        if hi < lo:
+            return 0
+        return self.rank(hi) - self._rank_below(lo)
+
+    # All values lo <= value <= hi in sorted order
+    def range(self, lo: int, hi: int) -> List[int]:
+        return [self.select(k) for k in range(self._rank_below(lo), self.rank(hi))]
+
+    def _check_index(self, k: int) -> None:
+        if k < 0 or k >= len(self):
+            raise IndexError("select index out of range")
+
+
+# Shared by the two binary engines, the nodes only need value, left and right
+def _print_binary(root) -> None:
+    if root is None:
+        print("Tree is empty")
+        return
+    print("Current tree state: ")
+    # Right subtree first so the tree reads sideways with the root on the left, like AVLTree
+    stack = []
+    current, level, prefix = root, 0, ""
+    while stack or current is not None:
+        if current is not None:
+            stack.append((current, level, prefix))
+            current, level, prefix = current.right, level + 1, "/"
+            continue
+        current, level, prefix = stack.pop()
+        print(" " * 3 * level + prefix + str(current.value))
+        current, level, prefix = current.left, level + 1, "\\"
+    print()
+
+
+def _binary_in_order(root):
+    stack = []
+    current = root
+    while stack or current is not None:
+        if current is not None:
+            stack.append(current)
+            current = current.left
+            continue
+        current = stack.pop()
+        yield current.value
+        current = current.right
+
+
+# Shared descents for the binary engines, the same walks as AVLTree's floor, ceil, rank and select
+class _BinaryEngine(_Engine):
+    def floor(self, x: int) -> int:
+        best = None
+        current = self.root
+        steps = 0
+        while current is not None:
+            steps += 1
+            if current.value <= x:
+                best = current.value
+                current = current.right
+            else:
+                current = current.left
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return best
+
+    def ceil(self, x: int) -> int:
+        best = None
+        current = self.root
+        steps = 0
+        while current is not None:
+            steps += 1
+            if current.value >= x:
+                best = current.value
+                current = current.left
+            else:
+                current = current.right
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return best
+
+    # How many values are <= x
+    def rank(self, x: int) -> int:
+        count = 0
+        current = self.root
+        while current is not None:
+            if current.value <= x:
+                count += _size(current.left) + 1
+                current = current.right
+            else:
+                current = current.left
+        return count
+
+    # How many values are < x
+    def _rank_below(self, x: int) -> int:
+        count = 0
+        current = self.root
+        while current is not None:
+            if current.value < x:
+                count += _size(current.left) + 1
+                current = current.right
+            else:
+                current = current.left
+        return count
+
+    # The k-th smallest value, counting from 0 like a sorted list index
+    def select(self, k: int) -> int:
+        self._check_index(k)
+        current = self.root
+        while True:
+            left_size = _size(current.left)
+            if k < left_size:
+                current = current.left
+            elif k == left_size:
+                return current.value
+            else:
+                k -= left_size + 1
+                current = current.right
+
+    def __len__(self) -> int:
+        return _size(self.root)
+
+    def in_order(self):
+        return _binary_in_order(self.root)
+
+    def print_tree(self) -> None:
+        _print_binary(self.root)
+
+
+def _size(node) -> int:
+    return 0 if node is None else node.size
+
+
+# Left leaning red-black tree
+# https://sedgewick.io/wp-content/themes/sedgewick/papers/2008LLRB.pdf
+# A red link always leans left, so the tree lines up one to one with a 2-3 tree and insert and
+# delete only need the three fix ups in _balance on the way back up. It's kept to a height of at
+# most 2 log n, looser than AVL's 1.44 log n, but does fewer rotations on updates.
+# The top down delete relies on there being one node per value, so copies of a value are counted in
+# their node instead of getting nodes of their own.
+class _RedBlackNode:
+    __slots__ = ("value", "left", "right", "red", "copies", "size")
+
+    def __init__(self, value: int) -> None:
+        self.value = value
+        self.left = None
+        self.right = None
+        # New nodes are always joined to their parent with a red link
+        self.red = True
+        self.copies = 1
+        # Counts every copy in the subtree, not just the nodes
+        self.size = 1
+
+
+def _is_red(node: _RedBlackNode) -> bool:
+    return node is not None and node.red
+
+
+class RedBlackTree(_BinaryEngine):
+    def __init__(self) -> None:
+        self.root = None
+
+    # There isn't a simple way to color a balanced build so every red link leans left, so this
+    # one inserts the values one by one
+    @classmethod
+    def from_sorted(cls, sorted_data: List[int]) -> Self:
+        tree = cls()
+        for value in sorted_data:
+            tree.insert(value)
+        return tree
+
+    def insert(self, newNode) -> None:
+        self.root = self._insert(self.root, _value(newNode))
+        self.root.red = False
+
+    def _insert(self, node: _RedBlackNode, value: int) -> _RedBlackNode:
+        if node is None:
+            return _RedBlackNode(value)
+        if self.stats is not None:
+            self.stats.comparisons += 1
+        if value < node.value:
+            node.left = self._insert(node.left, value)
+        elif value > node.value:
+            node.right = self._insert(node.right, value)
+        else:
+            node.copies += 1
+        return self._balance(node)
+
+    # Returns whether the data was found and removed
+    def delete(self, data: int) -> bool:
+        path = []
+        current = self.root
+        steps = 0
+        while current is not None and current.value != data:
+            steps += 1
+            path.append(current)
+            current = current.left if data < current.value else current.right
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        if current is None:
+            return False
+        if current.copies > 1:
+            # Only the counts change, the shape stays the same
+            current.copies -= 1
+            current.size -= 1
+            for node in path:
+                node.size -= 1
+            return True
+
+        if not _is_red(self.root.left) and not _is_red(self.root.right):
+            self.root.red = True
+        self.root = self._delete(self.root, data)
+        if self.root is not None:
+            self.root.red = False
+        return True
+
+    def _delete(self, node: _RedBlackNode, data: int) -> _RedBlackNode:
+        if self.stats is not None:
+            self.stats.comparisons += 1
+        if data < node.value:
+            # Make sure the node we step down to isn't a 2-node, so it can lose a value
+            if not _is_red(node.left) and not _is_red(node.left.left):
+                node = self._move_red_left(node)
+            node.left = self._delete(node.left, data)
+        else:
+            if _is_red(node.left):
+                node = self._rotate_right(node)
+            if data == node.value and node.right is None:
+                return None
+            if not _is_red(node.right) and not _is_red(node.right.left):
+                node = self._move_red_right(node)
+            if data == node.value:
+                # Same as AVLTree, the successor takes the node's place
+                successor = node.right
+                while successor.left is not None:
+                    successor = successor.left
+                node.value = successor.value
+                node.copies = successor.copies
+                node.right = self._delete_min(node.right)
+            else:
+                node.right = self._delete(node.right, data)
+        return self._balance(node)
+
+    def _delete_min(self, node: _RedBlackNode) -> _RedBlackNode:
+        if node.left is None:
+            return None
+        if not _is_red(node.left) and not _is_red(node.left.left):
+            node = self._move_red_left(node)
+        node.left = self._delete_min(node.left)
+        return self._balance(node)
+
+    def _rotate_left(self, node: _RedBlackNode) -> _RedBlackNode:
+        pivot = node.right
+        node.right = pivot.left
+        pivot.left = node
+        pivot.red = node.red
+        node.red = True
+        pivot.size = node.size
+        node.size = _size(node.left) + _size(node.right) + node.copies
+        return pivot
+
+    def _rotate_right(self, node: _RedBlackNode) -> _RedBlackNode:
+        pivot = node.left
+        node.left = pivot.right
+        pivot.right = node
+        pivot.red = node.red
+        node.red = True
+        pivot.size = node.size
+        node.size = _size(node.left) + _size(node.right) + node.copies
+        return pivot
+
+    def _flip_colors(self, node: _RedBlackNode) -> None:
+        node.red = not node.red
+        node.left.red = not node.left.red
+        node.right.red = not node.right.red
+
+    def _move_red_left(self, node: _RedBlackNode) -> _RedBlackNode:
+        self._flip_colors(node)
+        if _is_red(node.right.left):
+            node.right = self._rotate_right(node.right)
+            node = self._rotate_left(node)
+            self._flip_colors(node)
+        return node
+
+    def _move_red_right(self, node: _RedBlackNode) -> _RedBlackNode:
+        self._flip_colors(node)
+        if _is_red(node.left.left):
+            node = self._rotate_right(node)
+            self._flip_colors(node)
+        return node
+
+    # Put back the left leaning shape on the way up, and fix the node's size
+    def _balance(self, node: _RedBlackNode) -> _RedBlackNode:
+        if _is_red(node.right) and not _is_red(node.left):
+            node = self._rotate_left(node)
+        if _is_red(node.left) and _is_red(node.left.left):
+            node = self._rotate_right(node)
+        if _is_red(node.left) and _is_red(node.right):
+            self._flip_colors(node)
+        node.size = _size(node.left) + _size(node.right) + node.copies
+        return node
+
+    # The order statistics count every copy in a node
+    def rank(self, x: int) -> int:
+        count = 0
+        current = self.root
+        while current is not None:
+            if current.value <= x:
+                count += _size(current.left) + current.copies
+                current = current.right
+            else:
+                current = current.left
+        return count
+
+    def _rank_below(self, x: int) -> int:
+        count = 0
+        current = self.root
+        while current is not None:
+            if current.value < x:
+                count += _size(current.left) + current.copies
+                current = current.right
+            else:
+                current = current.left
+        return count
+
+    def select(self, k: int) -> int:
+        self._check_index(k)
+        current = self.root
+        while True:
+            left_size = _size(current.left)
+            if k < left_size:
+                current = current.left
+            elif k < left_size + current.copies:
+                return current.value
+            else:
+                k -= left_size + current.copies
+                current = current.right
+
+    def in_order(self):
+        stack = []
+        current = self.root
+        while stack or current is not None:
+            if current is not None:
+                stack.append(current)
+                current = current.left
+                continue
+            current = stack.pop()
+            for _ in range(current.copies):
+                yield current.value
+            current = current.right
+
+
+# Treap, a BST on the values that's also a max heap on a random priority per node, which keeps it
+# balanced in expectation (the shape is the same as inserting the values in a random order)
+# https://en.wikipedia.org/wiki/Treap
+class _TreapNode:
+    __slots__ = ("value", "priority", "left", "right", "size")
+
+    def __init__(self, value: int, priority: float) -> None:
+        self.value = value
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.size = 1
+
+
+def _treap_update(node: _TreapNode) -> None:
+    node.size = _size(node.left) + _size(node.right) + 1
+
+
+# Splits into (values <= x, values > x)
+def _treap_split(node: _TreapNode, x: int) -> Tuple[_TreapNode, _TreapNode]:
+    if node is None:
+        return None, None
+    if node.value <= x:
+        left, right = _treap_split(node.right, x)
+        node.right = left
+        _treap_update(node)
+        return node, right
+    left, right = _treap_split(node.left, x)
+    node.left = right
+    _treap_update(node)
+    return left, node
+
+
+# Every value in left has to be <= every value in right
+def _treap_merge(left: _TreapNode, right: _TreapNode) -> _TreapNode:
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _treap_merge(left.right, right)
+        _treap_update(left)
+        return left
+    right.left = _treap_merge(left, right.left)
+    _treap_update(right)
+    return right
+
+
+class Treap(_BinaryEngine):
+    def __init__(self) -> None:
+        self.root = None
+
+    # Build the balanced shape like AVLTree.from_sorted, then hand out a sorted batch of random
+    # priorities level by level so every parent's priority is above its children's
+    @classmethod
+    def from_sorted(cls, sorted_data: List[int]) -> Self:
+        tree = cls()
+        tree.root = cls._build_tree(sorted_data, 0, len(sorted_data) - 1)
+        priorities = sorted((random.random() for _ in range(len(sorted_data))), reverse=True)
+        level = [tree.root] if tree.root is not None else []
+        index = 0
+        while level:
+            next_level = []
+            for node in level:
+                node.priority = priorities[index]
+                index += 1
+                if node.left is not None:
+                    next_level.append(node.left)
+                if node.right is not None:
+                    next_level.append(node.right)
+            level = next_level
+        return tree
+
+    @staticmethod
+    def _build_tree(sorted_data: List[int], low: int, high: int) -> _TreapNode:
+        if low > high:
+            return None
+        mid = (low + high) // 2
+        node = _TreapNode(sorted_data[mid], 0.0)
+        node.left = Treap._build_tree(sorted_data, low, mid - 1)
+        node.right = Treap._build_tree(sorted_data, mid + 1, high)
+        _treap_update(node)
+        return node
+
+    def insert(self, newNode) -> None:
+        self.root = self._insert(self.root, _TreapNode(_value(newNode), random.random()))
+
+    # Walk down like a plain BST insert until the new node's priority belongs above the current
+    # one, then split that subtree around the new value. Splitting the whole tree would work too,
+    # but almost every new node ends up near the bottom so this touches far fewer nodes.
+    def _insert(self, node: _TreapNode, new_node: _TreapNode) -> _TreapNode:
+        if node is None:
+            return new_node
+        if self.stats is not None:
+            self.stats.comparisons += 1
+        if new_node.priority > node.priority:
+            # New copies of a value go after the ones already there
+            new_node.left, new_node.right = _treap_split(node, new_node.value)
+            _treap_update(new_node)
+            return new_node
+        if new_node.value < node.value:
+            node.left = self._insert(node.left, new_node)
+        else:
+            node.right = self._insert(node.right, new_node)
+        node.size += 1
+        return node
+
+    # Returns whether the data was found and removed
+    def delete(self, data: int) -> bool:
+        self.root, removed = self._delete(self.root, data)
+        return removed
+
+    def _delete(self, node: _TreapNode, data: int) -> Tuple[_TreapNode, bool]:
+        if node is None:
+            return None, False
+        if self.stats is not None:
+            self.stats.comparisons += 1
+        if data == node.value:
+            return _treap_merge(node.left, node.right), True
+        if data < node.value:
+            node.left, removed = self._delete(node.left, data)
+        else:
+            node.right, removed = self._delete(node.right, data)
+        if removed:
+            node.size -= 1
+        return node, removed
+
+
+# Indexable skip list, from Raymond Hettinger's recipe
+# https://code.activestate.com/recipes/576930/
+# Level 0 is a sorted linked list and each level above skips over about half the nodes of the one
+# below. Every link also stores its width (how many level 0 steps it jumps), so the descent that
+# finds a value also counts how many values come before it, which gives rank and select.
+class _SkipNode:
+    __slots__ = ("value", "next", "width")
+
+    def __init__(self, value: int, levels: int) -> None:
+        self.value = value
+        self.next = [None] * levels
+        self.width = [1] * levels
+
+
+class SkipList(_Engine):
+    _MAX_LEVELS = 32
+
+    def __init__(self) -> None:
+        self._head = _SkipNode(None, self._MAX_LEVELS)
+        # How many levels have nodes on them, the searches start at the top one
+        self._levels = 1
+        self._length = 0
+
+    # Each node gets its random height as the list is built, and is linked in behind the last node
+    # seen on each of its levels, so the whole build is one pass
+    @classmethod
+    def from_sorted(cls, sorted_data: List[int]) -> Self:
+        tree = cls()
+        head = tree._head
+        tails = [head] * cls._MAX_LEVELS
+        positions = [0] * cls._MAX_LEVELS
+        for position, value in enumerate(sorted_data, start=1):
+            levels = tree._random_levels()
+            node = _SkipNode(value, levels)
+            for level in range(levels):
+                tails[level].next[level] = node
+                tails[level].width[level] = position - positions[level]
+                tails[level] = node
+                positions[level] = position
+            tree._levels = max(tree._levels, levels)
+        tree._length = len(sorted_data)
+        for level in range(tree._levels):
+            tails[level].width[level] = tree._length + 1 - positions[level]
+        return tree
+
+    # A node is on level l with probability 1 / 2**l
+    def _random_levels(self) -> int:
+        bits = random.getrandbits(self._MAX_LEVELS - 1)
+        return min(self._MAX_LEVELS, (bits & -bits).bit_length() or self._MAX_LEVELS)
+
+    def insert(self, newNode) -> None:
+        value = _value(newNode)
+        levels = self._random_levels()
+        if levels > self._levels:
+            # The head's links on the new levels skip the whole list
+            for level in range(self._levels, levels):
+                self._head.next[level] = None
+                self._head.width[level] = self._length + 1
+            self._levels = levels
+
+        # The last node on each level that's <= value, and how far the descent moved on that level.
+        # New copies of a value go after the ones already there.
+        chain = [None] * self._levels
+        steps_at_level = [0] * self._levels
+        node = self._head
+        compared = 0
+        for level in reversed(range(self._levels)):
+            following = node.next[level]
+            while following is not None and following.value <= value:
+                compared += 1
+                steps_at_level[level] += node.width[level]
+                node = following
+                following = node.next[level]
+            chain[level] = node
+        if self.stats is not None:
+            self.stats.comparisons += compared + self._levels
+
+        new_node = _SkipNode(value, levels)
+        steps = 0
+        for level in range(levels):
+            previous = chain[level]
+            new_node.next[level] = previous.next[level]
+            previous.next[level] = new_node
+            new_node.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+            steps += steps_at_level[level]
+        # The links above the new node jump over one more value now
+        for level in range(levels, self._levels):
+            chain[level].width[level] += 1
+        self._length += 1
+
+    # Returns whether the data was found and removed
+    def delete(self, data: int) -> bool:
+        # The last node on each level that's < data, the first copy of data follows it on level 0
+        chain = [None] * self._levels
+        node = self._head
+        compared = 0
+        for level in reversed(range(self._levels)):
+            following = node.next[level]
+            while following is not None and following.value < data:
+                compared += 1
+                node = following
+                following = node.next[level]
+            chain[level] = node
+        if self.stats is not None:
+            self.stats.comparisons += compared + self._levels
+        target = chain[0].next[0]
+        if target is None or target.value != data:
+            return False
+
+        for level in range(len(target.next)):
+            previous = chain[level]
+            previous.width[level] += target.width[level] - 1
+            previous.next[level] = target.next[level]
+        for level in range(len(target.next), self._levels):
+            chain[level].width[level] -= 1
+        self._length -= 1
+        return True
+
+    def floor(self, x: int) -> int:
+        node = self._head
+        compared = 0
+        for level in reversed(range(self._levels)):
+            following = node.next[level]
+            while following is not None and following.value <= x:
+                compared += 1
+                node = following
+                following = node.next[level]
+        if self.stats is not None:
+            self.stats.comparisons += compared + self._levels
+        return None if node is self._head else node.value
+
+    def ceil(self, x: int) -> int:
+        node = self._head
+        compared = 0
+        for level in reversed(range(self._levels)):
+            following = node.next[level]
+            while following is not None and following.value < x:
+                compared += 1
+                node = following
+                following = node.next[level]
+        if self.stats is not None:
+            self.stats.comparisons += compared + self._levels
+        following = node.next[0]
+        return None if following is None else following.value
+
+    # How many values are <= x, adding up the widths of the links the descent takes
+    def rank(self, x: int) -> int:
+        count = 0
+        node = self._head
+        for level in reversed(range(self._levels)):
+            following = node.next[level]
+            while following is not None and following.value <= x:
+                count += node.width[level]
+                node = following
+                following = node.next[level]
+        return count
+
+    # How many values are < x
+    def _rank_below(self, x: int) -> int:
+        count = 0
+        node = self._head
+        for level in reversed(range(self._levels)):
+            following = node.next[level]
+            while following is not None and following.value < x:
+                count += node.width[level]
+                node = following
+                following = node.next[level]
+        return count
+
+    # The k-th smallest value, counting from 0 like a sorted list index
+    def select(self, k: int) -> int:
+        self._check_index(k)
+        # The head is position 0, so the k-th value is k + 1 steps along level 0
+        remaining = k + 1
+        node = self._head
+        for level in reversed(range(self._levels)):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        return node.value
+
+    def __len__(self) -> int:
+        return self._length
+
+    def in_order(self):
+        node = self._head.next[0]
+        while node is not None:
+            yield node.value
+            node = node.next[0]
+
+    def print_tree(self) -> None:
+        if self._length == 0:
+            print("Tree is empty")
+            return
+        print("Current skip list state: ")
+        for level in reversed(range(self._levels)):
+            values = []
+            node = self._head.next[level]
+            while node is not None:
+                values.append(str(node.value))
+                node = node.next[level]
+            print(f"{level:>3}: " + " ".join(values))
+        print()
+
+
+# B-tree, following CLRS chapter 18 (with the sizes of each subtree added for rank and select)
+# https://en.wikipedia.org/wiki/B-tree
+# Every node holds up to order - 1 sorted values in a list and order children, so a lookup is
+# a bisect per level over a tree about log_16(n) levels deep instead of ~1.44 log_2(n) node hops.
+# Insert splits full nodes on the way down and delete tops up thin nodes on the way down, so
+# neither ever has to walk back up.
+class _BTreeNode:
+    __slots__ = ("keys", "children", "size")
+
+    def __init__(self, keys: List[int], children: List["_BTreeNode"] = None) -> None:
+        self.keys = keys
+        # None for a leaf
+        self.children = children
+        self.size = len(keys)
+        if children is not None:
+            self.size += sum(child.size for child in children)
+
+
+class BTree(_Engine):
+    # The most children a node can have. CLRS's B-tree always has an even number of them (2t for
+    # a minimum degree of t), so the order has to be even.
+    order = 32
+
+    def __init__(self) -> None:
+        self._check_order(self.order)
+        # CLRS's minimum degree, every node but the root has at least t - 1 values
+        self._min_degree = self.order // 2
+        self._max_keys = 2 * self._min_degree - 1
+        self.root = _BTreeNode([])
+
+    # A BTree class with a different order, for passing as an engine. The class is named after
+    # the order, like BTree64, so it shows up that way in the benchmark results.
+    @classmethod
+    def with_order(cls, order: int) -> type:
+        cls._check_order(order)
+        return type(f"{cls.__name__}{order}", (cls,), {"order": order})
+
+    @staticmethod
+    def _check_order(order: int) -> None:
+        if order < 4 or order % 2 != 0:
+            raise ValueError(f"A B-tree needs an even order of at least 4, not {order}")
+
+    # Fill the leaves about three quarters full, with one value between each pair of leaves moving
+    # up to the level above, and repeat until what's left fits in one node
+    @classmethod
+    def from_sorted(cls, sorted_data: List[int]) -> Self:
+        tree = cls()
+        values = list(sorted_data)
+        nodes = None
+        target = 3 * tree._min_degree // 2
+        while len(values) > tree._max_keys:
+            # count nodes hold all but the count - 1 values that separate them
+            count = -(-(len(values) + 1) // (target + 1))
+            base, extra = divmod(len(values) - count + 1, count)
+            next_nodes = []
+            separators = []
+            start = 0
+            for index in range(count):
+                stop = start + base + (1 if index < extra else 0)
+                if nodes is None:
+                    next_nodes.append(_BTreeNode(values[start:stop]))
+                else:
+                    # values[j] sits between nodes[j] and nodes[j + 1]
+                    children = nodes[start : stop + 1]
+                    next_nodes.append(_BTreeNode(values[start:stop], children))
+                if stop < len(values):
+                    separators.append(values[stop])
+                start = stop + 1
+            nodes = next_nodes
+            values = separators
+        tree.root = _BTreeNode(values, nodes)
+        return tree
+
+    def insert(self, newNode) -> None:
+        value = _value(newNode)
+        if len(self.root.keys) == self._max_keys:
+            # The only way the tree gets taller, the root splits under a new root
+            self.root = _BTreeNode([], [self.root])
+            self._split_child(self.root, 0)
+        node = self.root
+        steps = 0
+        while True:
+            steps += 1
+            node.size += 1
+            # New copies of a value go after the ones already there
+            index = bisect.bisect_right(node.keys, value)
+            if node.children is None:
+                if self.stats is not None:
+                    self.stats.comparisons += steps
+                node.keys.insert(index, value)
+                return
+            child = node.children[index]
+            if len(child.keys) == self._max_keys:
+                self._split_child(node, index)
+                if value >= node.keys[index]:
+                    index += 1
+                child = node.children[index]
+            node = child
+
+    # Split the full child at index into two nodes of t - 1 values, the middle value moves up
+    def _split_child(self, parent: _BTreeNode, index: int) -> None:
+        child = parent.children[index]
+        middle = self._min_degree - 1
+        if child.children is None:
+            right = _BTreeNode(child.keys[middle + 1 :])
+        else:
+            right = _BTreeNode(child.keys[middle + 1 :], child.children[middle + 1 :])
+            del child.children[middle + 1 :]
+        parent.keys.insert(index, child.keys[middle])
+        parent.children.insert(index + 1, right)
+        del child.keys[middle:]
+        child.size -= right.size + 1
+
+    # Returns whether the data was found and removed
+    def delete(self, data: int) -> bool:
+        removed = self._delete(self.root, data)
+        if not self.root.keys and self.root.children is not None:
+            # The only way the tree gets shorter, the root's last value moved down into a merge
+            self.root = self.root.children[0]
+        return removed
+
+    # Every node this steps into has at least t values (apart from the root), so it can lose one
+    # without the tree having to be fixed on the way back up
+    def _delete(self, node: _BTreeNode, data: int) -> bool:
+        if self.stats is not None:
+            self.stats.comparisons += 1
+        index = bisect.bisect_left(node.keys, data)
+        found = index < len(node.keys) and node.keys[index] == data
+        if node.children is None:
+            if found:
+                del node.keys[index]
+                node.size -= 1
+            return found
+
+        if found:
+            left = node.children[index]
+            right = node.children[index + 1]
+            if len(left.keys) >= self._min_degree:
+                # The predecessor takes the value's place and is removed from the left child
+                replacement = self._last(left)
+                node.keys[index] = replacement
+                self._delete(left, replacement)
+            elif len(right.keys) >= self._min_degree:
+                replacement = self._first(right)
+                node.keys[index] = replacement
+                self._delete(right, replacement)
+            else:
+                # Both are as small as they can be, the value moves down into their merge
+                self._merge_children(node, index)
+                self._delete(left, data)
+            node.size -= 1
+            return True
+
+        removed = self._delete(self._fill_child(node, index), data)
+        if removed:
+            node.size -= 1
+        return removed
+
+    # Make sure the child at index has at least t values by borrowing one through the parent from
+    # a sibling, or by merging with a sibling. Returns the node that now covers that child's range.
+    def _fill_child(self, node: _BTreeNode, index: int) -> _BTreeNode:
+        child = node.children[index]
+        if len(child.keys) >= self._min_degree:
+            return child
+        if index > 0 and len(node.children[index - 1].keys) >= self._min_degree:
+            left = node.children[index - 1]
+            child.keys.insert(0, node.keys[index - 1])
+            node.keys[index - 1] = left.keys.pop()
+            moved = 1
+            if left.children is not None:
+                grandchild = left.children.pop()
+                child.children.insert(0, grandchild)
+                moved += grandchild.size
+            left.size -= moved
+            child.size += moved
+            return child
+        if index < len(node.keys) and len(node.children[index + 1].keys) >= self._min_degree:
+            right = node.children[index + 1]
+            child.keys.append(node.keys[index])
+            node.keys[index] = right.keys.pop(0)
+            moved = 1
+            if right.children is not None:
+                grandchild = right.children.pop(0)
+                child.children.append(grandchild)
+                moved += grandchild.size
+            right.size -= moved
+            child.size += moved
+            return child
+        if index < len(node.keys):
+            self._merge_children(node, index)
+            return child
+        self._merge_children(node, index - 1)
+        return node.children[index - 1]
+
+    # The child at index takes the separating value and everything in the child after it
+    def _merge_children(self, node: _BTreeNode, index: int) -> None:
+        left = node.children[index]
+        right = node.children.pop(index + 1)
+        left.keys.append(node.keys.pop(index))
+        left.keys.extend(right.keys)
+        if left.children is not None:
+            left.children.extend(right.children)
+        left.size += right.size + 1
+
+    def _first(self, node: _BTreeNode) -> int:
+        while node.children is not None:
+            node = node.children[0]
+        return node.keys[0]
+
+    def _last(self, node: _BTreeNode) -> int:
+        while node.children is not None:
+            node = node.children[-1]
+        return node.keys[-1]
+
+    # Deeper values are always closer to x than the candidate from the level above
+    def floor(self, x: int) -> int:
+        best = None
+        node = self.root
+        steps = 0
+        while True:
+            steps += 1
+            index = bisect.bisect_right(node.keys, x)
+            if index:
+                best = node.keys[index - 1]
+            if node.children is None:
+                if self.stats is not None:
+                    self.stats.comparisons += steps
+                return best
+            node = node.children[index]
+
+    def ceil(self, x: int) -> int:
+        best = None
+        node = self.root
+        steps = 0
+        while True:
+            steps += 1
+            index = bisect.bisect_left(node.keys, x)
+            if index < len(node.keys):
+                best = node.keys[index]
+            if node.children is None:
+                if self.stats is not None:
+                    self.stats.comparisons += steps
+                return best
+            node = node.children[index]
+
+    # How many values are <= x, every level adds the values and subtrees left of the descent
+    def rank(self, x: int) -> int:
+        return self._count_left(x, bisect.bisect_right)
+
+    # How many values are < x
+    def _rank_below(self, x: int) -> int:
+        return self._count_left(x, bisect.bisect_left)
+
+    def _count_left(self, x: int, search) -> int:
+        count = 0
+        node = self.root
+        while True:
+            index = search(node.keys, x)
+            count += index
+            if node.children is None:
+                return count
+            for child in node.children[:index]:
+                count += child.size
+            node = node.children[index]
+
+    # The k-th smallest value, counting from 0 like a sorted list index
+    def select(self, k: int) -> int:
+        self._check_index(k)
+        node = self.root
+        while node.children is not None:
+            for index, child in enumerate(node.children):
+                if k < child.size:
+                    node = child
+                    break
+                k -= child.size
+                if k == 0:
+                    return node.keys[index]
+                k -= 1
+        return node.keys[k]
+
+    def __len__(self) -> int:
+        return self.root.size
+
+    def in_order(self):
+        # Each stack entry is a node and the index of the next child to visit in it
+        stack = [(self.root, 0)]
+        while stack:
+            node, index = stack.pop()
+            if node.children is None:
+                yield from node.keys
+                continue
+            if index > 0:
+                yield node.keys[index - 1]
+            if index < len(node.keys):
+                stack.append((node, index + 1))
+            stack.append((node.children[index], 0))
+
+    def height(self) -> int:
+        height = 1
+        node = self.root
+        while node.children is not None:
+            node = node.children[0]
+            height += 1
+        return height
+
+    def print_tree(self) -> None:
+        if self.root.size == 0:
+            print("Tree is empty")
+            return
+        print("Current B-tree state: ")
+        level = [self.root]
+        depth = 0
+        while level:
+            print(f"{depth:>3}: " + " ".join(str(node.keys) for node in level))
+            level = [child for node in level for child in node.children or []]
+            depth += 1
+        print()
+
+
+# B+-tree, the values only live in the leaves and the internal nodes just hold separators
+# https://en.wikipedia.org/wiki/B%2B_tree
+# Each leaf is a sorted list of up to leaf_size values linked to the leaves on either side, so once
+# a lookup has found its leaf, pred / succ / range only step along the leaf chain. With 64 way
+# internal nodes and 64 value leaves 10^7 values are 4 levels deep.
+# Copies of a value never straddle two leaves: every separator is strictly greater than everything
+# to its left, so all the copies of a value are found in the one leaf the descent lands in. A leaf
+# holding nothing but copies of one value can't be split and is allowed to grow past leaf_size.
+class _BPlusLeaf:
+    __slots__ = ("keys", "size", "prev", "next")
+    # Lets the descents check node.children the same way for leaves and internal nodes
+    children = None
+
+    def __init__(self, keys: List[int]) -> None:
+        self.keys = keys
+        self.size = len(keys)
+        self.prev = None
+        self.next = None
+
+
+class _BPlusInternal:
+    __slots__ = ("keys", "children", "size")
+
+    def __init__(self, keys: List[int], children: list) -> None:
+        # keys[i] separates children[i] (all < keys[i]) from children[i + 1] (all >= keys[i])
+        self.keys = keys
+        self.children = children
+        self.size = sum(child.size for child in children)
+
+
+class BPlusTree(_Engine):
+    # The most children an internal node can have, and the most values in a leaf
+    order = 64
+    leaf_size = 64
+
+    def __init__(self) -> None:
+        self._min_children = (self.order + 1) // 2
+        self._min_leaf = self.leaf_size // 2
+        self.root = _BPlusLeaf([])
+
+    # A BPlusTree class with a different order (and leaf size, which defaults to the order)
+    @classmethod
+    def with_order(cls, order: int, leaf_size: int = None) -> type:
+        leaf_size = order if leaf_size is None else leaf_size
+        if order < 3 or leaf_size < 2:
+            raise ValueError("A B+-tree needs an order of at least 3 and leaves of at least 2")
+        return type(
+            f"{cls.__name__}{order}", (cls,), {"order": order, "leaf_size": leaf_size}
+        )
+
+    # Leaves about three quarters full (cut where the value changes), then each level of internal
+    # nodes over the one below until there's a single root
+    @classmethod
+    def from_sorted(cls, sorted_data: List[int]) -> Self:
+        tree = cls()
+        values = list(sorted_data)
+        if not values:
+            return tree
+        target = max(1, tree.leaf_size * 3 // 4)
+        leaves = []
+        start = 0
+        while start < len(values):
+            stop = start + target
+            if stop < len(values) and values[stop - 1] == values[stop]:
+                stop = tree._boundary_near(values, stop, start, len(values))
+            leaves.append(_BPlusLeaf(values[start:stop]))
+            start = stop
+        if len(leaves) > 1 and len(leaves[-1].keys) < tree._min_leaf:
+            tree._redistribute_leaves(leaves[-2], leaves[-1])
+        for left, right in zip(leaves, leaves[1:]):
+            left.next = right
+            right.prev = left
+
+        nodes = leaves
+        target = tree.order * 3 // 4
+        while len(nodes) > 1:
+            # As close to target children each as the minimum and maximum allow, shared out evenly
+            count = max(round(len(nodes) / target), -(-len(nodes) // tree.order))
+            count = min(count, max(1, len(nodes) // tree._min_children))
+            base, extra = divmod(len(nodes), count)
+            parents = []
+            start = 0
+            for index in range(count):
+                stop = start + base + (1 if index < extra else 0)
+                group = nodes[start:stop]
+                parents.append(_BPlusInternal([tree._first(child) for child in group[1:]], group))
+                start = stop
+            nodes = parents
+        tree.root = nodes[0]
+        return tree
+
+    # The place to cut a sorted list between low and high, as close to index as possible without
+    # separating copies of a value. Returns low or high when every value in between is the same.
+    def _boundary_near(self, values: List[int], index: int, low: int, high: int) -> int:
+        before = bisect.bisect_left(values, values[index], low, high)
+        after = bisect.bisect_right(values, values[index], low, high)
+        if before == low:
+            return after
+        if after == high:
+            return before
+        return before if index - before <= after - index else after
+
+    def _first(self, node) -> int:
+        while node.children is not None:
+            node = node.children[0]
+        return node.keys[0]
+
+    def _leftmost_leaf(self) -> _BPlusLeaf:
+        node = self.root
+        while node.children is not None:
+            node = node.children[0]
+        return node
+
+    # The leaf that would hold x
+    def _leaf_for(self, x: int) -> _BPlusLeaf:
+        node = self.root
+        steps = 1
+        while node.children is not None:
+            steps += 1
+            node = node.children[bisect.bisect_right(node.keys, x)]
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return node
+
+    # The same, plus the nodes passed on the way down with the child index taken
+    def _find_leaf(self, x: int) -> Tuple[_BPlusLeaf, List[Tuple[_BPlusInternal, int]]]:
+        path = []
+        node = self.root
+        steps = 1
+        while node.children is not None:
+            steps += 1
+            index = bisect.bisect_right(node.keys, x)
+            path.append((node, index))
+            node = node.children[index]
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        return node, path
+
+    def insert(self, newNode) -> None:
+        value = _value(newNode)
+        node = self.root
+        path = []
+        steps = 1
+        while node.children is not None:
+            steps += 1
+            node.size += 1
+            index = bisect.bisect_right(node.keys, value)
+            path.append((node, index))
+            node = node.children[index]
+        if self.stats is not None:
+            self.stats.comparisons += steps
+        bisect.insort_right(node.keys, value)
+        node.size += 1
+        if len(node.keys) > self.leaf_size:
+            self._split_leaf(node, path)
+
+    def _split_leaf(self, leaf: _BPlusLeaf, path: List[Tuple[_BPlusInternal, int]]) -> None:
+        middle = len(leaf.keys) // 2
+        split = self._boundary_near(leaf.keys, middle, 0, len(leaf.keys))
+        if split == 0 or split == len(leaf.keys):
+            # Every value in the leaf is the same
+            return
+        right = _BPlusLeaf(leaf.keys[split:])
+        del leaf.keys[split:]
+        leaf.size = len(leaf.keys)
+        right.prev = leaf
+        right.next = leaf.next
+        if leaf.next is not None:
+            leaf.next.prev = right
+        leaf.next = right
+
+        # Each split can push a separator up into a parent that then has to split too
+        separator = right.keys[0]
+        new_node = right
+        while path:
+            parent, index = path.pop()
+            parent.keys.insert(index, separator)
+            parent.children.insert(index + 1, new_node)
+            if len(parent.children) <= self.order:
+                return
+            middle = len(parent.keys) // 2
+            separator = parent.keys[middle]
+            new_node = _BPlusInternal(parent.keys[middle + 1 :], parent.children[middle + 1 :])
+            del parent.keys[middle:]
+            del parent.children[middle + 1 :]
+            parent.size -= new_node.size
+        # The only way the tree gets taller, the root split under a new root
+        self.root = _BPlusInternal([separator], [self.root, new_node])
+
+    # Returns whether the data was found and removed
+    def delete(self, data: int) -> bool:
+        leaf, path = self._find_leaf(data)
+        index = bisect.bisect_left(leaf.keys, data)
+        if index == len(leaf.keys) or leaf.keys[index] != data:
+            return False
+        del leaf.keys[index]
+        leaf.size -= 1
+        for node, _ in path:
+            node.size -= 1
+        if path and len(leaf.keys) < self._min_leaf:
+            self._fix_leaf(leaf, path)
+        return True
+
+    # Top up a leaf that's under half full from a sibling, or merge the two if they fit in one
+    def _fix_leaf(self, leaf: _BPlusLeaf, path: List[Tuple[_BPlusInternal, int]]) -> None:
+        parent, index = path[-1]
+        if index > 0:
+            index -= 1
+        left = parent.children[index]
+        right = parent.children[index + 1]
+        if len(left.keys) + len(right.keys) > self.leaf_size and self._redistribute_leaves(
+            left, right
+        ):
+            parent.keys[index] = right.keys[0]
+            return
+        left.keys.extend(right.keys)
+        left.size = len(left.keys)
+        left.next = right.next
+        if right.next is not None:
+            right.next.prev = left
+        del parent.keys[index]
+        del parent.children[index + 1]
+        path.pop()
+        self._fix_internal(parent, path)
+
+    # Even out two neighbouring leaves, cutting where the value changes. Returns False and leaves
+    # them alone if every value in the two is the same.
+    def _redistribute_leaves(self, left: _BPlusLeaf, right: _BPlusLeaf) -> bool:
+        values = left.keys + right.keys
+        split = self._boundary_near(values, len(values) // 2, 0, len(values))
+        if split == 0 or split == len(values):
+            return False
+        left.keys = values[:split]
+        right.keys = values[split:]
+        left.size = len(left.keys)
+        right.size = len(right.keys)
+        return True
+
+    def _fix_internal(self, node: _BPlusInternal, path: List[Tuple[_BPlusInternal, int]]) -> None:
+        if not path:
+            if len(node.children) == 1:
+                # The only way the tree gets shorter, the root is down to one child
+                self.root = node.children[0]
+            return
+        if len(node.children) >= self._min_children:
+            return
+        parent, index = path[-1]
+        if index > 0:
+            index -= 1
+        left = parent.children[index]
+        right = parent.children[index + 1]
+        if len(left.children) + len(right.children) <= self.order:
+            left.keys.append(parent.keys.pop(index))
+            left.keys.extend(right.keys)
+            left.children.extend(right.children)
+            left.size += right.size
+            del parent.children[index + 1]
+            path.pop()
+            self._fix_internal(parent, path)
+        elif left is node:
+            # Borrow the right sibling's first child, its separator moves through the parent
+            moved = right.children.pop(0)
+            left.children.append(moved)
+            left.keys.append(parent.keys[index])
+            parent.keys[index] = right.keys.pop(0)
+            left.size += moved.size
+            right.size -= moved.size
+        else:
+            moved = left.children.pop()
+            right.children.insert(0, moved)
+            right.keys.insert(0, parent.keys[index])
+            parent.keys[index] = left.keys.pop()
+            left.size -= moved.size
+            right.size += moved.size
+
+    # Everything before the leaf the descent lands in is smaller than x, so if nothing in the leaf
+    # is <= x the answer is the last value of the leaf before it
+    def floor(self, x: int) -> int:
+        leaf = self._leaf_for(x)
+        index = bisect.bisect_right(leaf.keys, x)
+        if index:
+            return leaf.keys[index - 1]
+        return leaf.prev.keys[-1] if leaf.prev is not None else None
+
+    def ceil(self, x: int) -> int:
+        leaf = self._leaf_for(x)
+        index = bisect.bisect_left(leaf.keys, x)
+        if index < len(leaf.keys):
+            return leaf.keys[index]
+        return leaf.next.keys[0] if leaf.next is not None else None
+
+    # All values lo <= value <= hi in sorted order, walking the leaf chain from lo's leaf
+    def range(self, lo: int, hi: int) -> List[int]:
+        leaf = self._leaf_for(lo)
+        values = []
+        index = bisect.bisect_left(leaf.keys, lo)
+        while leaf is not None:
+            stop = bisect.bisect_right(leaf.keys, hi)
+            values.extend(leaf.keys[index:stop])
+            if stop < len(leaf.keys):
+                break
+            leaf = leaf.next
+            index = 0
+        return values
+
+    # How many values are <= x, every level adds the subtrees left of the descent
+    def rank(self, x: int) -> int:
+        return self._count_left(x, bisect.bisect_right)
+
+    # How many values are < x
+    def _rank_below(self, x: int) -> int:
+        return self._count_left(x, bisect.bisect_left)
+
+    def _count_left(self, x: int, search) -> int:
+        count = 0
+        node = self.root
+        while node.children is not None:
+            index = bisect.bisect_right(node.keys, x)
+            for child in node.children[:index]:
+                count += child.size
+            node = node.children[index]
+        return count + search(node.keys, x)
+
+    # The k-th smallest value, counting from 0 like a sorted list index
+    def select(self, k: int) -> int:
+        self._check_index(k)
+        node = self.root
+        while node.children is not None:
+            for child in node.children:
+                if k < child.size:
+                    node = child
+                    break
+                k -= child.size
+        return node.keys[k]
+
+    def __len__(self) -> int:
+        return self.root.size
+
+    def in_order(self):
+        leaf = self._leftmost_leaf()
+        while leaf is not None:
+            yield from leaf.keys
+            leaf = leaf.next
+
+    def height(self) -> int:
+        height = 1
+        node = self.root
+        while node.children is not None:
+            node = node.children[0]
+            height += 1
+        return height
+
+    def print_tree(self) -> None:
+        if self.root.size == 0:
+            print("Tree is empty")
+            return
+        print("Current B+-tree state: ")
+        level = [self.root]
+        depth = 0
+        while level:
+            print(f"{depth:>3}: " + " ".join(str(node.keys) for node in level))
+            level = [child for node in level for child in node.children or []]
+            depth += 1
+        print()
+
+
+# The engines by name, for picking one from the command line
+SEARCH_TREES = {
+    "avl": AVLTree,
+    "arena": ArenaAVLTree,
+    "redblack": RedBlackTree,
+    "treap": Treap,
+    "skiplist": SkipList,
+    "btree": BTree,
+    "btree64": BTree.with_order(64),
+    "bplus": BPlusTree,
+}
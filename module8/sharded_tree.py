@@ -0,0 +1,532 @@
+# CSC 506 - Design and Analysis of Algorithms
+# Module 8 - Portfolio Project - Option 2
+# Spreading a retroactive search tree over several processes by key range
+
+"""
+ShardedRetroactiveTree splits the keys into ranges and gives each range to its own worker process,
+which holds a normal retroactive tree with only the operations on its keys. Updates to different keys
+never affect each other, so each shard can replay, rebuild and answer queries on its own, and the
+shards all work at the same time.
+
+The tree still looks like one tree with one operation log. The coordinator keeps which shard each
+operation in the global log went to, and uses that to turn a global retro point into a point in the
+owning shard's log. Pred goes to the shard that owns x, and if nothing in that shard is <= x it falls
+back to the shard before it, and so on.
+
+Updates are sent to the shards without waiting for them, a shard works through its requests in the
+order they were sent, so any query sent later sees them. pred_many, insert_many and delete_many
+split a batch up by shard and send every shard its part at once.
+
+rebalance() moves the boundaries so every shard has about the same number of operations, pulling
+each shard's log back, merging them into global order and handing out the new slices.
+
+Example:
+    python sharded_tree.py --shards 4 --operations 200000
+"""
+# Imports
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from io import BytesIO
+import argparse
+import bisect
+import random
+import time
+from typing import List, Tuple
+
+from benchmark_suite import ENGINES
+from portfolio_project_option2 import FullyRetroactiveAVL, OperationLog
+from search_engines import SEARCH_TREES
+
+# The tree in a shard's worker process, only ever set in the worker
+_tree = None
+
+
+def _start_shard(engine: str, search_tree: str, opcodes: bytes, values: bytes) -> None:
+    global _tree
+    _tree = ENGINES[engine][0](SEARCH_TREES[search_tree])
+    _replay(OperationLog.from_buffers(opcodes, values))
+
+
+# Rebuild a shard from its slice of the log. Runs of the same operation go in as one batch.
+def _replay(operations: OperationLog) -> None:
+    run_operation = None
+    run = []
+    for operation, value in operations:
+        if operation != run_operation and run:
+            _update(run_operation, run, None)
+            run = []
+        run_operation = operation
+        run.append(value)
+    if run:
+        _update(run_operation, run, None)
+
+
+def _update(operation: str, values: List[int], retro_point: int) -> None:
+    if retro_point is not None:
+        getattr(_tree, operation)(values[0], retro=True, retro_point=retro_point)
+    elif hasattr(_tree, f"{operation}_many"):
+        getattr(_tree, f"{operation}_many")(values)
+    else:
+        for value in values:
+            getattr(_tree, operation)(value)
+
+
+# Each query is (x, retro_point) with the retro point already in this shard's log, None for the
+# present. A query that finds nothing in this shard gives None, the trees' pred would give -1 and
+# that's also a key the shard could hold.
+def _pred_batch(queries: List[Tuple[int, int]]) -> List[int]:
+    results = []
+    for x, retro_point in queries:
+        if retro_point is None:
+            results.append(_tree._pred(x))
+        else:
+            results.append(_tree._pred(x, retro_point))
+    return results
+
+
+# The shard's log as the raw opcode and value bytes, see OperationLog.from_buffers
+def _log_buffers() -> Tuple[bytes, bytes]:
+    opcodes = BytesIO()
+    values = BytesIO()
+    _tree._operations.write_opcodes(opcodes)
+    _tree._operations.write_values(values)
+    return opcodes.getvalue(), values.getvalue()
+
+
+# Which shard every operation in the global log went to, in log order. Like the OperationLog it is
+# kept in chunks so an insert in the middle only shifts one chunk, with a Fenwick tree over the
+# chunks that keeps a count per shard as well as the total. That makes "how many of shard s's
+# operations come before global index t" O(log m + chunk size).
+class _ShardLog:
+    _CHUNK_SIZE = 1024
+
+    def __init__(self, shards: int, entries: bytes = b"") -> None:
+        self._shards = shards
+        self._chunks: List[bytearray] = []
+        self._length = 0
+        self.extend(entries)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            yield from chunk
+
+    def extend(self, entries: bytes) -> None:
+        position = 0
+        new_chunks = len(self._chunks) == 0
+        while position < len(entries):
+            if len(self._chunks) == 0 or len(self._chunks[-1]) >= self._CHUNK_SIZE:
+                self._chunks.append(bytearray())
+                new_chunks = True
+            room = self._CHUNK_SIZE - len(self._chunks[-1])
+            piece = entries[position : position + room]
+            self._chunks[-1].extend(piece)
+            if not new_chunks:
+                for shard in set(piece):
+                    self._fenwick_add(len(self._chunks) - 1, shard, piece.count(shard))
+            position += room
+        self._length += len(entries)
+        # Every _CHUNK_SIZE entries there's a new chunk and the Fenwick tree is rebuilt for it
+        if new_chunks:
+            self._rebuild_fenwick()
+
+    def append(self, shard: int) -> None:
+        if len(self._chunks) == 0 or len(self._chunks[-1]) >= self._CHUNK_SIZE:
+            self.extend(bytes([shard]))
+            return
+        self._chunks[-1].append(shard)
+        self._length += 1
+        self._fenwick_add(len(self._chunks) - 1, shard)
+
+    def insert(self, index: int, shard: int) -> None:
+        if index >= self._length:
+            self.append(shard)
+            return
+        chunk, offset = self._locate(index)
+        self._chunks[chunk].insert(offset, shard)
+        self._length += 1
+        if len(self._chunks[chunk]) >= 2 * self._CHUNK_SIZE:
+            half = len(self._chunks[chunk]) // 2
+            self._chunks.insert(chunk + 1, self._chunks[chunk][half:])
+            del self._chunks[chunk][half:]
+            self._rebuild_fenwick()
+        else:
+            self._fenwick_add(chunk, shard)
+
+    # How many of the first index entries belong to the shard
+    def count_before(self, index: int, shard: int) -> int:
+        if index >= self._length:
+            return self._prefix(len(self._chunks), shard)
+        chunk, offset = self._locate(index)
+        return self._prefix(chunk, shard) + self._chunks[chunk].count(shard, 0, offset)
+
+    # _fenwick[i][s] is the Fenwick sum for shard s and _fenwick[i][-1] for all of them
+    def _rebuild_fenwick(self) -> None:
+        self._fenwick = [[0] * (self._shards + 1) for _ in range(len(self._chunks) + 1)]
+        for i, chunk in enumerate(self._chunks, start=1):
+            node = self._fenwick[i]
+            for shard in range(self._shards):
+                node[shard] += chunk.count(shard)
+            node[-1] += len(chunk)
+            parent = i + (i & -i)
+            if parent < len(self._fenwick):
+                for shard, amount in enumerate(node):
+                    self._fenwick[parent][shard] += amount
+
+    def _fenwick_add(self, chunk: int, shard: int, amount: int = 1) -> None:
+        i = chunk + 1
+        while i < len(self._fenwick):
+            self._fenwick[i][shard] += amount
+            self._fenwick[i][-1] += amount
+            i += i & -i
+
+    def _prefix(self, chunks: int, shard: int) -> int:
+        total = 0
+        while chunks > 0:
+            total += self._fenwick[chunks][shard]
+            chunks -= chunks & -chunks
+        return total
+
+    def _locate(self, index: int) -> Tuple[int, int]:
+        position = 0
+        remaining = index
+        step = 1 << (len(self._fenwick) - 1).bit_length()
+        while step > 0:
+            following = position + step
+            if following < len(self._fenwick) and self._fenwick[following][-1] <= remaining:
+                position = following
+                remaining -= self._fenwick[following][-1]
+            step >>= 1
+        return position, remaining
+
+
+class ShardedRetroactiveTree:
+    # Shard s owns the keys from boundaries[s - 1] up to but not including boundaries[s]. Without
+    # boundaries, key_range is split evenly and rebalance() can fix it up once there's data.
+    def __init__(
+        self,
+        shards: int = 4,
+        engine: str = "full",
+        search_tree: str = "avl",
+        boundaries: List[int] = None,
+        key_range: Tuple[int, int] = (0, 2**20),
+    ) -> None:
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}, expected one of {list(ENGINES)}")
+        if search_tree not in SEARCH_TREES:
+            raise ValueError(f"Unknown tree {search_tree}, expected one of {list(SEARCH_TREES)}")
+        if boundaries is None:
+            low, high = key_range
+            boundaries = [low + (high - low) * s // shards for s in range(1, shards)]
+        if not 1 <= len(boundaries) + 1 <= 255:
+            raise ValueError("A sharded tree has between 1 and 255 shards")
+        if list(boundaries) != sorted(boundaries):
+            raise ValueError("Shard boundaries have to be in increasing order")
+        self._engine = engine
+        self._search_tree = search_tree
+        self._can_query_past = ENGINES[engine][1]
+        self._pools: List[ProcessPoolExecutor] = []
+        self._start(list(boundaries), [(b"", b"")] * (len(boundaries) + 1))
+        self._log = _ShardLog(self.shards)
+
+    def __enter__(self) -> "ShardedRetroactiveTree":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for pool in self._pools:
+            pool.shutdown(cancel_futures=True)
+        self._pools = []
+
+    # Start a worker for each shard with its slice of the log, (opcodes, values) bytes per shard
+    def _start(self, boundaries: List[int], slices: List[Tuple[bytes, bytes]]) -> None:
+        self.close()
+        self._boundaries = boundaries
+        self._pools = [
+            ProcessPoolExecutor(
+                max_workers=1,
+                initializer=_start_shard,
+                initargs=(self._engine, self._search_tree, opcodes, values),
+            )
+            for opcodes, values in slices
+        ]
+        # Number of operations in each shard's log
+        self._lengths = [len(opcodes) for opcodes, _ in slices]
+        # Updates that have been sent but not checked on yet, per shard
+        self._pending: List[List[Future]] = [[] for _ in slices]
+
+    @property
+    def shards(self) -> int:
+        return len(self._pools)
+
+    @property
+    def boundaries(self) -> List[int]:
+        return list(self._boundaries)
+
+    # Number of operations in each shard's log
+    def shard_sizes(self) -> List[int]:
+        return list(self._lengths)
+
+    def __len__(self) -> int:
+        return sum(self._lengths)
+
+    def shard_for(self, value: int) -> int:
+        return bisect.bisect_right(self._boundaries, value)
+
+    # Send an update without waiting on it. Finished ones are checked as they pile up so an error
+    # in a shard comes out on a later call instead of being lost
+    def _send_update(self, shard: int, operation: str, values: List[int], retro_point: int) -> None:
+        pending = self._pending[shard]
+        pending.append(self._pools[shard].submit(_update, operation, values, retro_point))
+        while pending and pending[0].done():
+            pending.pop(0).result()
+
+    # Wait for every update sent so far to be done
+    def flush(self) -> None:
+        for pending in self._pending:
+            wait(pending)
+            for future in pending:
+                future.result()
+            pending.clear()
+
+    def _valid_retro_point(self, retro_point: int) -> bool:
+        return retro_point is not None and 0 <= retro_point <= len(self._log) - 1
+
+    # Updates are checked before they're logged here, the shard only finds out about a bad one after
+    # the global log has moved on and there'd be no way to take it back out
+    def _add_operation(
+        self, operation: str, data: int, retro: bool, retro_point: int
+    ) -> None:
+        OperationLog.check_value(data)
+        shard = self.shard_for(data)
+        local_point = None
+        if retro:
+            # Where the update lands in the shard's own log. If every one of the shard's
+            # operations comes before the retro point, it's just a present time update to the shard
+            local_point = self._log.count_before(retro_point, shard)
+            if local_point == self._lengths[shard]:
+                local_point = None
+            self._log.insert(retro_point, shard)
+        else:
+            self._log.append(shard)
+        self._lengths[shard] += 1
+        self._send_update(shard, operation, [data], local_point)
+
+    # Present time updates split up by shard, every shard gets its part in one go
+    def _add_operations(self, operation: str, values: List[int]) -> None:
+        for value in values:
+            OperationLog.check_value(value)
+        by_shard = {}
+        shards = bytearray()
+        for value in values:
+            shard = self.shard_for(value)
+            by_shard.setdefault(shard, []).append(value)
+            shards.append(shard)
+        self._log.extend(shards)
+        for shard, shard_values in by_shard.items():
+            self._lengths[shard] += len(shard_values)
+            self._send_update(shard, operation, shard_values, None)
+
+    def insert_many(self, values: List[int]) -> None:
+        self._add_operations("insert", values)
+
+    def delete_many(self, values: List[int]) -> None:
+        self._add_operations("delete", values)
+
+    def insert(self, data: int, retro: bool = False, retro_point: int = None) -> None:
+        if retro and not self._valid_retro_point(retro_point):
+            print(f"ShardRAIns: Invalid retro point {retro_point} for {len(self._log)} ops")
+            return
+        self._add_operation("insert", data, retro, retro_point)
+
+    def delete(self, data: int, retro: bool = False, retro_point: int = None) -> None:
+        if retro and not self._valid_retro_point(retro_point):
+            print(f"ShardRADel: Invalid retro point {retro_point} for {len(self._log)} ops")
+            return
+        self._add_operation("delete", data, retro, retro_point)
+
+    def pred(self, x: int, retro: bool = False, retro_point: int = None) -> int:
+        if retro and not self._valid_retro_point(retro_point):
+            print(f"ShardRAPred: Invalid retro point {retro_point} for {len(self._log)} ops")
+            return
+        return self.pred_many([(x, retro_point if retro else None)])[0]
+
+    # Answer a batch of (x, retro_point) Pred queries, None as the retro point for the present.
+    # Every shard gets all of its queries at once, and the ones that found nothing move down to
+    # the shard before for another round until they find something or run out of shards.
+    def pred_many(self, queries: List[Tuple[int, int]]) -> List[int]:
+        results = [None] * len(queries)
+        invalid = set()
+        waiting = []
+        for i, (x, retro_point) in enumerate(queries):
+            if retro_point is not None and not self._valid_retro_point(retro_point):
+                print(f"ShardRAPred: Invalid retro point {retro_point} for {len(self._log)} ops")
+                invalid.add(i)
+                continue
+            if retro_point is not None and not self._can_query_past:
+                raise ValueError(f"The {self._engine} engine can't query the past")
+            waiting.append((i, self.shard_for(x)))
+
+        while waiting:
+            by_shard = {}
+            for i, shard in waiting:
+                x, retro_point = queries[i]
+                local_point = None
+                if retro_point is not None:
+                    # The shard's state right after global operation retro_point is its state
+                    # after the last of its own operations up to there
+                    seen = self._log.count_before(retro_point + 1, shard)
+                    if seen == 0:
+                        # The shard had nothing in it yet, go straight to the one before
+                        continue
+                    local_point = seen - 1
+                ids, batch = by_shard.setdefault(shard, ([], []))
+                ids.append(i)
+                batch.append((x, local_point))
+            futures = {
+                shard: self._pools[shard].submit(_pred_batch, batch)
+                for shard, (_, batch) in by_shard.items()
+            }
+            found = set()
+            for shard, future in futures.items():
+                for i, result in zip(by_shard[shard][0], future.result()):
+                    if result is not None:
+                        results[i] = result
+                        found.add(i)
+            waiting = [
+                (i, shard - 1) for i, shard in waiting if i not in found and shard > 0
+            ]
+        # If nothing was found, there are no keys less than or equal to x in any shard
+        return [
+            result if result is not None or i in invalid else -1
+            for i, result in enumerate(results)
+        ]
+
+    # Move the boundaries so each shard ends up with about the same number of operations, which
+    # is what the work and memory of a shard grow with. The logs come back from the shards, get
+    # merged into global order and are split up again along the new boundaries. Returns the new
+    # boundaries.
+    def rebalance(self) -> List[int]:
+        self.flush()
+        buffers = [pool.submit(_log_buffers) for pool in self._pools]
+        logs = [OperationLog.from_buffers(*future.result()) for future in buffers]
+        readers = [iter(log) for log in logs]
+        operations = [next(readers[shard]) for shard in self._log]
+
+        shards = self.shards
+        keys = sorted(value for _, value in operations)
+        boundaries = self._boundaries
+        if keys:
+            boundaries = [keys[len(keys) * s // shards] for s in range(1, shards)]
+
+        slices = [OperationLog() for _ in range(shards)]
+        log = bytearray()
+        for operation in operations:
+            shard = bisect.bisect_right(boundaries, operation[1])
+            slices[shard].append(operation)
+            log.append(shard)
+        buffers = []
+        for shard_log in slices:
+            opcodes = BytesIO()
+            values = BytesIO()
+            shard_log.write_opcodes(opcodes)
+            shard_log.write_values(values)
+            buffers.append((opcodes.getvalue(), values.getvalue()))
+        self._start(boundaries, buffers)
+        self._log = _ShardLog(shards, log)
+        return self.boundaries
+
+    # How uneven the shards are, the biggest shard's log over the average, 1.0 is perfectly even
+    def imbalance(self) -> float:
+        if len(self) == 0:
+            return 1.0
+        return max(self._lengths) * self.shards / len(self)
+
+    def print_shards(self) -> None:
+        low = "-inf"
+        for shard, length in enumerate(self._lengths):
+            high = self._boundaries[shard] if shard < len(self._boundaries) else "inf"
+            print(f"Shard {shard}: keys [{low}, {high}), {length} ops")
+            low = high
+
+
+# Load the same keys into a sharded tree and a single FullyRetroactiveAVL, then time the same
+# retroactive updates and queries on both and check they give the same answers
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare a sharded tree with a single tree")
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--tree", default="avl", choices=list(SEARCH_TREES))
+    parser.add_argument("--operations", type=int, default=50000, help="present time inserts")
+    parser.add_argument("--retro", type=int, default=40, help="retroactive inserts and deletes")
+    parser.add_argument("--queries", type=int, default=20000, help="pred queries, half retroactive")
+    parser.add_argument("--batch", type=int, default=1000, help="inserts per insert_many")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    # Skewed keys so the evenly split starting boundaries are a bad fit until rebalance()
+    keys = [int(rng.paretovariate(1.2) * 1000) for _ in range(args.operations)]
+    updates = []
+    for _ in range(args.retro):
+        operation = rng.choice(["insert", "delete"])
+        updates.append((operation, rng.choice(keys), rng.randint(0, args.operations - 1)))
+    top = max(keys)
+    queries = [
+        (rng.randint(0, top), rng.randint(0, args.operations - 1) if i % 2 else None)
+        for i in range(args.queries)
+    ]
+
+    def load(tree: object) -> None:
+        for i in range(0, len(keys), args.batch):
+            tree.insert_many(keys[i : i + args.batch])
+
+    def retro_updates(tree: object) -> float:
+        start = time.perf_counter()
+        for operation, value, retro_point in updates:
+            getattr(tree, operation)(value, retro=True, retro_point=retro_point)
+        if isinstance(tree, ShardedRetroactiveTree):
+            tree.flush()
+        return time.perf_counter() - start
+
+    def run_queries(tree: object) -> Tuple[List[int], float]:
+        start = time.perf_counter()
+        if isinstance(tree, ShardedRetroactiveTree):
+            results = tree.pred_many(queries)
+        else:
+            results = [
+                tree.pred(x) if point is None else tree.pred(x, retro=True, retro_point=point)
+                for x, point in queries
+            ]
+        return results, time.perf_counter() - start
+
+    single = FullyRetroactiveAVL()
+    load(single)
+    single_updates = retro_updates(single)
+    expected, single_queries = run_queries(single)
+    print(f"single tree: {args.retro} retro updates {single_updates:.3f}s, ", end="")
+    print(f"{len(queries)} preds {single_queries:.3f}s")
+
+    with ShardedRetroactiveTree(args.shards, search_tree=args.tree, key_range=(0, top + 1)) as tree:
+        load(tree)
+        tree.flush()
+        print(f"{args.shards} shards loaded, imbalance {tree.imbalance():.2f}")
+        start = time.perf_counter()
+        tree.rebalance()
+        # Make sure the new shards have replayed their slices before timing anything
+        tree.pred_many([(boundary, None) for boundary in tree.boundaries + [top]])
+        print(f"rebalanced in {time.perf_counter() - start:.3f}s, imbalance {tree.imbalance():.2f}")
+        tree.print_shards()
+        sharded_updates = retro_updates(tree)
+        results, sharded_queries = run_queries(tree)
+        print(f"{args.shards} shards: {args.retro} retro updates {sharded_updates:.3f}s, ", end="")
+        print(f"{len(queries)} preds {sharded_queries:.3f}s")
+    if results != expected:
+        raise SystemExit("The sharded tree gave different answers from the single tree")
+    print("Answers match")
+
+
+if __name__ == "__main__":
+    main()
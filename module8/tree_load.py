@@ -0,0 +1,193 @@
+# CSC 506 - Design and Analysis of Algorithms
+# Module 8 - Portfolio Project - Option 2
+# Load generator for tree_service.py
+
+"""
+Opens a number of connections to a running tree_service.py, keeps up to --pipeline requests in
+flight on each one, and reports the throughput and the latency percentiles of each kind of request.
+The operations are drawn the same way as in benchmark_suite.py, so the same --mix and --retro
+settings can be used against the service and against the trees directly.
+
+Example:
+    python tree_service.py --engine full &
+    python tree_load.py --connections 8 --pipeline 16 --requests 20000 --mix insert=4,pred=4,retro_pred=1
+"""
+# Imports
+from collections import deque
+import argparse
+import asyncio
+import random
+import time
+from typing import Dict, List
+
+from benchmark_suite import OPERATIONS, RETRO_DISTRIBUTIONS, _parse_mix, retro_point_for
+from tree_service import DEFAULT_PORT
+from workload_trace import print_histograms
+
+
+# Fill the tree before the timed run so the retroactive requests have a history to go back into
+async def prefill(host: str, port: int, count: int, seed: int) -> None:
+    reader, writer = await asyncio.open_connection(host, port)
+    rng = random.Random(f"{seed}-prefill")
+    writer.write(b"".join(f"insert {rng.randint(0, count * 2)}\n".encode() for _ in range(count)))
+    await writer.drain()
+    for _ in range(count):
+        response = await reader.readline()
+        if response != b"ok\n":
+            raise RuntimeError(f"Prefill failed: {response.decode().strip()}")
+    writer.close()
+    await writer.wait_closed()
+
+
+# One connection's share of the requests. Requests are written as long as fewer than pipeline of
+# them are waiting for an answer, and each answer is matched up with the oldest request still
+# waiting since the service answers in order.
+async def run_connection(
+    host: str,
+    port: int,
+    requests: int,
+    pipeline: int,
+    mix: Dict[str, float],
+    retro: str,
+    history: int,
+    seed: int,
+) -> Dict[str, List[float]]:
+    reader, writer = await asyncio.open_connection(host, port)
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    # Only this connection's updates are counted, the other connections only make the history
+    # longer, so retro points drawn from this length are always valid
+    length = history
+    in_flight = deque()
+    slots = asyncio.Semaphore(pipeline)
+    latencies = {}
+    errors = []
+
+    async def receive() -> None:
+        for _ in range(requests):
+            response = await reader.readline()
+            if not response:
+                raise ConnectionError("The service closed the connection")
+            name, start = in_flight.popleft()
+            latencies.setdefault(name, []).append(time.perf_counter() - start)
+            if response.startswith(b"error"):
+                errors.append(response.decode().strip())
+            slots.release()
+
+    receiver = asyncio.create_task(receive())
+    for name in rng.choices(names, weights, k=requests):
+        operation = name.removeprefix("retro_")
+        value = rng.randint(0, history * 2)
+        request = f"{operation} {value}"
+        if name.startswith("retro_"):
+            request += f" {retro_point_for(retro, rng, length)}"
+        if operation != "pred":
+            length += 1
+        await slots.acquire()
+        in_flight.append((name, time.perf_counter()))
+        writer.write(request.encode() + b"\n")
+        # Let the socket catch up now and then rather than after every request
+        if len(in_flight) >= pipeline:
+            await writer.drain()
+    await writer.drain()
+    await receiver
+    writer.close()
+    await writer.wait_closed()
+    if errors:
+        latencies["errors"] = errors
+    return latencies
+
+
+async def stats(host: str, port: int) -> str:
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b"stats\n")
+    await writer.drain()
+    response = await reader.readline()
+    writer.close()
+    await writer.wait_closed()
+    return response.decode().strip()
+
+
+async def run_load(args: argparse.Namespace) -> None:
+    if args.prefill > 0:
+        await prefill(args.host, args.port, args.prefill, args.seed)
+    before = await stats(args.host, args.port)
+    per_connection = args.requests // args.connections
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(
+            run_connection(
+                args.host,
+                args.port,
+                per_connection,
+                args.pipeline,
+                args.mix,
+                args.retro,
+                args.prefill,
+                f"{args.seed}-{connection}",
+            )
+            for connection in range(args.connections)
+        )
+    )
+    total = time.perf_counter() - start
+    after = await stats(args.host, args.port)
+
+    latencies = {}
+    errors = []
+    for result in results:
+        errors.extend(result.pop("errors", []))
+        for name, values in result.items():
+            latencies.setdefault(name, []).extend(values)
+    calls = sum(len(values) for values in latencies.values())
+    print(
+        f"{calls} requests over {args.connections} connections in {total:.3f}s, "
+        f"{calls / total:.0f} requests/s"
+    )
+    # How much the service coalesced, from the difference in its counters
+    requests, batches = (
+        int(after.split()[i]) - int(before.split()[i]) for i in (1, 3)
+    )
+    if batches:
+        print(f"{batches} batches, {requests / batches:.1f} requests per batch")
+    if errors:
+        print(f"{len(errors)} errors, the first was: {errors[0]}")
+    print()
+    print_histograms(latencies)
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Generate load against tree_service.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument(
+        "--pipeline", type=int, default=8, help="most requests in flight on each connection"
+    )
+    parser.add_argument("--requests", type=int, default=10000, help="total timed requests")
+    parser.add_argument(
+        "--prefill", type=int, default=1000, help="inserts to send before the timed requests"
+    )
+    parser.add_argument(
+        "--mix",
+        type=_parse_mix,
+        default={"insert": 1, "delete": 1, "pred": 2},
+        help=f"comma separated operation=weight pairs, operations are {', '.join(OPERATIONS)}",
+    )
+    parser.add_argument(
+        "--retro",
+        default="uniform",
+        help=f"{', '.join(RETRO_DISTRIBUTIONS)} or a fixed fraction of the history like 0.9",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    for name in args.mix:
+        if name not in OPERATIONS:
+            parser.error(f"unknown operation {name}, expected one of {OPERATIONS}")
+    if args.prefill < 1 and any(name.startswith("retro_") for name in args.mix):
+        parser.error("retroactive requests need a history, use --prefill")
+    asyncio.run(run_load(args))
+
+
+if __name__ == "__main__":
+    main()
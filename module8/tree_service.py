@@ -0,0 +1,265 @@
+# CSC 506 - Design and Analysis of Algorithms
+# Module 8 - Portfolio Project - Option 2
+# Serving a retroactive search tree to other processes over a local socket
+
+"""
+An asyncio server that holds one retroactive tree and answers requests from any number of
+connections. The protocol is one request per line and one response per line, in the same order:
+
+    insert <value> [retro_point]    -> ok
+    delete <value> [retro_point]    -> ok
+    pred <x> [retro_point]          -> the largest value <= x, or -1
+    stats                           -> requests <n> batches <n>
+
+Anything that goes wrong with a request is answered with "error <message>" and the connection
+carries on. Clients can pipeline, sending more requests without waiting for the answers.
+
+The tree itself lives in a worker process, so a retroactive update that has to rebuild a long
+history never holds up the event loop. The event loop only reads requests and writes responses.
+Requests from every connection go into one queue, and whatever has piled up while the worker was
+busy is sent over as a single batch, where runs of present time inserts go into the tree with one
+insert_many. The busier the server, the bigger the batches.
+
+Example:
+    python tree_service.py --engine full --port 7506
+    python tree_load.py --port 7506 --connections 8 --pipeline 16
+"""
+# Imports
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import asyncio
+from typing import List, Tuple
+
+from benchmark_suite import ENGINES
+from search_engines import SEARCH_TREES
+
+DEFAULT_PORT = 7506
+# The most requests sent to the worker in one go
+MAX_BATCH = 4096
+# The most requests a connection can have waiting for their answers before the server stops
+# reading from it
+MAX_PIPELINE = 1024
+
+# The tree, only ever set in the worker process
+_tree = None
+
+
+def _start_worker(engine: str, search_tree: str) -> None:
+    global _tree
+    _tree = ENGINES[engine][0](SEARCH_TREES[search_tree])
+
+
+# Runs in the worker. Each request is (operation, value, retro_point) and the results line up with
+# the requests, None for an update and the pred result otherwise. A request that fails gets its
+# error as the result instead of failing the whole batch.
+def _run_batch(requests: List[Tuple[str, int, int]]) -> List[object]:
+    results = []
+    # Present time inserts waiting to go in together, they have to go in before anything else does.
+    # start is where their results begin.
+    inserts = []
+    start = 0
+    for operation, value, retro_point in requests:
+        if operation == "insert" and retro_point is None:
+            if not inserts:
+                start = len(results)
+            inserts.append(value)
+            results.append(None)
+            continue
+        if inserts:
+            _flush_inserts(inserts, results, start)
+            inserts = []
+        try:
+            results.append(_run_request(operation, value, retro_point))
+        except Exception as error:
+            results.append(error)
+    if inserts:
+        _flush_inserts(inserts, results, start)
+    return results
+
+
+# If a run of inserts fails, only the requests in that run get the error
+def _flush_inserts(values: List[int], results: List[object], start: int) -> None:
+    try:
+        _insert_many(values)
+    except Exception as error:
+        results[start : start + len(values)] = [error] * len(values)
+
+
+def _insert_many(values: List[int]) -> None:
+    if hasattr(_tree, "insert_many"):
+        _tree.insert_many(values)
+    else:
+        for value in values:
+            _tree.insert(value)
+
+
+def _run_request(operation: str, value: int, retro_point: int) -> object:
+    retro = retro_point is not None
+    # The trees only print a message for a bad retro point, the client needs to hear about it.
+    # len() of a retroactive tree is the number of operations in its log.
+    if retro and not 0 <= retro_point < len(_tree):
+        raise ValueError(f"invalid retro point {retro_point} for {len(_tree)} ops")
+    if operation == "insert":
+        return _tree.insert(value, retro=retro, retro_point=retro_point)
+    if operation == "delete":
+        return _tree.delete(value, retro=retro, retro_point=retro_point)
+    if retro:
+        return _tree.pred(value, retro=True, retro_point=retro_point)
+    return _tree.pred(value)
+
+
+# "pred 5 12" -> ("pred", 5, 12)
+def parse_request(line: bytes) -> Tuple[str, int, int]:
+    parts = line.split()
+    if not parts:
+        raise ValueError("empty request")
+    operation = parts[0].decode("ascii", "replace")
+    if operation == "stats":
+        if len(parts) != 1:
+            raise ValueError("stats takes no arguments")
+        return operation, None, None
+    if operation not in ("insert", "delete", "pred"):
+        raise ValueError(f"unknown operation {operation}")
+    if len(parts) not in (2, 3):
+        raise ValueError(f"{operation} takes a value and an optional retro point")
+    value = int(parts[1])
+    retro_point = int(parts[2]) if len(parts) == 3 else None
+    return operation, value, retro_point
+
+
+def format_response(result: object) -> bytes:
+    if isinstance(result, Exception):
+        message = str(result).replace("\n", " ") or type(result).__name__
+        return f"error {message}\n".encode()
+    if result is None:
+        return b"ok\n"
+    return f"{result}\n".encode()
+
+
+class TreeService:
+    def __init__(self, engine: str = "full", search_tree: str = "avl") -> None:
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}, expected one of {list(ENGINES)}")
+        if search_tree not in SEARCH_TREES:
+            raise ValueError(f"Unknown tree {search_tree}, expected one of {list(SEARCH_TREES)}")
+        # One worker, the tree can only be in one place
+        self._pool = ProcessPoolExecutor(
+            max_workers=1, initializer=_start_worker, initargs=(engine, search_tree)
+        )
+        # (request, future) pairs waiting for the next batch
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self.requests = 0
+        self.batches = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = DEFAULT_PORT) -> asyncio.Server:
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        return await asyncio.start_server(self._handle, host, port)
+
+    def close(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        self._pool.shutdown(cancel_futures=True)
+
+    # Queue a request for the worker, the future gets its result
+    def submit(self, request: Tuple[str, int, int]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if request[0] == "stats":
+            future.set_result(f"requests {self.requests} batches {self.batches}")
+            return future
+        self._pending.append((request, future))
+        self._wakeup.set()
+        return future
+
+    # Only one batch is ever with the worker, so the tree sees the requests in the order they came
+    # in and everything that arrives in the meantime makes up the next batch
+    async def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                batch = self._pending[:MAX_BATCH]
+                del self._pending[:MAX_BATCH]
+                try:
+                    results = await loop.run_in_executor(
+                        self._pool, _run_batch, [request for request, _ in batch]
+                    )
+                except Exception as error:
+                    # The worker itself failed, not just one of the requests
+                    results = [error] * len(batch)
+                self.requests += len(batch)
+                self.batches += 1
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+
+    # Reading and answering are separate tasks so a client can keep sending while earlier
+    # requests are still with the worker. The queue keeps the answers in request order.
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        answers = asyncio.Queue(maxsize=MAX_PIPELINE)
+        sender = asyncio.create_task(self._send(answers, writer))
+        try:
+            async for line in reader:
+                try:
+                    future = self.submit(parse_request(line))
+                except ValueError as error:
+                    future = asyncio.get_running_loop().create_future()
+                    future.set_result(error)
+                await answers.put(future)
+        except ConnectionError:
+            pass
+        finally:
+            await answers.put(None)
+            await sender
+            writer.close()
+
+    async def _send(self, answers: asyncio.Queue, writer: asyncio.StreamWriter) -> None:
+        while True:
+            future = await answers.get()
+            if future is None:
+                return
+            writer.write(format_response(await future))
+            # Only wait for the socket once there's nothing else ready to go out
+            if answers.empty():
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    # Keep taking answers off the queue so the reading side doesn't get stuck
+                    pass
+
+
+async def serve(
+    engine: str = "full",
+    search_tree: str = "avl",
+    host: str = "127.0.0.1",
+    port: int = DEFAULT_PORT,
+) -> None:
+    service = TreeService(engine, search_tree)
+    server = await service.start(host, port)
+    print(f"Serving a {engine} tree on {host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Serve a retroactive tree over a local socket")
+    parser.add_argument("--engine", default="full", choices=list(ENGINES))
+    parser.add_argument(
+        "--tree", default="avl", choices=list(SEARCH_TREES), help="search tree the engine runs on"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.engine, args.tree, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+# CSC 506 - Design and Analysis of Algorithms
+# Module 8 - Portfolio Project - Option 2
+# Recording and replaying traffic against the retroactive search trees
+
+"""
+RecordingTree wraps any of the retroactive trees and writes every insert, delete, pred,
+insert_many and delete_many call it passes through (including retro and retro_point) to a binary
+trace file. replay() then drives any
+engine with the exact same calls, either as fast as possible or paced to the original timing, and
+collects the latency of each call so engines can be compared on identical traffic.
+
+Trace format, all little endian:
+    header  8 bytes  b"RTRACE1\\n"
+    entry   1 byte   operation (1 insert, 2 delete, 3 pred, 4 insert_many, 5 delete_many), with
+                     0x80 set for retroactive calls
+            8 bytes  value, signed, or the number of values for insert_many and delete_many
+            4 bytes  microseconds since the previous call started, unsigned
+            8 bytes  retro point, signed, only present for retroactive calls
+            8 bytes  per value, signed, only present for insert_many and delete_many
+
+Example:
+    python workload_trace.py traffic.trace --engine full --paced
+    python workload_trace.py traffic.trace --engine rollback --tree btree
+"""
+# Imports
+from dataclasses import dataclass
+import argparse
+import inspect
+import struct
+import time
+from typing import BinaryIO, Dict, Iterator, List
+
+from benchmark_suite import ENGINES, percentile
+from search_engines import SEARCH_TREES
+
+_HEADER = b"RTRACE1\n"
+_OPCODES = {"insert": 1, "delete": 2, "pred": 3, "insert_many": 4, "delete_many": 5}
+_BATCHES = {"insert_many", "delete_many"}
+_OPERATIONS = {code: name for name, code in _OPCODES.items()}
+_RETRO_FLAG = 0x80
+_ENTRY = struct.Struct("<BqI")
+_RETRO_POINT = struct.Struct("<q")
+_VALUE = struct.Struct("<q")
+# The gap between calls has to fit in 4 bytes, about 71 minutes
+_MAX_DELAY_US = 2**32 - 1
+
+
+@dataclass(slots=True)
+class TraceEntry:
+    operation: str
+    value: int
+    retro_point: int
+    # Seconds between the previous call starting and this one starting
+    delay: float
+    # The values of an insert_many or delete_many call, value is how many there are
+    values: List[int] = None
+
+    @property
+    def retro(self) -> bool:
+        return self.retro_point is not None
+
+
+# Passes calls through to the tree it wraps while writing them to the trace. insert, delete, pred,
+# insert_many and delete_many are recorded, they're the only calls that change the tree or that
+# replay() measures. Anything else (rank, print_tree, ...) goes straight to the tree unrecorded.
+class RecordingTree:
+
+    def __init__(self, tree: object, path: str) -> None:
+        self._tree = tree
+        self._file = open(path, "wb")
+        self._file.write(_HEADER)
+        self._last_call = None
+
+    def __getattr__(self, name: str) -> object:
+        return getattr(self._tree, name)
+
+    def __enter__(self) -> "RecordingTree":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _record(self, operation: str, value: int, retro: bool, retro_point: int) -> None:
+        now = time.perf_counter_ns()
+        delay = 0 if self._last_call is None else (now - self._last_call) // 1000
+        self._last_call = now
+        code = _OPCODES[operation]
+        if retro:
+            code |= _RETRO_FLAG
+        self._file.write(_ENTRY.pack(code, value, min(delay, _MAX_DELAY_US)))
+        if retro:
+            # A missing retro point is written as -1, the trees treat both as invalid
+            self._file.write(_RETRO_POINT.pack(-1 if retro_point is None else retro_point))
+
+    def _record_batch(self, operation: str, values: List[int]) -> List[int]:
+        values = list(values)
+        self._record(operation, len(values), False, None)
+        self._file.write(struct.pack(f"<{len(values)}q", *values))
+        return values
+
+    def insert(self, data: int, retro: bool = False, retro_point: int = None) -> None:
+        self._record("insert", data, retro, retro_point)
+        return self._tree.insert(data, retro=retro, retro_point=retro_point)
+
+    def delete(self, data: int, retro: bool = False, retro_point: int = None) -> None:
+        self._record("delete", data, retro, retro_point)
+        return self._tree.delete(data, retro=retro, retro_point=retro_point)
+
+    def insert_many(self, values: List[int]) -> None:
+        return self._tree.insert_many(self._record_batch("insert_many", values))
+
+    def delete_many(self, values: List[int]) -> None:
+        return self._tree.delete_many(self._record_batch("delete_many", values))
+
+    def pred(self, x: int, retro: bool = False, retro_point: int = None) -> int:
+        self._record("pred", x, retro, retro_point)
+        if retro:
+            return self._tree.pred(x, retro=retro, retro_point=retro_point)
+        # The partially retroactive trees don't take the retro arguments at all
+        return self._tree.pred(x)
+
+
+def read_trace(path: str) -> Iterator[TraceEntry]:
+    with open(path, "rb") as trace:
+        if trace.read(len(_HEADER)) != _HEADER:
+            raise ValueError(f"{path} is not a trace file")
+        yield from _read_entries(trace)
+
+
+def _read_entries(trace: BinaryIO) -> Iterator[TraceEntry]:
+    while True:
+        entry = trace.read(_ENTRY.size)
+        if len(entry) == 0:
+            return
+        if len(entry) < _ENTRY.size:
+            raise ValueError("Trace file ends part way through an entry")
+        code, value, delay = _ENTRY.unpack(entry)
+        retro_point = None
+        if code & _RETRO_FLAG:
+            point = trace.read(_RETRO_POINT.size)
+            if len(point) < _RETRO_POINT.size:
+                raise ValueError("Trace file ends part way through an entry")
+            (retro_point,) = _RETRO_POINT.unpack(point)
+        operation = _OPERATIONS[code & ~_RETRO_FLAG]
+        values = None
+        if operation in _BATCHES:
+            batch = trace.read(value * _VALUE.size)
+            if len(batch) < value * _VALUE.size:
+                raise ValueError("Trace file ends part way through an entry")
+            values = list(struct.unpack(f"<{value}q", batch))
+        yield TraceEntry(operation, value, retro_point, delay / 1e6, values)
+
+
+# Drive a tree with every call in the trace and return the latencies (in seconds) of each kind of
+# call, keyed like "insert" or "retro_pred". When paced, each call waits until the same amount of
+# time has passed since the start as it had in the original run (divided by speed), so bursts and
+# idle gaps are kept. Retroactive preds are skipped for trees that can only query the present.
+def replay(
+    path: str, tree: object, paced: bool = False, speed: float = 1.0
+) -> Dict[str, List[float]]:
+    latencies = {}
+    can_query_past = _can_query_past(tree)
+    start = time.perf_counter()
+    scheduled = 0.0
+    for entry in read_trace(path):
+        scheduled += entry.delay / speed
+        if paced:
+            wait = start + scheduled - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        name = f"retro_{entry.operation}" if entry.retro else entry.operation
+        if entry.operation == "pred" and entry.retro and not can_query_past:
+            latencies.setdefault("skipped", []).append(0.0)
+            continue
+
+        call_start = time.perf_counter()
+        if entry.operation == "insert":
+            tree.insert(entry.value, retro=entry.retro, retro_point=entry.retro_point)
+        elif entry.operation == "delete":
+            tree.delete(entry.value, retro=entry.retro, retro_point=entry.retro_point)
+        elif entry.operation in _BATCHES:
+            _replay_batch(tree, entry)
+        elif entry.retro:
+            tree.pred(entry.value, retro=True, retro_point=entry.retro_point)
+        else:
+            tree.pred(entry.value)
+        latencies.setdefault(name, []).append(time.perf_counter() - call_start)
+    return latencies
+
+
+# Engines without batch updates get the same values one call at a time, in the same order
+def _replay_batch(tree: object, entry: TraceEntry) -> None:
+    batch = getattr(tree, entry.operation, None)
+    if batch is not None:
+        batch(entry.values)
+        return
+    update = tree.insert if entry.operation == "insert_many" else tree.delete
+    for value in entry.values:
+        update(value)
+
+
+# The partially retroactive trees' pred doesn't take the retro arguments
+def _can_query_past(tree: object) -> bool:
+    return "retro" in inspect.signature(tree.pred).parameters
+
+
+# Latency histogram with power of two buckets in microseconds, bucket b counts the calls that took
+# at least 2**(b-1) and less than 2**b microseconds (bucket 0 is anything under 1 microsecond)
+def latency_histogram(latencies: List[float]) -> Dict[int, int]:
+    buckets = {}
+    for latency in latencies:
+        bucket = int(latency * 1e6).bit_length()
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+    return dict(sorted(buckets.items()))
+
+
+def print_histograms(latencies: Dict[str, List[float]], width: int = 40) -> None:
+    for name, values in sorted(latencies.items()):
+        if name == "skipped":
+            print(f"{len(values)} retroactive preds skipped")
+            continue
+        values = sorted(values)
+        print(
+            f"{name}: {len(values)} calls, p50 {percentile(values, 0.50) * 1e6:.2f}us, "
+            f"p95 {percentile(values, 0.95) * 1e6:.2f}us, p99 {percentile(values, 0.99) * 1e6:.2f}us"
+        )
+        histogram = latency_histogram(values)
+        most = max(histogram.values())
+        for bucket, count in histogram.items():
+            low = 0 if bucket == 0 else 2 ** (bucket - 1)
+            bar = "#" * max(1, count * width // most)
+            print(f"  {low:>9}us - {2**bucket:>9}us | {count:>8} | {bar}")
+        print()
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Replay a recorded trace against an engine")
+    parser.add_argument("trace")
+    parser.add_argument("--engine", default="full", choices=list(ENGINES))
+    parser.add_argument(
+        "--tree", default="avl", choices=list(SEARCH_TREES), help="search tree the engine runs on"
+    )
+    parser.add_argument(
+        "--paced", action="store_true", help="keep the original gaps between calls"
+    )
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="with --paced, how many times faster to play"
+    )
+    args = parser.parse_args(argv)
+
+    tree = ENGINES[args.engine][0](SEARCH_TREES[args.tree])
+    start = time.perf_counter()
+    latencies = replay(args.trace, tree, paced=args.paced, speed=args.speed)
+    total = time.perf_counter() - start
+    calls = sum(len(values) for name, values in latencies.items() if name != "skipped")
+    print(f"Replayed {calls} calls in {total:.4f}s")
+    print()
+    print_histograms(latencies)
+
+
+if __name__ == "__main__":
+    main()